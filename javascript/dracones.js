@@ -147,6 +147,15 @@ var dracones = dracones || (function() {
            @param {str} [config.select_mode] How selection is to be performed on a DLayer: "reset" (default) will unselect all features before selecting new ones, 
                                              "toggle" will toggle the selected state of the target items, and "add" will not unselect nor toggle anything before selecting new features.
                                              Note that this mode affects all the selection mechanisms: mouse (point/box selection) as well as calls to the selectFeatures method.
+           @param {str} [config.img_delivery="url"] How the map image is delivered: "url" (saved server-side in the ms_tmp directory, and then fetched by the browser),
+                                                    "inline" (embedded in the JSON response as a data URI, which saves a disk write and an HTTP round trip per request),
+                                                    or "lazy" (drawn only when fetched by the browser, and skipped if a newer map state replaced it first).
+           @param {bool} [config.tiled=false] If set to true, the map is made of fixed grid tiles that are cached server-side (and by the browser) across requests and sessions,
+                                              so that panning only requires the newly exposed tiles to be rendered.
+           @param {str} [config.hover_encoding="list"] How the hover items are sent by the server: "list" (one [gx, gy, html] triplet per item) or "compact"
+                                                      (numeric coordinate arrays, and a table of the distinct html strings), much smaller for large numbers of items.
+           @param {bool} [config.delta_responses=false] If set to true, the server only sends the selection of the dlayers that changed since the last response
+                                                        (the full selection is rebuilt client-side, and still passed as resp.selection to the success callback).
 
            @example
            var mw = new dracones.MapWidget({
@@ -202,6 +211,15 @@ var dracones = dracones || (function() {
             // if set, called by handleSuccess when it's done
             var success_callback = null;
 
+            // rev of the last response processed (sent back with every request), and full selection
+            // map, which the delta responses are merged into (see config.delta_responses)
+            var known_rev = null;
+            var current_selection = {};
+            // evaluated by jQuery when the (possibly queued) request is actually sent
+            var getKnownRev = function() {
+                return known_rev === null ? '' : known_rev;
+            };
+
             // click/dblclick distinction mechanism
             var click_timeout = null;
             var click_timeout_delay = 300;
@@ -295,6 +313,59 @@ var dracones = dracones || (function() {
 
             };
 
+            // In tiled mode, the map is made of tile images, attached to a container div in each moving_anchor. The map img
+            // is then a transparent overlay on top of them (it keeps receiving the mouse events), and mapImageLoadCallback is
+            // called once all the tiles of a response have loaded.
+            var BLANK_IMG_SRC = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7';
+
+            /** @private */
+            function setupTiles(anchor) {
+                anchor.tiles = jQuery('<div />').prependTo(anchor);
+                anchor.tiles.css({
+                    position: 'absolute',
+                    overflow: 'hidden',
+                    left: 1, // map img border
+                    top: 1,
+                    width: map_vp_width * config.map_size_rel_to_vp,
+                    height: map_vp_height * config.map_size_rel_to_vp
+                });
+                anchor.map_img.css({
+                    position: 'relative',
+                    'z-index': 1,
+                    width: map_vp_width * config.map_size_rel_to_vp,
+                    height: map_vp_height * config.map_size_rel_to_vp
+                });
+                anchor.map_img.attr('src', BLANK_IMG_SRC);
+            };
+
+            /** @private */
+            function loadTiles(anchor, tiles) {
+                var n_pending = tiles.length;
+                var tileLoaded = function() {
+                    n_pending -= 1;
+                    if (n_pending == 0) {
+                        mapImageLoadCallback();
+                    }
+                };
+                anchor.tiles.empty();
+                jQuery.each(tiles, function(i, tile) {
+                    var tile_img = jQuery('<img />').appendTo(anchor.tiles);
+                    tile_img.css({
+                        position: 'absolute',
+                        border: 0,
+                        left: tile.x,
+                        top: tile.y
+                    });
+                    // tile URLs are content addressed: they can safely be cached by the browser
+                    tile_img.bind('load', tileLoaded);
+                    tile_img.bind('error', tileLoaded);
+                    tile_img.attr('src', tile.url);
+                });
+                if (tiles.length == 0) {
+                    mapImageLoadCallback();
+                }
+            };
+
             // First moving anchor div, on which the first map img is attached
             var moving_anchor = jQuery('<div />').appendTo(vp);
             moving_anchor.css({
@@ -326,7 +397,11 @@ var dracones = dracones || (function() {
             map_img.bind('dragstart', function() { return false; }); // prevents img selection in Chrome
 
             // This function is called whenever the map img has finished loading
-            map_img.bind('load', mapImageLoadCallback);
+            if (config.tiled) {
+                setupTiles(moving_anchor);
+            } else {
+                map_img.bind('load', mapImageLoadCallback);
+            }
 
             // Second moving anchor div, on which the second map img is attached; used to prevent flickering while performing positioning computations.
             var moving_anchor2 = jQuery('<div />').appendTo(vp);
@@ -359,7 +434,11 @@ var dracones = dracones || (function() {
             map_img2.bind('dragstart', function() { return false; }); // prevents img selection in Chrome
 
             // This function is called whenever the map img has finished loading
-            map_img2.bind('load', mapImageLoadCallback);
+            if (config.tiled) {
+                setupTiles(moving_anchor2);
+            } else {
+                map_img2.bind('load', mapImageLoadCallback);
+            }
 
             // Both moving_anchors
             var moving_anchors = [moving_anchor, moving_anchor2];
@@ -435,6 +514,7 @@ var dracones = dracones || (function() {
             var pan_locked = false;
             var pan_dir = null;
             var center_viewport = false;
+            var center_after_superseded = false; // centering required by a superseded response, left to the next one
 
             // transform some list params that can be allowed as strings
             if (typeof config.point_action_dlayers === 'string') {
@@ -577,7 +657,9 @@ var dracones = dracones || (function() {
                             dataType: 'json',
                             data: {
                                 mid: config.mid,
-                                dir: dir
+                                rev: getKnownRev,
+                                dir: dir,
+                                nav_pending: hasPendingNavigation
                             },
                             success: that.handleSuccess,
                             error: that.handleError
@@ -586,6 +668,20 @@ var dracones = dracones || (function() {
                 }
             };
 
+            /**
+               Evaluated when a pan/zoom request is actually sent (it is then at the head of the queue): whether other
+               navigation requests are queued behind it, in which case the server does not render its image.
+               @private */
+            function hasPendingNavigation() {
+                var q = (typeof document.ajaxq !== 'undefined' && document.ajaxq.q[ajaxq_name]) ? document.ajaxq.q[ajaxq_name] : [];
+                for (var i = 1; i < q.length; i++) {
+                    if (/\/dracones_do\/(pan|zoom)$/.test(q[i].url)) {
+                        return true;
+                    }
+                }
+                return false;
+            };
+
             /** @private */
             function panUp(event) {
                 for (var i = 0; i < 2; i++) {
@@ -636,6 +732,8 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {
                         mid: config.mid,
+                        rev: getKnownRev,
+                        nav_pending: hasPendingNavigation,
                         mode: mev.mod == 'shift' ? 'out' : 'in',
                         zsize: zsize,
                         x: event.pageX - vp_pos.x + map_vp_width + (-map_vp_width - ma_pos.x),
@@ -665,6 +763,7 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {
                         mid: config.mid,
+                        rev: getKnownRev,
                         action: config.point_action,
                         select_mode: config.select_mode,
                         x: event.pageX - vp_pos.x - ma_pos.x,
@@ -756,6 +855,7 @@ var dracones = dracones || (function() {
                             dataType: 'json',
                             data: {
                                 mid: config.mid,
+                                rev: getKnownRev,
                                 mode: 'zin',
                                 x: boundaries.x,
                                 y: boundaries.y,
@@ -778,6 +878,7 @@ var dracones = dracones || (function() {
                             dataType: 'json',
                             data: {
                                 mid: config.mid,
+                                rev: getKnownRev,
                                 action: config.box_action,
                                 select_mode: config.select_mode,
                                 x: boundaries.x,
@@ -850,7 +951,11 @@ var dracones = dracones || (function() {
                         mvpw: map_vp_width,
                         mvph: map_vp_height,
                         msvp: config.map_size_rel_to_vp,
-                        history_size: config.history_size
+                        history_size: config.history_size,
+                        tiled: config.tiled ? true : false,
+                        img_delivery: config.img_delivery || 'url',
+                        hover_encoding: config.hover_encoding || 'list',
+                        delta_responses: config.delta_responses ? true : false
                     },
                     success: that.handleSuccess,
                     error: that.handleError
@@ -867,7 +972,8 @@ var dracones = dracones || (function() {
                     url: dracones_url + '/dracones_do/fullExtent',
                     dataType: 'json',
                     data: {                        
-                        mid: config.mid
+                        mid: config.mid,
+                        rev: getKnownRev
                     },
                     success: that.handleSuccess,
                     error: that.handleError
@@ -895,21 +1001,42 @@ var dracones = dracones || (function() {
                 if (resp.hasOwnProperty('mid')) {
                     config.mid = resp.mid;
                 }
+
+                // selection: merge a delta response with the previous selection state
+                if (resp.hasOwnProperty('selection')) {
+                    if (!resp.delta) {
+                        current_selection = {};
+                    }
+                    jQuery.each(resp.selection, function(dlayer, sel) {
+                        current_selection[dlayer] = sel;
+                    });
+                    resp.selection = jQuery.extend({}, current_selection);
+                }
+                known_rev = resp.hasOwnProperty('rev') ? resp.rev : null;
                 
                 // map positioning (pan, etc.)
                 pan_dir = null;
                 if (resp.hasOwnProperty('pan_dir')) {
                     pan_dir = resp.pan_dir;
                 }
-                center_viewport = false;
+                center_viewport = center_after_superseded;
                 if (resp.hasOwnProperty('extent')) { // the viewport must be centered only if the extent has changed
                                                      // panning is special though, as it requires it own centering
                     if (!areExtentsEqual(resp.extent, curr_extent) && !resp.hasOwnProperty('pan_dir')) {
                         center_viewport = true;
                     }
                 }
-                var now = new Date().getTime(); // time is added to img.src to prevent caching
-                getAlternateMovingAnchor().map_img.attr('src', resp.map_img_url + '?' + now);
+                center_after_superseded = resp.superseded ? center_viewport : false;
+                if (resp.superseded) {
+                    // intermediate navigation state: no image, the response of a newer request follows
+                } else if (resp.hasOwnProperty('tiles')) {
+                    loadTiles(getAlternateMovingAnchor(), resp.tiles);
+                } else if (resp.map_img_url.indexOf('data:') == 0) {
+                    getAlternateMovingAnchor().map_img.attr('src', resp.map_img_url);
+                } else {
+                    var now = new Date().getTime(); // time is added to img.src to prevent caching
+                    getAlternateMovingAnchor().map_img.attr('src', resp.map_img_url + (resp.map_img_url.indexOf('?') == -1 ? '?' : '&') + now);
+                }
                 
                 if (resp.shift_history_window && config.history_size >= 2) {
 
@@ -957,10 +1084,16 @@ var dracones = dracones || (function() {
                             if (!dlayer_hi.append || typeof hover_maps[history_idx][dlayer] === 'undefined') {
                                 hover_maps[history_idx][dlayer] = [];
                             } 
-                            jQuery.each(dlayer_hi.items, function(i, hi) {
-                                var hi = { gx : parseFloat(hi[0]), gy : parseFloat(hi[1]), html : hi[2]};
-                                hover_maps[history_idx][dlayer].push(hi);
-                            });
+                            if (dlayer_hi.hasOwnProperty('html_table')) { // compact encoding
+                                for (var i = 0; i < dlayer_hi.html.length; i++) {
+                                    hover_maps[history_idx][dlayer].push({ gx : parseFloat(dlayer_hi.gx[i]), gy : parseFloat(dlayer_hi.gy[i]), html : dlayer_hi.html_table[dlayer_hi.html[i]] });
+                                }
+                            } else {
+                                jQuery.each(dlayer_hi.items, function(i, hi) {
+                                    var hi = { gx : parseFloat(hi[0]), gy : parseFloat(hi[1]), html : hi[2]};
+                                    hover_maps[history_idx][dlayer].push(hi);
+                                });
+                            }
                         });
                     }
                 }
@@ -992,7 +1125,8 @@ var dracones = dracones || (function() {
                             var error_msg = 'It seems that the init call has not succeeded. ';
                             error_msg += 'One likely cause of that problem is that the Apache "Alias" directive for the "ms_tmp" directory has not been properly defined.';
                             error_msg += 'When properly set, you should be able to view the static map image that was just created by visiting:<br><br>';
-                            error_msg += '<code><a href="' + resp.map_img_url + '>' + resp.map_img_url + '</a></code>';
+                            var img_url = resp.hasOwnProperty('tiles') ? (resp.tiles.length ? resp.tiles[0].url : '') : resp.map_img_url;
+                            error_msg += '<code><a href="' + img_url + '>' + img_url + '</a></code>';
                             that.handleError({responseText: error_msg});
                         }
                     }, 5000); // wait 5 seconds before triggering the test
@@ -1027,6 +1161,11 @@ var dracones = dracones || (function() {
                         that.init();
                         return;
                     }
+                    if (resp.error == 'session_locked') { // the server gave up waiting for a concurrent request: the map is unchanged
+                        console.error(resp.error_msg);
+                        pan_locked = false;
+                        return;
+                    }
                 }
                 var s = '<h2>Dracones Server Error:</h2>';
                 if (resp.responseText) {
@@ -1086,6 +1225,7 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {
                         mid: config.mid,
+                        rev: getKnownRev,
                         dlayers: args.dlayers.join(',')
                     },
                     success: function(r) {
@@ -1113,6 +1253,7 @@ var dracones = dracones || (function() {
                     args.data = {}
                 }
                 args.data.mid = config.mid;
+                args.data.rev = getKnownRev;
                 if (typeof args.success !== 'function') {
                     args.success = function(r) {
                         that.handleSuccess(r);
@@ -1218,6 +1359,7 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {                        
                         mid: config.mid,
+                        rev: getKnownRev,
                         dir: args.direction
                     },
                     success: function(r) {
@@ -1249,6 +1391,7 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {                        
                         mid: config.mid,
+                        rev: getKnownRev,
                         dlayers: args.dlayers.join(','),
                         what: args.hasOwnProperty('what') ? args.what : 'all'
                     },
@@ -1292,6 +1435,7 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {                        
                         mid: config.mid,
+                        rev: getKnownRev,
                         dlayers_on: dlayers_on.join(','),
                         dlayers_off: dlayers_off.join(',')
                     },
@@ -1358,6 +1502,7 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {                        
                         mid: config.mid,
+                        rev: getKnownRev,
                         dlayer: args.dlayer,
                         features: args.features.join(','),
                         select_mode: args.hasOwnProperty('select_mode') ? args.select_mode : config.select_mode
@@ -1389,13 +1534,57 @@ var dracones = dracones || (function() {
                     dataType: 'json',
                     data: {                        
                         mid: config.mid,
+                        rev: getKnownRev,
                         dlayer: args.dlayer,
                         features: args.features.join(','),
                         visibles: args.visibles.join(',')
                     },
                     success: that.handleSuccess,
-                    error: that.handleError                    
-                });                                
+                    error: that.handleError
+                });
+            };
+
+            /**
+               Applies several operations to the map in a single request (one render, and one history step).
+
+               @param {obj} args An object containing the function parameters as properties.
+               @param {obj[]} args.ops Operations, in order: objects with an "op" property naming the operation ("action", "clearDLayers", "fullExtent",
+                                       "pan", "selectFeatures", "setDLayersStatus", "setFeatureVisibility", "toggleDLayers" or "zoom"), and the
+                                       params of the corresponding server function (lists can be given as arrays).
+               @param {function} [args.callback] Callback triggered at completion (it is passed the JSON response from the server).
+
+               @example
+               mw.batch({ ops: [{ op: 'setDLayersStatus', dlayers_on: ['region'], dlayers_off: [] },
+                                { op: 'clearDLayers', dlayers: ['circle'], what: 'all' },
+                                { op: 'selectFeatures', dlayer: 'region', features: ['12', '14'], select_mode: 'reset' }] });
+             */
+            this.batch = function(args) {
+                var ops = [];
+                for (var i = 0; i < args.ops.length; i++) {
+                    var op = {};
+                    jQuery.each(args.ops[i], function(k, v) {
+                        op[k] = jQuery.isArray(v) ? v.join(',') : v;
+                    });
+                    ops.push(op);
+                }
+                that.loading.show();
+                jQuery.ajaxq(ajaxq_name, {
+                    type: 'GET',
+                    url: dracones_url + '/dracones_do/batch',
+                    dataType: 'json',
+                    data: {
+                        mid: config.mid,
+                        rev: getKnownRev,
+                        ops: JSON.stringify(ops)
+                    },
+                    success: function(r) {
+                        that.handleSuccess(r);
+                        if (args.hasOwnProperty('callback') && typeof args.callback === 'function') {
+                            args.callback(r);
+                        }
+                    },
+                    error: that.handleError
+                });
             };
 
             // If delayed init is not set, trigger init.
@@ -0,0 +1,110 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Generic in-process cache, used for the rendered images.
+"""
+
+import time, threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded LRU cache, with an optional time-to-live for its
+    entries. The size of an entry is given by the sizeof function (len by
+    default, which is the byte size of the cached image strings).
+    """
+
+    def __init__(self, max_bytes, ttl = 0, sizeof = len):
+        """
+        LRUCache constructor.
+
+        @type max_bytes: int
+        @param max_bytes: Size budget: the least recently used entries are evicted when it is exceeded
+                          (0 disables the cache: nothing gets stored).
+        @type ttl: float
+        @param ttl: Time-to-live of the entries, in seconds (0 means no expiration).
+        @type sizeof: function
+        @param sizeof: Returns the size of a value.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict() # key -> (value, size, expiration time), least recently used first
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+        """
+        @return: The cached value (which becomes the most recently used), or default if absent or expired.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[2] and entry[2] < time.time()):
+                if entry is not None:
+                    self.n_bytes -= entry[1]
+                self.n_misses += 1
+                return default
+            self.entries[key] = entry
+            self.n_hits += 1
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """
+        Stores a value (values bigger than the whole budget are not stored).
+        """
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.n_bytes -= old_entry[1]
+            self.entries[key] = (value, size, (time.time() + self.ttl) if self.ttl else 0)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                evicted_key, evicted_entry = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_entry[1]
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        """
+        Removes an entry, if present.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.n_bytes -= entry[1]
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            return entry is not None and not (entry[2] and entry[2] < time.time())
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getStats(self):
+        """
+        @return: {entries:.., bytes:.., max_bytes:.., hits:.., misses:..}
+        """
+        return { 'entries' : len(self.entries), 'bytes' : self.n_bytes, 'max_bytes' : self.max_bytes,
+                 'hits' : self.n_hits, 'misses' : self.n_misses }
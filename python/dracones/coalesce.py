@@ -0,0 +1,43 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Coalescing of the navigation (pan/zoom) requests of a map widget. During fast
+mouse wheel zooming, the client sends a burst of zoom requests for the same
+mid, of which the user only sees the last state. A request that is known to be
+superseded by a newer one of the same widget skips the rendering of its image,
+and gets a lightweight "superseded" reply. As the client queue serializes the
+requests of a widget, a newer navigation request never reaches the server while
+an older one is being processed: only the client knows that a request is
+superseded, and it reports it with the "nav_pending" request param (set when
+more navigation requests of the widget are queued behind it).
+
+Every request of a burst still applies its own extent change, but the burst is
+folded into a single history step: only its first request shifts the history
+window, and the following ones (the requests sent while the previous one
+reported pending requests, which endDracones records in the session) replace
+the state of that step, so that a single undo goes back to the extent that
+preceded the burst.
+"""
+
+
+def isSuperseded(params):
+    """
+    @param params: Params of a navigation request (req.form).
+    @return: Whether the client has more navigation requests of the same widget queued behind it.
+    """
+    return params.get('nav_pending', 'false').lower() == 'true'
+
+
+def continuesBurst(dmap):
+    """
+    @type dmap: DMap
+    @param dmap: The dmap of a navigation request.
+    @return: Whether the request follows a superseded navigation request (in which case it must
+             not shift the history window, see endDracones).
+    """
+    return dmap.sess_mid.get('nav_burst', False)
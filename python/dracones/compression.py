@@ -0,0 +1,99 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Gzip compression of the textual (JSON) responses of the web interface, for the
+clients that accept it. The responses with large hover item or selection lists
+compress very well, whereas the images are already compressed, and are left
+alone. It is controlled by the "gzip_responses" (on by default), "gzip_min_size"
+(in bytes) and "gzip_level" options of conf.json.
+"""
+
+import zlib
+
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript')
+
+
+def acceptsGzip(accept_encoding):
+    """
+    @type accept_encoding: str
+    @param accept_encoding: Value of the Accept-Encoding request header.
+    @return: Whether it accepts the gzip encoding, with a non-zero q-value (explicitly, or through "*").
+    """
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            param = param.strip().lower()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qvalues[name] = q
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qvalues:
+            return qvalues[name] > 0
+    return False
+
+
+def gzip_middleware(min_size = 1024, level = 6):
+    """
+    WSGI middleware factory (used like the Pesto ones: gzip_middleware(..)(app)). The
+    responses of a compressible type all get a "Vary: Accept-Encoding" header, whether
+    they are compressed or not, so that a cache never serves one version in place of
+    the other.
+
+    @type min_size: int
+    @param min_size: Responses smaller than this (in bytes) are not compressed.
+    @type level: int
+    @param level: zlib compression level (1-9).
+    @return: A function wrapping a WSGI application.
+    """
+
+    def middleware(app):
+
+        def gzip_app(environ, start_response):
+            response = {}
+            body = []
+            def capture_start_response(status, headers, exc_info = None):
+                response['status'] = status
+                response['headers'] = headers
+                response['exc_info'] = exc_info
+                return body.append
+            result = app(environ, capture_start_response)
+            try:
+                body.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            body = b''.join(body)
+            headers = response['headers']
+            header_names = dict([(name.lower(), value) for name, value in headers])
+            content_type = header_names.get('content-type', '')
+            if [t for t in COMPRESSIBLE_TYPES if content_type.startswith(t)]:
+                if (len(body) >= min_size and 'content-encoding' not in header_names and
+                    acceptsGzip(environ.get('HTTP_ACCEPT_ENCODING', ''))):
+                    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip container
+                    body = compressor.compress(body) + compressor.flush()
+                    headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+                    headers.extend([('Content-Encoding', 'gzip'), ('Content-Length', str(len(body)))])
+                vary = header_names.get('vary', '')
+                if 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+                    headers = [(name, value) for name, value in headers if name.lower() != 'vary']
+                    headers.append(('Vary', '%s, Accept-Encoding' % vary if vary else 'Accept-Encoding'))
+            start_response(response['status'], headers, response['exc_info'])
+            return [body]
+
+        return gzip_app
+
+    return middleware
@@ -9,8 +9,26 @@
 Main Dracones components and logic.
 """
 
-import sys, re, os, copy, time, datetime, os.path, copy
+import sys, re, os, copy, time, datetime, os.path, copy, threading, hashlib, math, base64, uuid
 from dracones.conf import *
+from dracones.cache import LRUCache
+from dracones.session_store import replaceFile
+from dracones.image_store import createImageStore
+from dracones.shputils import getShapefileBasePath, getAttributeIndex, getSubsetShapefile, getFeatureShapefile
+from dracones.shputils import SHPT_POINT, SHPT_ARC, SHPT_POLYGON
+from dracones.selection import OrderedSet, encodeIDs, decodeIDs
+from dracones.spatial import GridIndex
+from dracones.features import FeatureColumns
+
+
+_map_templates = {} # (app, map) -> {mtime:.., map_obj:..}
+_map_templates_lock = threading.Lock()
+
+render_cache = LRUCache(dconf.get('render_cache_max_bytes', 0), dconf.get('render_cache_ttl', 0))
+"""Per-process cache of the rendered images (state hash -> image bytes), see DMap.renderImage."""
+
+image_store = createImageStore(dconf)
+"""Storage of the map images fetched by the browser, see dracones.image_store."""
 
 
 def pix2geo(m, px, py):
@@ -73,6 +91,101 @@ def rectObjToDict(r):
     return { 'minx' : r.minx, 'miny' : r.miny, 'maxx' : r.maxx, 'maxy' : r.maxy }
     
 
+def getMapTemplate(app, map_name, map_file):
+    """
+    Returns the parsed mapfile template for a given app/map pair. Parsing
+    a mapfile is an important fixed cost, so the parsed mapscript.mapObj is
+    kept in a per-process cache, and a DMap only has to clone it. The cache
+    entry is replaced whenever the mapfile modification time changes.
+
+    @type app: str
+    @param app: Name of the application.
+    @type map_name: str
+    @param map_name: Name of the map (mapfile name, without the .map extension).
+    @type map_file: str
+    @param map_file: Absolute path of the mapfile.
+    @return: The cache entry, a dict: {mtime:float, map_obj:mapscript.mapObj}, updated with
+             the layer metadata returned by prepareMapTemplate.
+    """
+    mtime = os.path.getmtime(map_file)
+    key = (app, map_name)
+    _map_templates_lock.acquire()
+    try:
+        entry = _map_templates.get(key)
+        if entry is None or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'map_obj': mapObj(map_file)}
+            entry.update(prepareMapTemplate(entry['map_obj'], app))
+            _map_templates[key] = entry
+        return entry
+    finally:
+        _map_templates_lock.release()
+
+
+def inspectLayer(ms_layer):
+    """
+    Computes the DLayer metadata of a MS layer, which only depends on the mapfile:
+    DLayer subclass, shapefile detection, select item, filtering and group.
+
+    @type ms_layer: mapscript.layerObj
+    @param ms_layer: The inspected MS layer.
+    @return: {cls:.., is_shapefile:.., select_item:.., is_filtered:.., group:.., status:..}
+    """
+    layer_classes = { MS_LAYER_POINT : PointDLayer, MS_LAYER_POLYGON : PolygonDLayer,
+                      MS_LAYER_CIRCLE : CircleDLayer, MS_LAYER_LINE : LineDLayer }
+    is_filtered = (ms_layer.filteritem is not None)
+    is_shapefile = False
+    if ms_layer.data:
+        # search from SQL pattern '* from *...'
+        is_shapefile = not re.match('.* *from *.*', ms_layer.data, re.IGNORECASE)
+    return { 'cls' : layer_classes.get(ms_layer.type, DLayer),
+             'is_shapefile' : is_shapefile,
+             'select_item' : ms_layer.filteritem if is_filtered else ms_layer.classitem,
+             'is_filtered' : is_filtered,
+             'group' : ms_layer.group,
+             'status' : ms_layer.status }
+
+
+def prepareMapTemplate(map_obj, app):
+    """
+    Applies the Dracones mapfile overrides to a freshly parsed map (PostGIS connection
+    string), and collects the metadata of all its layers, so that it is computed once
+    per mapfile rather than once per request.
+
+    @type map_obj: mapscript.mapObj
+    @param map_obj: The parsed map.
+    @type app: str
+    @param app: Name of the application.
+    @return: {layer_names: [names..], layers: {name: metadata}, groups: {group: [names..]}}
+    """
+    layer_names = []
+    layers = {}
+    groups = {}
+    for i in range(map_obj.numlayers):
+        ms_layer = map_obj.getLayer(i)
+        # PostGIS connection string override mechanism
+        if ms_layer.connectiontype == MS_POSTGIS and not ms_layer.connection:
+            if dconf[app].get('map', {}).get('postgis_connection', None):
+                ms_layer.connection = dconf[app]['map']['postgis_connection']
+        meta = inspectLayer(ms_layer)
+        layer_names.append(ms_layer.name)
+        layers[ms_layer.name] = meta
+        if meta['group']:
+            groups.setdefault(meta['group'], []).append(ms_layer.name)
+    return { 'layer_names' : layer_names, 'layers' : layers, 'groups' : groups }
+
+
+def newDLayerState(status):
+    """
+    Creates the session state of a dlayer that has not been modified since the map
+    was loaded.
+
+    @type status: mapscript.MS_ON | mapscript.MS_OFF
+    @param status: On/off status of the dlayer.
+    @return: {filtered:.., selected:.., sel_rev:.., features:.., features_rev:.., status:..}
+    """
+    return { 'filtered' : [], 'selected' : [], 'sel_rev' : None, 'features' : {}, 'features_rev' : None, 'status' : status }
+
+
 def newHistoryCell():
     """
     Creates an HistoryCell to store in the session variable.
@@ -94,17 +207,156 @@ def createDLayerInstance(name, dmap):
     @return: An instance of a subclassed DLayer, according to the MS type of the layer.
     """
     assert dmap.getLayerByName(name), "Layer '%s' does not exist" % name
-    layer_type = dmap.getLayerByName(name).type
-    if layer_type == MS_LAYER_POINT:
-        return PointDLayer(name, dmap)
-    elif layer_type == MS_LAYER_POLYGON:
-        return PolygonDLayer(name, dmap)
-    elif layer_type == MS_LAYER_CIRCLE:
-        return CircleDLayer(name, dmap)
-    elif layer_type == MS_LAYER_LINE:
-        return LineDLayer(name, dmap)
-    else:
-        return DLayer(name, dmap)
+    return dmap.getLayerMeta(name)['cls'](name, dmap)
+
+
+class DLayerDict(dict):
+    """
+    Lazy 'dlayer_name' -> DLayer mapping, used by DMap. A DLayer is only created
+    (and its state restored from the session) the first time it is accessed by
+    name: membership tests, len() and iteration over the names never trigger it.
+    """
+
+    def __init__(self, dmap, names):
+        """
+        DLayerDict constructor.
+
+        @type dmap: DMap
+        @param dmap: The DMap containing the layers.
+        @type names: list
+        @param names: Names of all the map layers, in mapfile order.
+        """
+        dict.__init__(self)
+        self.dmap = dmap
+        self.names = names
+        self.name_set = set(names)
+
+    def __missing__(self, name):
+        if name not in self.name_set:
+            raise KeyError(name)
+        return self.dmap.materializeDLayer(name)
+
+    def __contains__(self, name):
+        return name in self.name_set
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name, default = None):
+        if name in self.name_set:
+            return self[name]
+        return default
+
+    def keys(self):
+        return list(self.names)
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+    def values(self):
+        return [self[name] for name in self.names]
+
+    def isMaterialized(self, name):
+        """
+        @return: Whether the DLayer has already been created or not.
+        """
+        return dict.__contains__(self, name)
+
+    def materialized(self):
+        """
+        @return: List of (name, DLayer) pairs, for the already created DLayers only.
+        """
+        return [(name, dict.__getitem__(self, name)) for name in self.names if dict.__contains__(self, name)]
+
+
+class ResultExtractor(object):
+    """
+    Extraction of the select_item value, hover coordinates and hover HTML of the
+    results of a query. The positions of the needed items are resolved once per
+    query (rather than by comparing every item name, for every result), and only
+    their values are read.
+    """
+
+    def __init__(self, items, select_item, hover_item_html_template = ""):
+        """
+        ResultExtractor constructor.
+
+        @type items: list
+        @param items: Item (attribute) names of the queried layer, in shape value order.
+        @type select_item: str
+        @param select_item: Name of the key item.
+        @type hover_item_html_template: str
+        @param hover_item_html_template: Hover HTML template (see DLayer.queryByAttributes).
+        """
+        positions = dict([(item.lower(), i) for i, item in reversed(list(enumerate(items)))])
+        self.key_position = positions.get(select_item.lower()) if select_item else None
+        self.template = hover_item_html_template
+        self.template_positions = {} # template field (lower case) -> item position (None if missing)
+        self.template_re = None
+        if hover_item_html_template:
+            for field in re.findall('{(\w+)}', hover_item_html_template):
+                self.template_positions[field.lower()] = positions.get(field.lower())
+            self.template_re = re.compile('{(\w+)}')
+
+    def getKeyValue(self, get_value):
+        """
+        @type get_value: function
+        @param get_value: Returns the value of the item at a given position (e.g. shapeObj.getValue).
+        @return: The select_item value, or None if the layer has no such item.
+        """
+        if self.key_position is None:
+            return None
+        return get_value(self.key_position)
+
+    def getHoverHTML(self, get_value):
+        """
+        Substitutes the template fields in a single pass (missing fields are replaced by '?').
+
+        @type get_value: function
+        @param get_value: Returns the value of the item at a given position (e.g. shapeObj.getValue).
+        @return: The hover HTML string.
+        """
+        if not self.template_re:
+            return self.template
+        def substitute(m):
+            if m.group(1).lower() not in self.template_positions:
+                return m.group(0)
+            position = self.template_positions[m.group(1).lower()]
+            return "?" if position is None else get_value(position)
+        return self.template_re.sub(substitute, self.template)
+
+    def getHoverPoint(self, shp):
+        """
+        Hover location of a result, read from its geometry: the point itself for a point
+        shape, the centroid of the outer ring for a polygon, and the center of the bounding
+        box otherwise.
+
+        @type shp: mapscript.shapeObj
+        @param shp: Result shape.
+        @return: (gx, gy) pair of strings, or (None, None) for an empty shape.
+        """
+        if not shp.numlines or not shp.get(0).numpoints:
+            return (None, None)
+        line = shp.get(0)
+        if shp.type == MS_SHAPE_POINT:
+            p = line.get(0)
+            return (repr(p.x), repr(p.y))
+        if shp.type == MS_SHAPE_POLYGON and line.numpoints >= 3:
+            area, cx, cy = 0.0, 0.0, 0.0
+            p0 = line.get(line.numpoints - 1)
+            for i in range(line.numpoints):
+                p1 = line.get(i)
+                cross = p0.x * p1.y - p1.x * p0.y
+                area += cross
+                cx += (p0.x + p1.x) * cross
+                cy += (p0.y + p1.y) * cross
+                p0 = p1
+            if area:
+                return (repr(cx / (3 * area)), repr(cy / (3 * area)))
+        return (repr((shp.bounds.minx + shp.bounds.maxx) / 2), repr((shp.bounds.miny + shp.bounds.maxy) / 2))
 
 
 class DLayer(object):
@@ -112,6 +364,9 @@ class DLayer(object):
     Dracones encapsulation of a MS layer object.
     """
 
+    feature_kind = None #: Kind of the features, if they are stored by columns (see dracones.features).
+    snapshot_shape_type = None #: Shapefile type of the compiled features (see updateFeatureSnapshot), if supported.
+
     def __init__(self, name, dmap):
         """
         DLayer constructor.
@@ -124,29 +379,33 @@ class DLayer(object):
         self.name = name
         self.dmap = dmap
         self.ms_layer = dmap.getLayerByName(name) #: Pointer to the underlying MS mapscript.layerObj (via the DMap's central tile, see DMap doc).
-        self.selected = [] #: List of currently selected items/features.
-        self.is_filtered = (self.ms_layer.filteritem is not None) #: Whether the underlying MS layer contains a filteritem directive or not.
+        meta = dmap.getLayerMeta(name)
+        self.selected = OrderedSet() #: Currently selected items/features.
+        self.is_filtered = meta['is_filtered'] #: Whether the underlying MS layer contains a filteritem directive or not.
         self.filtered = [] #: List of currently filtered items/features.
-        self.features = {} #: dict: id -> {feature attributes..}.
+        self.features = self.newFeatures() #: id -> {feature attributes..} (dict, or FeatureColumns).
         self.hover_items = [] #: List of (gx, gy, html) triplets.
         self.hover_items_are_dirty = False
         self.hover_items_in_append_mode = False
-        self.group = self.ms_layer.group 
+        self.group = meta['group']
         self.shape_index = 0
-        self.is_shapefile = False #: Shapefile or PostGIS source.
-        if self.ms_layer.data:
-            # search from SQL pattern '* from *...'
-            self.is_shapefile = not re.match('.* *from *.*', self.ms_layer.data, re.IGNORECASE)
-        self.select_item = None #: Corresponds to a MS filter or class item (must be set for the layer to be queryable).
-        if self.is_filtered:
-            self.select_item = self.ms_layer.filteritem
-        else:
-            self.select_item = self.ms_layer.classitem
-
-        # PostGIS connection string override mechanism
-        if self.ms_layer.connectiontype == MS_POSTGIS and not self.ms_layer.connection:
-            if dconf[dmap.app_name].get('map', {}).get('postgis_connection', None):
-                self.ms_layer.connection = dconf[dmap.app_name]['map']['postgis_connection']
+        self.is_shapefile = meta['is_shapefile'] #: Shapefile or PostGIS source.
+        self.select_item = meta['select_item'] #: Corresponds to a MS filter or class item (must be set for the layer to be queryable).
+        self.source_data = self.ms_layer.data #: The mapfile DATA (which is replaced by a subset shapefile when filtering, see setFilter).
+        self.shapefile = getShapefileBasePath(dmap, self.ms_layer) if self.is_shapefile else None #: Source shapefile path (without extension), if any.
+        self.selection_overlay = None #: MS layer drawing the selected items (see updateSelectionOverlay).
+        self.selection_overlay_key = None
+        self.unselected_data = None # subset shapefile of the unselected items, read by the MS layer when the overlay is on
+        self.unselected_filter = None # filter of the unselected items (PostGIS), set on the MS layer when the overlay is on
+        self.filter_indices = None # shape indices of the subset shapefile read by the MS layer (see setFilter), if any
+        self.filter_data = self.source_data # DATA set by setFilter
+        self.filter_expr = self.getMapfileFilter() # MS filter set by setFilter
+        self.spatial_index = None #: GridIndex of the visible features (built on demand, see getSpatialIndex).
+        self.is_inline = (self.ms_layer.connectiontype == MS_INLINE) #: Whether the MS layer is made of inline features only.
+        self.features_rev = None #: Revision of the features (see getFeaturesRevision).
+        self.features_rev_features = None # copy of the features that features_rev identifies
+        self.feature_snapshot = None #: Compiled features shapefile (without extension) read by the MS layer (see updateFeatureSnapshot).
+        self.feature_positions = {} # feature id -> shape index in feature_snapshot
 
                         
     def queryByAttributes(self, attr, value, hover_item_html_template = ""):
@@ -187,59 +446,115 @@ class DLayer(object):
                 value_expr = "%s = '%s'" % (attr, value)
         filtered = []
         hover_items = []
-        hover_item_html_tmpl_fields = []
-        if hover_item_html_template:
-            hover_item_html_tmpl_fields = re.findall('{(\w+)}', hover_item_html_template)
-        hover_item_html_tmpl_fields = [f.lower() for f in hover_item_html_tmpl_fields]
-        succ = self.ms_layer.queryByAttributes(self.dmap, attr, value_expr, MS_MULTIPLE)
-        if succ == MS_SUCCESS:
-            self.ms_layer.open()
-            n_res = self.ms_layer.getNumResults()
-            for i in range(n_res):
-                res = self.ms_layer.getResult(i)
-                if msGetVersionInt() >= 50600:
-                    shp = shapeObj(MS_SHAPE_NULL)
-                    self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
-                else:
-                    shp = self.ms_layer.getFeature(res.shapeindex)
-                wkt = shp.toWKT()
+        results = None
+        if self.is_shapefile and value:
+            results = self.queryShapefileIndex(attr, value if isinstance(value, list) else [value])
+        if results is None:
+            results = self.queryLayer(attr, value_expr, MS_MULTIPLE)
+        items, shapes = results
+        extractor = ResultExtractor(items, self.select_item, hover_item_html_template)
+        for shp, get_value in shapes:
+            key_val = extractor.getKeyValue(get_value)
+            if key_val:
+                gx, gy = extractor.getHoverPoint(shp)
+                filtered.append(key_val)
+                hover_items.append({ 'gx' : gx, 'gy' : gy, 'html' : extractor.getHoverHTML(get_value) })
 
-                hover_item = { 'gx':None, 'gy':None, 'html':None}
-                hover_item_map = {}
-
-                m = re.match('POINT *[(](.*) (.*)[)]', wkt)
-                if m:
-                    hover_item['gx'] = m.group(1)
-                    hover_item['gy'] = m.group(2)
-
-                # there's no item map so no other choice than searching for the required fields
+        if self.is_filtered:
+            self.setFilter(filtered)
+        self.setHoverItems(hover_items)
 
-                key_val = None
 
-                for i in range(shp.numvalues):
+    def queryLayer(self, attr, value_expr, mode):
+        """
+        Performs mapscript.queryByAttributes on the underlying MS layer.
 
-                    # collect key_val
-                    if self.ms_layer.getItem(i).lower() == self.select_item.lower():
-                        key_val = shp.getValue(i)
+        @type attr: str
+        @param attr: The name of the queried attribute.
+        @type value_expr: str
+        @param value_expr: MS query expression.
+        @type mode: MS_SINGLE | MS_MULTIPLE
+        @param mode: MS query mode.
+        @return: (item names, [(shapeObj, get_value)..]) pair, where get_value returns the value of an item, by position.
+        """
+        # an attribute query ignores the filter, so it must not be restricted to the filtered subset (see setFilter)
+        data = self.ms_layer.data
+        if data != self.source_data:
+            self.ms_layer.data = self.source_data
+        try:
+            if self.ms_layer.queryByAttributes(self.dmap, attr, value_expr, mode) != MS_SUCCESS:
+                return ([], [])
+            items, shapes = self.getQueryResults()
+        finally:
+            if data != self.source_data:
+                self.ms_layer.data = data
+        return (items, [(shp, shp.getValue) for shp in shapes])
+
+
+    def getQueryResults(self, max_results = None):
+        """
+        Fetches the shapes resulting from the last (successful) MS query on the layer.
+
+        @type max_results: int
+        @param max_results: Max number of results to fetch (all by default).
+        @return: (item names, [shapeObj..]) pair.
+        """
+        items = []
+        shapes = []
+        self.ms_layer.open() # useless with new query mechanism
+        n_res = self.ms_layer.getNumResults()
+        if max_results is not None:
+            n_res = min(n_res, max_results)
+        for i in range(n_res):
+            res = self.ms_layer.getResult(i)
+            if msGetVersionInt() >= 50600:
+                shp = shapeObj(MS_SHAPE_NULL)
+                self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
+            else:
+                shp = self.ms_layer.getFeature(res.shapeindex)
+            if not items:
+                items = [self.ms_layer.getItem(j) for j in range(shp.numvalues)]
+            shapes.append(shp)
+        self.ms_layer.close() # useless with new query mechanism
+        return (items, shapes)
 
-                    # collect hover values for corresponding fields
-                    if self.ms_layer.getItem(i).lower() in hover_item_html_tmpl_fields:
-                        hover_item_map[self.ms_layer.getItem(i).lower()] = shp.getValue(i)
-                        
-                if key_val:
 
-                    hover_item_html = hover_item_html_template
-                    for f in hover_item_html_tmpl_fields:
-                        hover_item_html = hover_item_html.replace('{%s}' % f, hover_item_map.get(f, "?"))
-                    hover_item['html'] = hover_item_html
+    def queryShapefileIndex(self, attr, values, single = False):
+        """
+        Equivalent of queryLayer for the shapefile layers, for equality/value list queries:
+        the matching shapes are found through an attribute index (see dracones.shputils),
+        and only them are read, instead of a regex match on every DBF record. As with
+        the MS query, the shapes outside of the map extent are discarded.
 
-                    filtered.append(key_val)
-                    hover_items.append(hover_item)
-                        
-            self.ms_layer.close()
-        if self.is_filtered:
-            self.setFilter(filtered)
-        self.setHoverItems(hover_items)
+        @type attr: str
+        @param attr: The name of the queried attribute.
+        @type values: list
+        @param values: The queried values (strings).
+        @type single: bool
+        @param single: If True, only the first matching shape is returned.
+        @return: (item names, [(shapeObj, get_value)..]) pair (see queryLayer), or None if the index cannot
+                 be used (tile index layer, missing attribute, etc.).
+        """
+        if self.shapefile is None:
+            return None
+        index = getAttributeIndex(self.shapefile, attr)
+        if index is None:
+            return None
+        rect = rectObj(self.dmap.extent.minx, self.dmap.extent.miny, self.dmap.extent.maxx, self.dmap.extent.maxy)
+        if self.ms_layer.getProjection() and self.ms_layer.getProjection() != self.dmap.getProjection():
+            rect.project(projectionObj(self.dmap.getProjection()), projectionObj(self.ms_layer.getProjection()))
+        shapes = []
+        sf = shapefileObj(self.shapefile, -1)
+        for i in index.lookup(values):
+            shp = sf.getShape(i)
+            if shp.bounds.minx > rect.maxx or shp.bounds.maxx < rect.minx or \
+               shp.bounds.miny > rect.maxy or shp.bounds.maxy < rect.miny:
+                continue
+            shapes.append((i, shp))
+            if single:
+                break
+        records = index.dbf.getRecords([i for i, shp in shapes])
+        return (index.dbf.getFieldNames(), [(shp, records[j].__getitem__) for j, (i, shp) in enumerate(shapes)])
 
 
     def getRecordAttributes(self, attr, value):
@@ -253,23 +568,21 @@ class DLayer(object):
         @return: An attribute:value dict.
         """
         if not self.select_item: assert False, 'select_item (classitem or filteritem) must be set for a queryByAttributes'
+        results = None
         if self.is_shapefile:
             value_expr = "/^%s$/" % value
+            if str(value):
+                results = self.queryShapefileIndex(attr, [str(value)], single=True)
         else: 
             value_expr = "%s = '%s'" % (attr, value)
+        if results is None:
+            results = self.queryLayer(attr, value_expr, MS_SINGLE)
         attributes = {}
-        succ = self.ms_layer.queryByAttributes(self.dmap, attr, value_expr, MS_SINGLE)
-        if succ == MS_SUCCESS:
-            self.ms_layer.open()
-            res = self.ms_layer.getResult(0)
-            if msGetVersionInt() >= 50600:
-                shp = shapeObj(MS_SHAPE_NULL)
-                self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
-            else:
-                shp = self.ms_layer.getFeature(res.shapeindex)
-            for i in range(shp.numvalues):
-                attributes[self.ms_layer.getItem(i)] = shp.getValue(i)
-            self.ms_layer.close()
+        items, shapes = results
+        if shapes:
+            shp, get_value = shapes[0]
+            for i in range(len(items)):
+                attributes[items[i]] = get_value(i)
         return attributes
 
 
@@ -281,17 +594,19 @@ class DLayer(object):
         @param already_filtered: List of filtered item IDs.
         @type already_selected: list
         @param already_selected: List of selected item IDs.
-        @type existing_features: dict: id -> {feature attributes..}
-        @param existing_features: Dict of feature attributes (identified by id).
+        @type existing_features: dict or FeatureColumns: id -> {feature attributes..}
+        @param existing_features: Feature attributes (identified by id).
         @type status: mapscript.MS_ON | mapscript.MS_OFF
         @param status: On/off status of the DLayer.
         """
         if self.is_filtered:
             self.setFilter(already_filtered)
         self.setExpression(already_selected)
-        self.selected = already_selected
         self.filtered = already_filtered
+        if self.feature_kind and not isinstance(existing_features, FeatureColumns):
+            existing_features = FeatureColumns(self.feature_kind, existing_features) # state saved as a dict
         self.features = existing_features
+        self.spatial_index = None
         self.setStatus(status)
         
 
@@ -315,54 +630,26 @@ class DLayer(object):
 
             succ = self.ms_layer.queryByPoint(self.dmap, p, MS_SINGLE, -1)
             if select_mode == 'reset':
-                elements = []
+                elements = OrderedSet()
             else:
-                elements = self.selected[:]
+                elements = OrderedSet(self.selected)
             if succ == MS_SUCCESS:
-                res = self.ms_layer.getResult(0)
-                self.ms_layer.open() # useless with new query mechanism
-                if msGetVersionInt() >= 50600:
-                    shp = shapeObj(MS_SHAPE_NULL)
-                    self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
-                else:
-                    shp = self.ms_layer.getFeature(res.shapeindex)   
-                for i in range(shp.numvalues):
-                    if self.ms_layer.getItem(i).lower() == self.select_item.lower():
-                        val = shp.getValue(i)
-                        if select_mode in ['reset', 'add']:
-                            elements.append(val)
-                        elif select_mode == 'toggle':
-                            if val in elements:
-                                elements.remove(val)
-                            else:
-                                elements.append(val)
-                        break
-                self.ms_layer.close() # useless with new query mechanism
+                items, shapes = self.getQueryResults(1)
+                extractor = ResultExtractor(items, self.select_item)
+                for shp in shapes:
+                    val = extractor.getKeyValue(shp.getValue)
+                    if val is None:
+                        continue
+                    if select_mode in ['reset', 'add']:
+                        elements.add(val)
+                    elif select_mode == 'toggle':
+                        elements.toggle(val)
             self.setExpression(elements)
 
         elif self.features:
 
-            succ = self.ms_layer.queryByPoint(self.dmap, p, MS_SINGLE, -1)
-            if succ == MS_SUCCESS:
-                res = self.ms_layer.getResult(0)
-                self.ms_layer.open() # useless with new query mechanism
-                if msGetVersionInt() >= 50600:
-                    shp = shapeObj(MS_SHAPE_NULL)
-                    self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
-                else:
-                    shp = self.ms_layer.getFeature(res.shapeindex)
-                ssi = str(res.shapeindex) # string shapeindex
-                if select_mode in ['reset', 'add']:
-                    self.selected.append(ssi)
-                elif select_mode == 'toggle':
-                    if ssi in self.selected:
-                        self.selected.remove(ssi)
-                        shp.classindex = 0
-                    else:
-                        self.selected.append(ssi)                        
-                        shp.classindex = 1
-                self.ms_layer.addFeature(shp)
-                self.ms_layer.close() # useless with new query mechanism
+            # single (nearest) feature, as with a MS_SINGLE query
+            self.selectFeatureHits(self.getSpatialIndex().queryPoint(p.x, p.y, self.getQueryTolerance())[:1], select_mode)
             
 
     def boxSelect(self, g1, g2, g3, g4, select_mode):
@@ -394,83 +681,225 @@ class DLayer(object):
 
             succ = self.ms_layer.queryByRect(self.dmap, rect)
             if select_mode == 'reset':
-                elements = []
+                elements = OrderedSet()
             else:
-                elements = self.selected[:]
+                elements = OrderedSet(self.selected)
             if succ == MS_SUCCESS:
-               self.ms_layer.open() # useless with new query mechanism
-               n_res = self.ms_layer.getNumResults()
-               for i in range(n_res):
-                   res = self.ms_layer.getResult(i)
-                   if msGetVersionInt() >= 50600:
-                       shp = shapeObj(MS_SHAPE_NULL)
-                       self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
-                   else:
-                       shp = self.ms_layer.getFeature(res.shapeindex)                     
-                   for j in range(shp.numvalues):
-                       if self.ms_layer.getItem(j).lower() == self.select_item.lower():
-                           val = shp.getValue(j)
-                           if select_mode in ['reset', 'add']:
-                               elements.append(val)
-                           elif select_mode == 'toggle':
-                               if val in elements:
-                                   elements.remove(val)
-                               else:
-                                   elements.append(val)
-                           break
-               self.ms_layer.close() # useless with new query mechanism
+                items, shapes = self.getQueryResults()
+                extractor = ResultExtractor(items, self.select_item)
+                for shp in shapes:
+                    val = extractor.getKeyValue(shp.getValue)
+                    if val is None:
+                        continue
+                    if select_mode in ['reset', 'add']:
+                        elements.add(val)
+                    elif select_mode == 'toggle':
+                        elements.toggle(val)
             self.setExpression(elements)
 
         elif self.features:
 
-            succ = self.ms_layer.queryByRect(self.dmap, rect)
-            if succ == MS_SUCCESS:
-                self.ms_layer.open() # useless with new query mechanism
-                n_res = self.ms_layer.getNumResults()
-                for j in range(n_res):
-                    res = self.ms_layer.getResult(j)
-                    if msGetVersionInt() >= 50600:
-                        shp = shapeObj(MS_SHAPE_NULL)
-                        self.ms_layer.resultsGetShape(shp, res.shapeindex, res.tileindex)
-                    else:
-                        shp = self.ms_layer.getFeature(res.shapeindex)                     
-                    ssi = str(res.shapeindex) # string shapeindex
-                    if select_mode in ['reset', 'add']:
-                        self.selected.append(ssi)
-                        shp.classindex = 1
-                    elif select_mode == 'toggle':
-                        if ssi in self.selected:
-                            self.selected.remove(ssi)
-                            shp.classindex = 0
-                        else:
-                            self.selected.append(ssi)                        
-                            shp.classindex = 1
-                    self.ms_layer.addFeature(shp)
-                self.ms_layer.close() # useless with new query mechanism
+            self.selectFeatureHits(self.getSpatialIndex().queryRect(min(rect.minx, rect.maxx), min(rect.miny, rect.maxy),
+                                                                    max(rect.minx, rect.maxx), max(rect.miny, rect.maxy)), select_mode)
+
+
+    def getSpatialIndex(self):
+        """
+        @return: The spatial index (see dracones.spatial) of the visible features, built on
+                 first use, and rebuilt after the features have changed.
+        """
+        if self.spatial_index is None:
+            self.spatial_index = GridIndex([(fid, geom) for fid, geom in self.getVisibleFeatureGeometries() if geom is not None])
+        return self.spatial_index
+
+
+    def getQueryTolerance(self):
+        """
+        Point query tolerance of the MS layer, in geographic units (MapServer uses a default
+        of 3 pixels for point and line layers, and 0 for polygon layers).
+
+        @return: float
+        """
+        tolerance = self.ms_layer.tolerance
+        if tolerance < 0:
+            tolerance = 0 if self.ms_layer.type == MS_LAYER_POLYGON else 3
+        if self.ms_layer.toleranceunits == MS_PIXELS:
+            tolerance *= (self.dmap.extent.maxx - self.dmap.extent.minx) / float(self.dmap.width)
+        return tolerance
+
+
+    def selectFeatureHits(self, feature_ids, select_mode):
+        """
+        Applies a point/box selection to the features it hit. If the features have already been
+        added to the MS layer, the hit ones are added again on top, with their new class.
+
+        @type feature_ids: list
+        @param feature_ids: IDs of the hit features.
+        @type select_mode: str
+        @param select_mode: "reset", "add" or "toggle" (see pointSelect).
+        """
+        for fid in feature_ids:
+            if select_mode in ['reset', 'add']:
+                self.selected.add(fid)
+            elif select_mode == 'toggle':
+                self.selected.toggle(fid)
+            if self.dmap.features_added and not self.usesFeatureSnapshot():
+                shp = self.createShape(self.features[fid])
+                shp.classindex = 1 if fid in self.selected else 0
+                self.ms_layer.addFeature(shp)
             
 
     # goes with self.selected
     def setExpression(self, elements):
         """
-        If there are at least two classes, this will set an MS expression on the first one, using
-        the supplied element IDs.
+        If there are at least two classes, this will differentiate visually the supplied element
+        IDs: the first class is used for the unselected items, and the following ones for the
+        selected items. When possible, the selected items are drawn by a selection overlay
+        layer, and kept out of the layer itself (see updateSelectionOverlay), so that the first
+        class needs no expression; otherwise, an MS expression excluding the selected items is
+        set on the first class.
 
-        @type elements: list
-        @param elements: List of item IDs to differentiate visually.
-        """
-        if not self.select_item: return
-        expr = " and ".join(["'[%s]' ne '%s'" % (self.select_item, s) for s in elements])
-        if expr: expr = "(%s)" % expr
-        if self.ms_layer.numclasses >= 2:
-            self.ms_layer.getClass(0).setExpression(expr)
-#            self.dmap.getLayerByName(self.name).getClass(0).setExpression(expr)
+        @type elements: list or OrderedSet
+        @param elements: Item IDs to differentiate visually.
+        """
+        if not isinstance(elements, OrderedSet):
+            elements = OrderedSet(elements)
         self.selected = elements
+        if not self.select_item or self.ms_layer.numclasses < 2:
+            return
+        if self.usesSelectionOverlay():
+            expr = ""
+        else:
+            expr = " and ".join(["'[%s]' ne '%s'" % (self.select_item, s) for s in elements])
+            if expr: expr = "(%s)" % expr
+        self.ms_layer.getClass(0).setExpression(expr)
+#        self.dmap.getLayerByName(self.name).getClass(0).setExpression(expr)
+
+
+    def usesSelectionOverlay(self):
+        """
+        The selection overlay is used for the layers having at least two classes, if they are
+        feature layers compiled into a shapefile (see updateFeatureSnapshot), or if they have a
+        select_item and are PostGIS layers, or shapefile layers whose select_item can be indexed
+        (see dracones.shputils). For the latter two, it can be disabled with the selection_overlay
+        option of conf.json (the selection is then drawn with a class expression).
+
+        @return: bool
+        """
+        if self.ms_layer.numclasses < 2:
+            return False
+        if self.feature_snapshot is not None:
+            return True
+        if not self.select_item or not dconf.get('selection_overlay', True):
+            return False
+        if not self.is_shapefile:
+            return self.ms_layer.connectiontype == MS_POSTGIS
+        return self.getSelectItemIndex() is not None
+
+
+    def getSelectItemIndex(self):
+        """
+        @return: The attribute index of the select_item (see dracones.shputils), or None
+                 if the dlayer is not a (single) shapefile layer with a select_item.
+        """
+        if self.shapefile is None or not self.select_item:
+            return None
+        return getAttributeIndex(self.shapefile, self.select_item)
+
+
+    def getMapfileFilter(self):
+        """
+        @return: The FILTER of the MS layer in the mapfile (without its quotes), or an empty string.
+        """
+        expr = self.ms_layer.getFilterString() or ''
+        if len(expr) >= 2 and expr[0] == expr[-1] == '"':
+            expr = expr[1:-1]
+        return expr
+
+
+    def updateSelectionOverlay(self):
+        """
+        Updates the selection overlay layer before a draw (see DMap.draw). The overlay is
+        a copy of the layer without its first class, inserted right after it, and restricted
+        to the selected (and filtered, if applicable) items, while the layer itself is
+        restricted to the other ones, so that every item is drawn once: for a shapefile
+        layer (or compiled features), they read subset shapefiles of the selected and of the
+        unselected shapes, and for a PostGIS layer, they get '<select_item> in (..)' and
+        'not in (..)' filters. The cost of a draw is then independent of the selection size,
+        instead of an expression with one term per selected item being evaluated for every
+        item. The subsets are written once per selection (and filter or features revision).
+        """
+        if not self.usesSelectionOverlay():
+            return
+        selected = self.selected
+        if self.is_filtered:
+            filtered = set([str(x) for x in self.filtered])
+            selected = [s for s in selected if str(s) in filtered]
+        if self.feature_snapshot is not None:
+            selected = [s for s in selected if s in self.feature_positions]
+        key = (tuple(selected), self.getStatus(), self.feature_snapshot, tuple(self.filtered))
+        if key != self.selection_overlay_key:
+            self.selection_overlay_key = key
+            # back to the data and filter of the layer (see setFilter and updateFeatureSnapshot)
+            if self.unselected_data is not None and self.feature_snapshot is None:
+                self.ms_layer.data = self.filter_data
+            if self.unselected_filter is not None:
+                self.ms_layer.setFilter(self.filter_expr)
+            self.unselected_data = None
+            self.unselected_filter = None
+            if self.selection_overlay is None and selected:
+                self.selection_overlay = self.dmap.addSelectionOverlay(self)
+            if self.selection_overlay is not None:
+                self.selection_overlay.status = MS_OFF
+            if selected and self.getStatus() == MS_ON:
+                self.restrictToSelection(self.selection_overlay, selected)
+        if self.unselected_data is not None:
+            self.ms_layer.data = self.unselected_data
+        if self.unselected_filter is not None:
+            self.ms_layer.setFilter(self.unselected_filter)
+
+
+    def restrictToSelection(self, overlay, selected):
+        """
+        Restricts the selection overlay to the selected items, and the layer to the unselected
+        ones (see updateSelectionOverlay).
+
+        @type overlay: mapscript.layerObj
+        @param overlay: The selection overlay.
+        @type selected: list
+        @param selected: The selected items (that are filtered).
+        """
+        cache_path = dconf.get('cache_path', dconf['ms_tmp_path'])
+        if self.feature_snapshot is not None:
+            source = self.feature_snapshot
+            indices = set([self.feature_positions[s] for s in selected])
+            all_indices = range(len(self.feature_positions))
+        elif self.is_shapefile:
+            source = self.shapefile
+            index = self.getSelectItemIndex()
+            indices = set(index.lookup([str(s) for s in selected]))
+            if not indices:
+                return
+            all_indices = self.filter_indices if self.filter_indices is not None else range(index.dbf.n_records)
+        else:
+            items = ",".join(["'%s'" % str(s).replace("'", "''") for s in selected])
+            overlay.setFilter("%s in (%s)" % (self.select_item, items))
+            overlay.status = MS_ON
+            expr = "%s not in (%s)" % (self.select_item, items)
+            self.unselected_filter = "(%s) and %s" % (self.filter_expr, expr) if self.filter_expr else expr
+            return
+        overlay.data = getSubsetShapefile(source, sorted(indices), cache_path)
+        overlay.status = MS_ON
+        self.unselected_data = getSubsetShapefile(source, [i for i in all_indices if i not in indices], cache_path)
 
         
     # goes with self.filtered
     def setFilter(self, elements, append = False):
         """
-        Sets a MS filter on the dlayer.
+        Sets a MS filter on the dlayer. For a shapefile layer whose select_item can be
+        indexed (see dracones.shputils), the filter is not an expression, but a subset
+        shapefile containing only the matching shapes, that the layer reads instead of
+        the whole file: drawing and querying the filtered layer then only touch them.
 
         @type elements: list
         @param elements: List of item IDs.
@@ -479,8 +908,25 @@ class DLayer(object):
         """        
         if elements and append:
             elements.extend(self.filtered)
+        if self.ms_layer.data != self.source_data:
+            self.ms_layer.data = self.source_data
+        self.filter_indices = None
+        self.filter_data = self.source_data
         if elements:
             elements = [str(x) for x in elements]
+            index = self.getSelectItemIndex() if dconf.get('subset_filter', True) else None
+            if index is not None:
+                indices = index.lookup(elements)
+                if indices:
+                    self.ms_layer.data = getSubsetShapefile(self.shapefile, indices, dconf.get('cache_path', dconf['ms_tmp_path']))
+                    self.filter_indices = indices
+                    self.filter_data = self.ms_layer.data
+                    self.filter_expr = ''
+                else:
+                    self.filter_expr = 'null'
+                self.ms_layer.setFilter(self.filter_expr)
+                self.filtered = elements
+                return
             if self.is_shapefile:
                 expr = " or ".join(["'[%s]' eq '%s'" % (self.select_item, s) for s in elements])
             else:
@@ -491,6 +937,7 @@ class DLayer(object):
             expr = "null"
         self.ms_layer.setFilter(expr)
 #        self.dmap.getLayerByName(self.name).setFilter(expr)
+        self.filter_expr = expr
         self.filtered = elements
         
 
@@ -516,15 +963,15 @@ class DLayer(object):
         """
         Removes all dlayer's selected items.
         """
-        del self.selected[:]
-        self.setExpression([])
+        self.setExpression(OrderedSet())
 
 
     def clearFeatures(self):
         """
         Removes all dlayer's features.
         """
-        self.features = {}
+        self.features = self.newFeatures()
+        self.spatial_index = None
 
 
     # "inSession" emphasizes the fact that the session var is modified 
@@ -532,11 +979,33 @@ class DLayer(object):
         """
         Saves the state of the dlayer in the member session variable:
         filtered, selected, features items and the status are saved.
-        """
-        self.dmap.sess_mid['history'][-1]['dlayers'].setdefault(self.name, {})['filtered'] = self.filtered
-        self.dmap.sess_mid['history'][-1]['dlayers'].setdefault(self.name, {})['selected'] = self.selected
-        self.dmap.sess_mid['history'][-1]['dlayers'].setdefault(self.name, {})['features'] = self.features
-        self.dmap.sess_mid['history'][-1]['dlayers'].setdefault(self.name, {})['status'] = self.getStatus()
+        The values that did not change since the state was restored are not
+        copied, but shared with the restored history cell (and the whole entry
+        if nothing changed), so that unchanged data is pickled only once for
+        the whole history. For that reason, session entries must never be
+        modified in place.
+        The selection is identified by a 'sel_rev' token, renewed whenever it changes
+        (see DMap.getSelectionDelta).
+        """
+        prev_state = self.dmap.getDLayerState(self.name)
+        min_size = dconf.get('selection_rle_min_size', 64)
+        state = { 'filtered' : encodeIDs(self.filtered, min_size),
+                  'selected' : encodeIDs(self.selected, min_size),
+                  'features' : self.features,
+                  'features_rev' : self.getFeaturesRevision() if self.features else None,
+                  'status' : self.getStatus() }
+        if state['selected'] == prev_state.get('selected'):
+            state['sel_rev'] = prev_state.get('sel_rev')
+        else:
+            state['sel_rev'] = uuid.uuid4().hex
+        n_shared = 0
+        for k in state:
+            if k in prev_state and prev_state[k] == state[k]:
+                state[k] = prev_state[k]
+                n_shared += 1
+        if n_shared == len(state) and len(prev_state) == len(state):
+            state = prev_state
+        self.dmap.getHistoryCell()['dlayers'][self.name] = state
 
     # accepts both items = { id -> {gx,gy,html}, ... }
     #          and items = [{gx,gy,html}, ...]
@@ -585,11 +1054,143 @@ class DLayer(object):
     # the shape_indexes must start at zero
     def addFeatures(self):
         """
-        Once they are ready, add all the features (user-defined shapes).
+        Once they are ready, add all the features (user-defined shapes). When the layer reads
+        its features from a compiled shapefile (see updateFeatureSnapshot), only the shape index
+        is advanced, as if they had been added.
+        """
+        if self.usesFeatureSnapshot():
+            for fid in self.getVisibleFeatureIds():
+                self.shape_index = self.getNextShapeIndex(fid)
+            return
+        for fid in self.getVisibleFeatureIds():
+            self.addFeature(self.features[fid], fid)
+
+
+    def removeFeatures(self):
+        """
+        Undoes addFeatures, so that the features can be added again once modified. As inline
+        features cannot be removed from an MS layer, the layer is replaced by a copy of its
+        mapfile definition (see DMap.resetLayer), on which the state of the dlayer is set again.
+        """
+        self.shape_index = 0
+        if not self.is_inline or self.usesFeatureSnapshot():
+            return
+        status = self.getStatus()
+        self.ms_layer = self.dmap.resetLayer(self.name)
+        if self.is_filtered:
+            self.setFilter(self.filtered)
+        self.setExpression(self.selected)
+        self.setStatus(status)
+
+
+    def newFeatures(self):
+        """
+        @return: An empty feature container: FeatureColumns if the dlayer has a feature kind, a dict otherwise.
+        """
+        if self.feature_kind:
+            return FeatureColumns(self.feature_kind)
+        return {}
+
+
+    def getVisibleFeatureIds(self):
+        """
+        @return: Sorted ids of the visible features (the order in which they are added).
+        """
+        if isinstance(self.features, FeatureColumns):
+            return self.features.getVisibleIds()
+        return sorted([fid for fid, f in self.features.items() if f.get('is_vis', True)])
+
+
+    def getVisibleFeatureGeometries(self):
+        """
+        @return: [(feature id, geometry tuple or None)..] of the visible features (see getVisibleFeatureIds),
+                 read from the columns when possible.
+        """
+        geometries = []
+        for fid in self.getVisibleFeatureIds():
+            geom = None
+            if isinstance(self.features, FeatureColumns):
+                geom = self.features.getGeometry(fid)
+            if geom is None:
+                geom = self.getFeatureGeometry(self.features[fid])
+            geometries.append((fid, geom))
+        return geometries
+
+
+    def getNextShapeIndex(self, feature_id):
+        """
+        @return: The shape index following the one of an added feature (see addFeature).
+        """
+        return self.shape_index + 1
+
+
+    def usesFeatureSnapshot(self):
         """
-        for fid, f in sorted(self.features.items()):
-            if f.get('is_vis', True):
-                self.addFeature(f, fid)
+        The features of an inline layer are compiled into a shapefile (see updateFeatureSnapshot)
+        if its type supports it, and if it has no select_item (the selected features being drawn
+        by the selection overlay). It can be disabled with the feature_snapshot option of conf.json.
+
+        @return: bool
+        """
+        return (self.snapshot_shape_type is not None and self.is_inline and not self.select_item and
+                dconf.get('feature_snapshot', True) and dconf.get('selection_overlay', True))
+
+
+    def getFeaturesRevision(self):
+        """
+        The features revision identifies the content of the features: it is carried over from
+        the restored history cell as long as the features are the same, and a new (unique) one
+        is generated when they change.
+
+        @return: str
+        """
+        if self.features_rev is None or self.features != self.features_rev_features:
+            state = self.dmap.getDLayerState(self.name)
+            if state.get('features_rev') and self.features == state['features']:
+                self.features_rev = state['features_rev']
+            else:
+                self.features_rev = uuid.uuid4().hex
+            self.features_rev_features = self.features.copy()
+        return self.features_rev
+
+
+    def updateFeatureSnapshot(self):
+        """
+        Before a draw (see DMap.draw), points the MS layer to the compiled shapefile of its
+        visible features (in addFeatures order), instead of the inline features. The shapefile
+        is written once per features revision, so the features are only rebuilt when they
+        change, and the layer is otherwise attached to the existing file.
+        """
+        if not self.usesFeatureSnapshot():
+            return
+        if not self.features:
+            if self.feature_snapshot is not None:
+                self.setConnectionType(MS_INLINE)
+                self.ms_layer.data = ''
+                self.feature_snapshot = None
+                self.feature_positions = {}
+            return
+        def getGeometries():
+            visible = self.getVisibleFeatureGeometries()
+            return ([geom for fid, geom in visible], [fid for fid, geom in visible])
+        self.feature_snapshot = getFeatureShapefile('%s|%s' % (self.getFeaturesRevision(), self.name), self.snapshot_shape_type,
+                                                    getGeometries, dconf.get('cache_path', dconf['ms_tmp_path']))
+        self.feature_positions = dict([(fid, i) for i, fid in enumerate(self.getVisibleFeatureIds())])
+        self.setConnectionType(MS_SHAPEFILE)
+        self.ms_layer.data = self.feature_snapshot
+
+
+    def setConnectionType(self, connectiontype):
+        """
+        @type connectiontype: MS_INLINE | MS_SHAPEFILE
+        @param connectiontype: New connection type of the MS layer.
+        """
+        if self.ms_layer.connectiontype == connectiontype:
+            return
+        if hasattr(self.ms_layer, 'setConnectionType'): # MS >= 5.4
+            self.ms_layer.setConnectionType(connectiontype, '')
+        else:
+            self.ms_layer.connectiontype = connectiontype
                 
 
     # defined in subclasses: point, polygon, circle
@@ -598,6 +1199,26 @@ class DLayer(object):
         Only defined in subclasses.
         """
         pass
+
+
+    # defined in subclasses: point, polygon, circle, line
+    def createShape(self, feature):
+        """
+        Only defined in subclasses.
+
+        @return: The mapscript.shapeObj of a feature.
+        """
+        return None
+
+
+    # defined in subclasses: point, polygon, circle, line
+    def getFeatureGeometry(self, feature):
+        """
+        Only defined in subclasses.
+
+        @return: The geometry tuple of a feature (see dracones.spatial), or None.
+        """
+        return None
             
 
     def setFeatureVisibility(self, feature_id, is_visible):
@@ -606,7 +1227,11 @@ class DLayer(object):
         """
         feature_id = str(feature_id)
         if feature_id in self.features:
-            self.features[feature_id]['is_vis'] = is_visible
+            # copy on write: the feature dict may be shared with history cells
+            feature = self.features[feature_id].copy()
+            feature['is_vis'] = is_visible
+            self.features[feature_id] = feature
+            self.spatial_index = None
 
     # defined in subclasses: point, circle
     def drawFeature(self, x, y):
@@ -628,14 +1253,12 @@ class DLayer(object):
         if not getattr(features, '__iter__', False):
             features = [features]
         features = [str(s) for s in features]
-        if select_mode == 'reset': del self.selected[:]
+        if select_mode == 'reset': self.selected.clear()
         for feature_id in features:
             if select_mode in ['reset', 'add']:
-                if feature_id not in self.selected:
-                    self.selected.append(feature_id)
+                self.selected.add(feature_id)
             elif select_mode == 'toggle':
-                if feature_id in self.selected: self.selected.remove(feature_id)
-                else: self.selected.append(feature_id)
+                self.selected.toggle(feature_id)
         self.setExpression(self.selected)
 
 
@@ -651,6 +1274,9 @@ class PointDLayer(DLayer):
     A point-specialized DLayer subclass.
     """
 
+    feature_kind = 'point'
+    snapshot_shape_type = SHPT_POINT
+
     def __init__(self, name, dmap):
         """
         PointDLayer constructor.
@@ -674,11 +1300,7 @@ class PointDLayer(DLayer):
         """
         if feature_id: feature_id = str(feature_id)
         # todo: assert feature structure
-        pt_shp = shapeObj(MS_SHAPE_POINT)
-        p = pointObj(feature['gx'], feature['gy'])
-        line = lineObj()
-        line.add(p)
-        pt_shp.add(line)
+        pt_shp = self.createShape(feature)
         pt_shp.index = self.shape_index
         if feature_id in self.selected:
             pt_shp.classindex = 1
@@ -686,9 +1308,22 @@ class PointDLayer(DLayer):
         if not feature_id:
             feature_id = str(self.shape_index)
         self.features[feature_id] = feature
+        self.spatial_index = None
         self.shape_index += 1
 
 
+    def createShape(self, feature):
+        pt_shp = shapeObj(MS_SHAPE_POINT)
+        line = lineObj()
+        line.add(pointObj(feature['gx'], feature['gy']))
+        pt_shp.add(line)
+        return pt_shp
+
+
+    def getFeatureGeometry(self, feature):
+        return ('point', feature['gx'], feature['gy'])
+
+
     def drawFeature(self, x, y):
         """
         Calls addFeature with geographic x/y coords.
@@ -707,6 +1342,9 @@ class PolygonDLayer(DLayer):
     A polygon-specialized DLayer subclass.
     """
 
+    feature_kind = 'polygon'
+    snapshot_shape_type = SHPT_POLYGON
+
     def __init__(self, name, dmap):
         """
         PolygonDLayer constructor.
@@ -730,12 +1368,7 @@ class PolygonDLayer(DLayer):
         """
         if feature_id: feature_id = str(feature_id)
         # todo: assert feature structure
-        poly_shp = shapeObj(MS_SHAPE_POLYGON)
-        poly_line = lineObj()
-        for xy in feature['coords']:
-            p = pointObj(xy[0], xy[1])
-            poly_line.add(p)
-        poly_shp.add(poly_line)                    
+        poly_shp = self.createShape(feature)
         poly_shp.index = self.shape_index
         if feature_id in self.selected:
             poly_shp.classindex = 1
@@ -743,14 +1376,33 @@ class PolygonDLayer(DLayer):
         if not feature_id:
             feature_id = str(self.shape_index)
         self.features[feature_id] = feature
+        self.spatial_index = None
         self.shape_index += 1
 
 
+    def createShape(self, feature):
+        poly_shp = shapeObj(MS_SHAPE_POLYGON)
+        poly_line = lineObj()
+        for xy in feature['coords']:
+            poly_line.add(pointObj(xy[0], xy[1]))
+        poly_shp.add(poly_line)
+        return poly_shp
+
+
+    def getFeatureGeometry(self, feature):
+        if not feature['coords']:
+            return None
+        return ('polygon', [(xy[0], xy[1]) for xy in feature['coords']])
+
+
 class CircleDLayer(DLayer):
     """
     A circle-specialized DLayer subclass.
     """
 
+    feature_kind = 'circle'
+    snapshot_shape_type = SHPT_ARC
+
     def __init__(self, name, dmap):
         """
         CircleDLayer constructor.
@@ -775,13 +1427,7 @@ class CircleDLayer(DLayer):
         """
         if feature_id: feature_id = str(feature_id)
         # todo: assert feature structure
-        circle_shp = shapeObj(MS_SHAPE_LINE)
-        p1 = pointObj(feature['gx'] - feature['rad'], feature['gy'] + feature['rad'])
-        p2 = pointObj(feature['gx'] + feature['rad'], feature['gy'] - feature['rad'])
-        line = lineObj()
-        line.add(p1)
-        line.add(p2)
-        circle_shp.add(line)
+        circle_shp = self.createShape(feature)
         if feature_id is not None:
             circle_shp.index = int(feature_id)
         else:
@@ -792,9 +1438,28 @@ class CircleDLayer(DLayer):
         if feature_id is None:
             feature_id = str(self.shape_index)
         self.features[feature_id] = feature
+        self.spatial_index = None
         #self.shape_index += 1
         self.shape_index = int(feature_id) + 1
 
+
+    def getNextShapeIndex(self, feature_id):
+        return int(feature_id) + 1
+
+
+    def createShape(self, feature):
+        # a MS circle is defined by its bounding box
+        circle_shp = shapeObj(MS_SHAPE_LINE)
+        line = lineObj()
+        line.add(pointObj(feature['gx'] - feature['rad'], feature['gy'] + feature['rad']))
+        line.add(pointObj(feature['gx'] + feature['rad'], feature['gy'] - feature['rad']))
+        circle_shp.add(line)
+        return circle_shp
+
+
+    def getFeatureGeometry(self, feature):
+        return ('circle', feature['gx'], feature['gy'], abs(feature['rad']))
+
     def drawFeature(self, x, y, rad = 1000):
         """
         Calls addFeature with geographic x/y coords, default radius of 1000.
@@ -815,6 +1480,9 @@ class LineDLayer(DLayer):
     A line-specialized DLayer subclass.
     """
 
+    feature_kind = 'line'
+    snapshot_shape_type = SHPT_ARC
+
     def __init__(self, name, dmap):
         """
         LineDLayer constructor.
@@ -838,13 +1506,7 @@ class LineDLayer(DLayer):
         """
         if feature_id: feature_id = str(feature_id)
         # todo: assert feature structure
-        line_shp = shapeObj(MS_SHAPE_LINE)
-        line = lineObj()
-        p0 = pointObj(feature['gx0'], feature['gy0'])
-        line.add(p0)
-        p1 = pointObj(feature['gx1'], feature['gy1'])
-        line.add(p1)
-        line_shp.add(line)                    
+        line_shp = self.createShape(feature)
         line_shp.index = self.shape_index
         if feature_id in self.selected:
             line_shp.classindex = 1
@@ -852,9 +1514,23 @@ class LineDLayer(DLayer):
         if not feature_id:
             feature_id = str(self.shape_index)
         self.features[feature_id] = feature
+        self.spatial_index = None
         self.shape_index += 1
 
 
+    def createShape(self, feature):
+        line_shp = shapeObj(MS_SHAPE_LINE)
+        line = lineObj()
+        line.add(pointObj(feature['gx0'], feature['gy0']))
+        line.add(pointObj(feature['gx1'], feature['gy1']))
+        line_shp.add(line)
+        return line_shp
+
+
+    def getFeatureGeometry(self, feature):
+        return ('line', [(feature['gx0'], feature['gy0']), (feature['gx1'], feature['gy1'])])
+
+
     def drawLine(self, x0, y0, x1, y1, from_pixel_coords = True):
         """
         Add a line feature, from coords in geo/pixel coords.
@@ -893,7 +1569,20 @@ class DMap(mapObj):
         self.sess_mid = sess[mid]
         self.app = sess[mid]['app']
         map_file = "%s/%s.map" % (os.path.abspath(dconf[self.app]['mapfile_path']), sess[mid]['map'])
-        super(DMap, self).__init__(map_file)
+        self.map_file = map_file
+        if dconf.get('map_template_cache', True):
+            template = getMapTemplate(self.app, sess[mid]['map'], map_file)
+            self.map_mtime = template['mtime']
+            # The underlying MS object of the template clone is adopted by this instance (the
+            # ownership flags are swapped so that it gets freed along with the DMap, not the clone).
+            clone = template['map_obj'].clone()
+            self.this = clone.this
+            clone.thisown = False
+            self.thisown = True
+        else:
+            super(DMap, self).__init__(map_file)
+            self.map_mtime = os.path.getmtime(map_file)
+            template = prepareMapTemplate(self, self.app)
         if use_viewport_geom:
             self.map_size_rel_to_vp = 1            
         else:
@@ -901,14 +1590,15 @@ class DMap(mapObj):
         p = pointObj(self.map_size_rel_to_vp * sess[mid]['mvpw'] / 2, self.map_size_rel_to_vp * sess[mid]['mvph'] / 2)
         self.setSize(self.map_size_rel_to_vp * sess[mid]['mvpw'], self.map_size_rel_to_vp * sess[mid]['mvph'])
         self.zoomPoint(-self.map_size_rel_to_vp, p, self.width, self.height, self.extent, None)
-        self.dlayers = {} # 'dlayer_name' -> DLayer object
-        self.groups = {} # dlayer group name -> [dlayer names]
-        for i in range(self.numlayers):
-            ms_layer = self.getLayer(i)            
-            dlayer = createDLayerInstance(ms_layer.name, self)
-            self.dlayers[ms_layer.name] = dlayer
-            if dlayer.group:
-                self.groups.setdefault(dlayer.group, []).append(ms_layer.name)
+        self.default_extent = rectObjToDict(self.extent) # mapfile extent, before the session one is restored
+        self.layers_meta = dict(template['layers']) # 'dlayer_name' -> metadata (see inspectLayer)
+        self.dlayers = DLayerDict(self, template['layer_names']) # 'dlayer_name' -> DLayer object (created on demand)
+        self.groups = dict([(g, names[:]) for g, names in template['groups'].items()]) # dlayer group name -> [dlayer names]
+        self.restored_cell = None # history cell from which the dlayers state is restored
+        self.features_added = False
+        self.overlay_layer_names = set() # MS layers added to the mapfile ones (see DLayer.updateSelectionOverlay)
+        self.client_rev = None # rev of the last response processed by the client (see getSelectionDelta)
+        self.request_lock = None # session lock held by the request (see dracones.locks)
 
 
     def pan(self, dir):
@@ -1006,9 +1696,9 @@ class DMap(mapObj):
         for dlayer_name in dlayers:
             if dlayer_name in self.groups: # if dlayer_name is the name of a group
                 for dlayer_name_in_grp in self.groups[dlayer_name]:
-                    if dlayer_name_in_grp in self.dlayers and self.dlayers[dlayer_name_in_grp].isActive():
+                    if self.isDLayerActive(dlayer_name_in_grp):
                         selection_dlayers.append(dlayer_name_in_grp)
-            elif dlayer_name in self.dlayers and self.dlayers[dlayer_name].isActive():
+            elif self.isDLayerActive(dlayer_name):
                 selection_dlayers.append(dlayer_name)
 
         for dlayer_to_select in selection_dlayers:
@@ -1026,18 +1716,235 @@ class DMap(mapObj):
                 self.dlayers[dlayer_to_select].pointSelect(p, select_mode)
 
 
+    def draw(self):
+        """
+        Draws the map (mapscript.mapObj.draw), once the compiled features and the selection
+        overlays of the dlayers are up to date.
+
+        @return: mapscript.imageObj
+        """
+        for dlayer_name, dlayer in self.dlayers.materialized():
+            dlayer.updateFeatureSnapshot()
+            dlayer.updateSelectionOverlay()
+        return mapObj.draw(self)
+
+
+    def addSelectionOverlay(self, dlayer):
+        """
+        Inserts the selection overlay layer of a dlayer (see DLayer.updateSelectionOverlay).
+
+        @type dlayer: DLayer
+        @param dlayer: The dlayer.
+        @return: The (off) overlay mapscript.layerObj.
+        """
+        overlay = dlayer.ms_layer.clone()
+        overlay.name = '%s__selection' % dlayer.name
+        overlay.removeClass(0)
+        overlay.setFilter('')
+        overlay.status = MS_OFF
+        overlay = self.getLayer(self.insertLayer(overlay, dlayer.ms_layer.index + 1))
+        self.overlay_layer_names.add(overlay.name)
+        return overlay
+
+
+    def resetLayer(self, layer_name):
+        """
+        Replaces an MS layer by a copy of its mapfile definition (see DLayer.removeFeatures).
+
+        @type layer_name: str
+        @param layer_name: Name of the MS layer.
+        @return: The new mapscript.layerObj.
+        """
+        if dconf.get('map_template_cache', True):
+            source = getMapTemplate(self.app, self.sess_mid['map'], self.map_file)['map_obj']
+        else:
+            source = mapObj(self.map_file)
+        layer = source.getLayerByName(layer_name).clone()
+        index = self.getLayerByName(layer_name).index
+        self.removeLayer(index)
+        return self.getLayer(self.insertLayer(layer, index))
+
+
     # image filename structure: <app>_<mid>_<map>_<session_id>.<img_type>
     def getImageURL(self):
         """
-        Saves the map image and returns its URL.
+        Puts the map image in the image store and returns its URL.
         @return: map image URL.
         """
-        img = self.draw()
-        img.imagepath = os.path.abspath(dconf['ms_tmp_path'])
         fn = "%s_%s_%s_%s.%s" % (self.app, self.mid, self.sess_mid['map'], self.sess.session_id, self.imagetype)
-        img_url = "%s%s%s" % (dconf['ms_tmp_url'], '' if dconf['ms_tmp_url'].endswith('/') else '/', fn)
-        img.save("%s/%s" % (os.path.abspath(dconf['ms_tmp_path']), fn))
-        return img_url
+        return image_store.put(fn, self.renderImage(), self.outputformat.mimetype)
+
+
+    def getLazyImageURL(self):
+        """
+        Lazy alternative to getImageURL: the map is not drawn by the request, which only records
+        a render rev in the session, and returns the URL of the render service (render_url in
+        conf.json) for it. The image is drawn from the state saved in the session when the client
+        fetches it, and not at all if a newer state has replaced it in the meantime (see
+        web_interface.render). Note that changes made by a request directly to the MS objects
+        (and not saved in the session) are thus not rendered.
+
+        @return: map image URL.
+        """
+        rev = uuid.uuid4().hex
+        self.sess_mid['render_rev'] = rev
+        return "%s?mid=%s&rev=%s" % (dconf.get('render_url', '/dracones_core/dracones_do/render'), self.mid, rev)
+
+
+    def getImageDataURI(self):
+        """
+        Inline alternative to getImageURL: the map image is embedded in the response, as
+        a base64 data URI, which saves the tmp file write and the additional HTTP request
+        the client has to make to fetch it.
+
+        @return: map image data URI.
+        """
+        return "data:%s;base64,%s" % (self.outputformat.mimetype,
+                                      base64.b64encode(self.renderImage()).decode('ascii'))
+
+
+    def renderImage(self):
+        """
+        Draws the map and returns the encoded image. If the render cache is enabled
+        (render_cache_max_bytes in conf.json), an image that was already produced for
+        the same visual state (see getStateHash) is returned without drawing.
+
+        @return: The image bytes (in the map output format).
+        """
+        if not render_cache.max_bytes:
+            return self.draw().getBytes()
+        state_hash = self.getStateHash()
+        img_bytes = render_cache.get(state_hash)
+        if img_bytes is None:
+            img_bytes = self.draw().getBytes()
+            render_cache.put(state_hash, img_bytes)
+        return img_bytes
+
+
+    def getRenderState(self):
+        """
+        Everything that determines the rendered image, except its geometry (size and extent):
+        mapfile (and its version), output format, and for every layer its status, data,
+        filter and class expressions, as well as the selected items and user-defined
+        features of the dlayers.
+
+        @return: A JSON-serializable list.
+        """
+        layers = []
+        for i in range(self.numlayers):
+            ms_layer = self.getLayer(i)
+            if ms_layer.name in self.overlay_layer_names:
+                continue # derived from the dlayer selections, below
+            layers.append([ms_layer.name, ms_layer.status, ms_layer.data, ms_layer.getFilterString(),
+                           [ms_layer.getClass(j).getExpressionString() for j in range(ms_layer.numclasses)]])
+        dlayers = {}
+        for name, dlayer in self.dlayers.materialized():
+            if dlayer.selected or dlayer.features:
+                features = dlayer.features
+                if isinstance(features, FeatureColumns):
+                    features = features.getDigest()
+                dlayers[name] = [list(dlayer.selected), features]
+        return [self.app, self.sess_mid['map'], self.map_mtime, self.imagetype, layers, dlayers]
+
+
+    def getStateHash(self):
+        """
+        Canonical hash of the visual state of the map (see getRenderState), including
+        its size and extent.
+
+        @return: Hex digest string.
+        """
+        state = self.getRenderState() + [self.width, self.height, rectObjToDict(self.extent)]
+        return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+    def isTiled(self):
+        """
+        @return: True if the map widget was initialized in tiled mode (see getTiles).
+        """
+        return self.sess_mid.get('tiled', False)
+
+
+    def getTiles(self):
+        """
+        Tiled alternative to getImageURL. The plane is divided in a fixed grid of square
+        tiles (tile_size pixels in conf.json, 256 by default) for every resolution, and
+        the map image is made of the tiles that intersect its extent. A tile is rendered
+        once and saved in <ms_tmp_path>/tiles/<tileset hash>/, where the tileset hash
+        covers the render state (see getRenderState) and the resolution, but not the
+        session: after a pan, only the newly exposed tiles have to be drawn, and the
+        tiles of a given view are reused by all the sessions that share it.
+
+        @return: List of {url:.., x:.., y:..} dicts, where x/y is the tile offset in map/pixel coords.
+        """
+        tile_size = dconf.get('tile_size', 256)
+        # The resolution is rounded so that the same zoom level yields the same tileset
+        # regardless of floating point noise in the extent computations.
+        res = float('%.10g' % ((self.extent.maxx - self.extent.minx) / self.width))
+        tile_geo_size = tile_size * res
+        tileset_state = self.getRenderState() + [tile_size, repr(res)]
+        tileset = hashlib.sha1(json.dumps(tileset_state, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        tileset_path = os.path.join(os.path.abspath(dconf['ms_tmp_path']), 'tiles', tileset)
+        tileset_url = "%s%stiles/%s" % (dconf['ms_tmp_url'], '' if dconf['ms_tmp_url'].endswith('/') else '/', tileset)
+
+        # rows grow downward, from geo y = 0
+        col0 = int(math.floor(self.extent.minx / tile_geo_size))
+        col1 = int(math.ceil(self.extent.maxx / tile_geo_size)) - 1
+        row0 = int(math.floor(-self.extent.maxy / tile_geo_size))
+        row1 = int(math.ceil(-self.extent.miny / tile_geo_size)) - 1
+
+        xt = rectObjToDict(self.extent)
+        width, height = self.width, self.height
+        tiles = []
+        try:
+            for row in range(row0, row1 + 1):
+                for col in range(col0, col1 + 1):
+                    fn = "%d_%d.%s" % (col, row, self.imagetype)
+                    tile_file = os.path.join(tileset_path, fn)
+                    if not os.path.exists(tile_file):
+                        self.renderTile(tile_file, col * tile_geo_size, -(row + 1) * tile_geo_size, tile_size, res)
+                    tiles.append({ 'url' : "%s/%s" % (tileset_url, fn),
+                                   'x' : int(round((col * tile_geo_size - xt['minx']) / res)),
+                                   'y' : int(round((xt['maxy'] + row * tile_geo_size) / res)) })
+        finally:
+            # restore the map geometry
+            if (self.width, self.height) != (width, height):
+                self.setSize(width, height)
+            self.setExtentFromDict(xt)
+        return tiles
+
+
+    def renderTile(self, tile_file, minx, miny, tile_size, res):
+        """
+        Draws a single tile and saves it (the map size and extent are modified, and
+        must be restored by the caller).
+
+        @type tile_file: str
+        @param tile_file: Tile image file path.
+        @param minx, miny: Tile lower left corner, in geo coords.
+        @type tile_size: int
+        @param tile_size: Tile dimension, in pixels.
+        @type res: float
+        @param res: Resolution (geo units per pixel).
+        """
+        if (self.width, self.height) != (tile_size, tile_size):
+            self.setSize(tile_size, tile_size)
+        self.setExtentFromDict({ 'minx' : minx, 'miny' : miny,
+                                 'maxx' : minx + tile_size * res, 'maxy' : miny + tile_size * res })
+        img_bytes = self.draw().getBytes()
+        if not os.path.isdir(os.path.dirname(tile_file)):
+            try:
+                os.makedirs(os.path.dirname(tile_file))
+            except OSError:
+                pass # created concurrently
+        # write then rename, so that a concurrent request never serves a partial tile
+        tmp_file = '%s.%s.%s.tmp' % (tile_file, os.getpid(), threading.current_thread().ident)
+        f = open(tmp_file, 'wb')
+        try:
+            f.write(img_bytes)
+        finally:
+            f.close()
+        replaceFile(tmp_file, tile_file)
 
 
     def getDLayer(self, dlayer_name):
@@ -1057,20 +1964,83 @@ class DMap(mapObj):
         return (dlayer_name in self.dlayers)
 
 
+    def isDLayerActive(self, dlayer_name):
+        """
+        Same as DLayer.isActive, but without creating the dlayer if it was not already
+        (the status of an untouched dlayer is the one of its MS layer).
+
+        @type dlayer_name: str
+        @param dlayer_name: Name of the dlayer.
+        @return: Whether the dlayer exists and is ON.
+        """
+        if dlayer_name not in self.dlayers:
+            return False
+        if self.dlayers.isMaterialized(dlayer_name):
+            return self.dlayers[dlayer_name].isActive()
+        return (self.getLayerByName(dlayer_name).status == MS_ON)
+
+
+    def getLayerMeta(self, dlayer_name):
+        """
+        @type dlayer_name: str
+        @param dlayer_name: Name of the dlayer.
+        @return: The dlayer metadata computed from the mapfile (see inspectLayer).
+        """
+        if dlayer_name not in self.layers_meta:
+            self.layers_meta[dlayer_name] = inspectLayer(self.getLayerByName(dlayer_name))
+        return self.layers_meta[dlayer_name]
+
+
+    def getDLayerState(self, dlayer_name):
+        """
+        Session state of a dlayer that has not been created in this request: the one found in
+        the restored history cell, or the mapfile default.
+
+        @type dlayer_name: str
+        @param dlayer_name: Name of the dlayer.
+        @return: {filtered:.., selected:.., features:.., status:..}
+        """
+        if self.restored_cell and dlayer_name in self.restored_cell['dlayers']:
+            return self.restored_cell['dlayers'][dlayer_name]
+        return newDLayerState(self.layers_meta[dlayer_name]['status'])
+
+
+    def materializeDLayer(self, dlayer_name):
+        """
+        Creates a dlayer, and restores its state from the restored history cell (if any).
+        This is called by the dlayers dict the first time a dlayer is accessed.
+
+        @type dlayer_name: str
+        @param dlayer_name: Name of the dlayer.
+        @return: The new DLayer.
+        """
+        dlayer = createDLayerInstance(dlayer_name, self)
+        dict.__setitem__(self.dlayers, dlayer_name, dlayer)
+        if self.restored_cell and dlayer_name in self.restored_cell['dlayers']:
+            state = self.restored_cell['dlayers'][dlayer_name]
+            # important here to pass copies for compound types (decodeIDs returns new lists)
+            dlayer.restoreState(decodeIDs(state['filtered']), decodeIDs(state['selected']), state['features'].copy(), state['status'])
+        if self.features_added:
+            dlayer.addFeatures()
+        return dlayer
+
+
     def restoreStateFromSession(self, restore_extent = True):
         """
-        Restores the state of all the dlayers found in the session variable.
+        Restores the state of all the dlayers found in the session variable (the dlayers
+        that are identical to their mapfile definition are restored lazily, see materializeDLayer).
         @type restore_extent: bool
         @param restore_extent: If False, will stay with map default extent.
         """
-        hist_idx = self.sess_mid['history_idx']
-        for name, dlayer in self.dlayers.items():
-                # important here to pass copies for compound types
-                dlayer.restoreState(self.sess_mid['history'][hist_idx]['dlayers'][name]['filtered'][:],
-                                    self.sess_mid['history'][hist_idx]['dlayers'][name]['selected'][:],
-                                    self.sess_mid['history'][hist_idx]['dlayers'][name]['features'].copy(),
-                                    self.sess_mid['history'][hist_idx]['dlayers'][name]['status'])
-        xt = self.sess_mid['history'][hist_idx]['extent']
+        self.restored_cell = self.getHistoryCell()
+        # Only the dlayers whose state differs from the mapfile need to be created right
+        # away (for the renderer), the others will be restored on first access.
+        for name in self.dlayers:
+            state = self.restored_cell['dlayers'].get(name)
+            meta = self.layers_meta[name]
+            if state and (meta['is_filtered'] or state['selected'] or state['features'] or state['status'] != meta['status']):
+                self.dlayers[name]
+        xt = self.restored_cell['extent']
         if restore_extent and xt:
             self.setExtent(xt['minx'], xt['miny'], xt['maxx'], xt['maxy'])
         
@@ -1095,38 +2065,74 @@ class DMap(mapObj):
             # the outcome should be: _ a b c f
             # Note that we must use a special "init" padding for the first element (_), to prevent going back to it.
             # The same mechanism is also used in the client module (for hover items history)
+            # The cells are kept in a ring buffer (see getHistoryCell), so both cases only amount to moving its head.
             hist_idx = self.sess_mid['history_idx']
             hist_size = self.sess_mid['history_size']
+            head = self.sess_mid.get('history_head', 0)
+            prev_hist_cell = self.getHistoryCell(hist_idx)
             if hist_idx != (hist_size - 1):
-                prev_hist_cell = copy.deepcopy(self.sess_mid['history'][hist_idx])
-                # shift subset of history (0 to history_idx) to the far right (minus 1)
-                hist_copy = copy.deepcopy(self.sess_mid['history'])
-                for i in range(0, hist_idx + 1):
-                    h = hist_size - hist_idx - 2 + i
-                    self.sess_mid['history'][h] = hist_copy[i]
-                    if i == 0 and h > 0: # special case: prevent going back to previous part of history (using an 'init' item)
-                        self.sess_mid['history'][h-1]['init'] = True
-                # add new cell at last slot
-                self.sess_mid['history'][-1] = newHistoryCell() # add new cell
-
-            # new action is initiated at the end of history: simply append a new cell at the 
-            # right, and pop the oldest one at the left
+                # rotate the ring right so that the current cell lands at the before-last position: the trimmed
+                # "future" cells wrap around to the left, where they are replaced by "init" padding cells
+                shift = hist_size - hist_idx - 2
+                head = (head - shift) % hist_size
+                for i in range(shift):
+                    init_cell = newHistoryCell()
+                    init_cell['init'] = True # special marker to make it impossible to go back to these
+                    self.sess_mid['history'][(head + i) % hist_size] = init_cell
+
+            # new action is initiated at the end of history: simply rotate the ring left, the oldest 
+            # cell becoming the slot of the new one
             else:
-                prev_hist_cell = copy.deepcopy(self.sess_mid['history'][-1])
-                self.sess_mid['history'].append(newHistoryCell()) # add new cell
-                self.sess_mid['history'].pop(0) # remove oldest one
+                head = (head + 1) % hist_size
 
-            # copy every prev cell element
+            self.sess_mid['history_head'] = head
+            new_hist_cell = newHistoryCell() # add new cell at last slot
+            # copy every prev cell element (user-defined history items are never modified in place, see setHistoryItem)
             for item in prev_hist_cell:
                 if item not in ['dlayers', 'extent']:
-                    self.sess_mid['history'][-1][item] = prev_hist_cell[item]
+                    new_hist_cell[item] = prev_hist_cell[item]
+            self.sess_mid['history'][(head + hist_size - 1) % hist_size] = new_hist_cell
             
         self.sess_mid['history_idx'] = (self.sess_mid['history_size'] - 1) # make sure that pointer is to last elem
-        self.sess_mid['history'][-1]['extent'] = self.getExtent()
-        for name, dlayer in self.dlayers.items():
-            dlayer.saveStateInSession()
+        self.getHistoryCell()['extent'] = self.getExtent()
+        for name in self.dlayers:
+            if self.dlayers.isMaterialized(name):
+                self.dlayers[name].saveStateInSession()
+            else:
+                self.getHistoryCell()['dlayers'][name] = self.getDLayerState(name)
         
 
+    def getHistoryCell(self, hist_idx = None):
+        """
+        The history cells are kept in a ring buffer: the logical index i (0 being the
+        oldest cell, and history_size - 1 the newest) is stored in the history list at
+        slot (history_head + i) % history_size.
+
+        @type hist_idx: int
+        @param hist_idx: Logical index of the cell (default: the current history_idx).
+        @return: The history cell.
+        """
+        if hist_idx is None:
+            hist_idx = self.sess_mid['history_idx']
+        slot = (self.sess_mid.get('history_head', 0) + hist_idx) % self.sess_mid['history_size']
+        return self.sess_mid['history'][slot]
+
+
+    def canUndo(self):
+        """
+        @return: Whether there is a previous (non "init") history cell to go back to.
+        """
+        hist_idx = self.sess_mid['history_idx']
+        return hist_idx > 0 and ('init' not in self.getHistoryCell(hist_idx - 1))
+
+
+    def canRedo(self):
+        """
+        @return: Whether there is a next history cell to go forward to.
+        """
+        return self.sess_mid['history_idx'] < (self.sess_mid['history_size'] - 1)
+
+
     # map dlayer -> hover_items
     def getHoverItems(self):
         """
@@ -1137,12 +2143,36 @@ class DMap(mapObj):
         @return: Hover items for the whole map (dict: {dlayer: {append: bool, items: [(hover item triplets)]}}).
         """
         map_hover_items = {}
-        for name, dlayer in self.dlayers.items():
+        for name, dlayer in self.dlayers.materialized():
             if dlayer.hover_items_are_dirty:
                 map_hover_items[name] = {'append': dlayer.hover_items_in_append_mode, 'items':dlayer.hover_items}
         return map_hover_items
 
 
+    def getCompactHoverItems(self):
+        """
+        Columnar version of getHoverItems, for large numbers of hover items: for every dlayer,
+        the coordinates are numeric arrays, and the (often repeated) HTML strings are stored
+        once, in a table referenced by index.
+
+        @return: Hover items for the whole map (dict: {dlayer: {append: bool, gx: [float], gy: [float], html: [int], html_table: [str]}}).
+        """
+        map_hover_items = {}
+        for name, items in self.getHoverItems().items():
+            html_indices = {}
+            html_table = []
+            gxs, gys, htmls = [], [], []
+            for gx, gy, html in items['items']:
+                if html not in html_indices:
+                    html_indices[html] = len(html_table)
+                    html_table.append(html)
+                gxs.append(float(gx) if gx is not None else None)
+                gys.append(float(gy) if gy is not None else None)
+                htmls.append(html_indices[html])
+            map_hover_items[name] = { 'append' : items['append'], 'gx' : gxs, 'gy' : gys, 'html' : htmls, 'html_table' : html_table }
+        return map_hover_items
+
+
     def getSelection(self):
         """
         Selection dict for the whole map.
@@ -1150,10 +2180,48 @@ class DMap(mapObj):
         @return: {dlayer: [..sel IDs], ..}.
         """
         selection_map = {}
-        for name, dlayer in self.dlayers.items():
-#            if dlayer.selected:
-            selection_map[name] = dlayer.selected
+        for name in self.dlayers:
+            if self.dlayers.isMaterialized(name):
+                selection_map[name] = list(self.dlayers[name].selected)
+            else:
+                selection_map[name] = decodeIDs(self.getDLayerState(name)['selected'])
         return selection_map
+
+
+    def getSelectionDelta(self, client_rev, state_saved = True):
+        """
+        Selection dict for the whole map, limited to the dlayers whose selection changed since the
+        last response sent to the client, provided that the client is in sync with it (i.e. it sends
+        back the rev of that response): the sel_rev tokens of the dlayers (see DLayer.saveStateInSession)
+        that were sent are kept in the session, and compared with the current ones. If the client is
+        not in sync (first request, lost or unprocessed response), the whole selection is sent.
+
+        @type client_rev: str
+        @param client_rev: Rev of the last response processed by the client (None if unknown).
+        @type state_saved: bool
+        @param state_saved: Whether the state was saved in the session by this request (if not, the created
+                            dlayers, whose selection may differ from the history cell, are always sent).
+        @return: {selection: {dlayer: [..sel IDs], ..}, delta: bool, rev: str}
+        """
+        cell = self.getHistoryCell()
+        sent_sel_revs = self.sess_mid.get('sent_sel_revs')
+        in_sync = client_rev is not None and client_rev == self.sess_mid.get('rev') and sent_sel_revs is not None
+        sel_revs = {}
+        selection_map = {}
+        for name in self.dlayers:
+            state = cell['dlayers'].get(name) or self.getDLayerState(name)
+            sel_revs[name] = state.get('sel_rev')
+            is_materialized = self.dlayers.isMaterialized(name)
+            if in_sync and name in sent_sel_revs and sent_sel_revs[name] == sel_revs[name] and (state_saved or not is_materialized):
+                continue
+            if is_materialized:
+                selection_map[name] = list(self.dlayers[name].selected)
+            else:
+                selection_map[name] = decodeIDs(state['selected'])
+        rev = uuid.uuid4().hex
+        self.sess_mid['rev'] = rev
+        self.sess_mid['sent_sel_revs'] = sel_revs
+        return { 'selection' : selection_map, 'delta' : in_sync, 'rev' : rev }
     
 
     def getExtent(self):
@@ -1176,7 +2244,7 @@ class DMap(mapObj):
         """
         if dlayer_name in self.groups: # clear all members of group if dlayer_name is the name of a group
             for dlayer_name_grp in self.groups[dlayer_name]:
-                if not self.hasDLayer(dlayer_name_grp) or self.dlayers[dlayer_name_grp].getStatus() != MS_ON: 
+                if not self.isDLayerActive(dlayer_name_grp):
                     continue
                 if what in ['selected', 'all']:
                     self.dlayers[dlayer_name_grp].clearSelected()
@@ -1187,7 +2255,7 @@ class DMap(mapObj):
                     self.dlayers[dlayer_name_grp].setFilter([])
                     self.dlayers[dlayer_name_grp].hover_items_are_dirty = True # to have them reset
         else:
-            if not self.hasDLayer(dlayer_name) or self.dlayers[dlayer_name].getStatus() != MS_ON: return
+            if not self.isDLayerActive(dlayer_name): return
             if what in ['selected', 'all']:
                 self.dlayers[dlayer_name].clearSelected()
             if what in ['features', 'all']:
@@ -1202,8 +2270,19 @@ class DMap(mapObj):
         """
         Recursively calls addFeatures for all existing dlayers.
         """
-        for dlayer in self.dlayers.values():
+        for name, dlayer in self.dlayers.materialized():
             dlayer.addFeatures()
+        self.features_added = True # dlayers created from now on will add their features themselves
+
+
+    def removeDLayerFeatures(self):
+        """
+        Recursively calls removeFeatures for all existing dlayers (the features then have to be
+        added again, see addDLayerFeatures).
+        """
+        for name, dlayer in self.dlayers.materialized():
+            dlayer.removeFeatures()
+        self.features_added = False
         
 
     def getSelected(self, dlayer_name):
@@ -1215,12 +2294,12 @@ class DMap(mapObj):
         if dlayer_name in self.groups:
             selected = []
             for dlayer_name_in_grp in self.groups[dlayer_name]:
-                if dlayer_name_in_grp in self.dlayers and self.dlayers[dlayer_name_in_grp].isActive():
+                if self.isDLayerActive(dlayer_name_in_grp):
                     selected.extend(self.dlayers[dlayer_name_in_grp].selected)
             return selected
         else:
             if dlayer_name in self.dlayers:
-                return self.dlayers[dlayer_name].selected
+                return list(self.dlayers[dlayer_name].selected)
             else:
                 return []
 
@@ -1254,7 +2333,7 @@ class DMap(mapObj):
         """
         active_dlayers = []
         for dlayer_name_in_grp in self.groups.get(group_name, []):
-            if dlayer_name_in_grp in self.dlayers and self.dlayers[dlayer_name_in_grp].isActive():
+            if self.isDLayerActive(dlayer_name_in_grp):
                 active_dlayers.append(dlayer_name_in_grp)
         return active_dlayers
 
@@ -1262,17 +2341,17 @@ class DMap(mapObj):
     def setHistoryItem(self, item, value):
         """
         Sets a user-defined history item in the current session's history cell.
-        The item gets copied every time the history is shifter, so it can be 
-        recalled later, using getHistoryItem. IMPORTANT: This must be called 
-        *before* the endDracones call.
+        The item gets carried over every time the history is shifted, so it can be 
+        recalled later, using getHistoryItem. The value is copied here, and the
+        copy is then shared by the following cells (it must not be modified in place).
+        IMPORTANT: This must be called *before* the endDracones call.
 
         @type item: str
         @param item: Name of the item to retrieve.
         @type value: built-in type
         @param value: Value of the item to set (restricted to built-in types).
         """
-        hist_idx = self.sess_mid['history_idx']
-        self.sess_mid['history'][hist_idx][item] = copy.deepcopy(value)
+        self.getHistoryCell()[item] = copy.deepcopy(value)
 
 
     def getHistoryItem(self, item):
@@ -1283,6 +2362,6 @@ class DMap(mapObj):
         @param item: Name of the item to retrieve.
         @return: Value of the retrieved item.
         """
-        hist_idx = self.sess_mid['history_idx'] - 1
-        assert item in self.sess_mid['history'][hist_idx]
-        return self.sess_mid['history'][hist_idx][item]
+        hist_cell = self.getHistoryCell(self.sess_mid['history_idx'] - 1)
+        assert item in hist_cell
+        return hist_cell[item]
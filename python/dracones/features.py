@@ -0,0 +1,291 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Columnar storage of the user-defined features of the dlayers. Instead of one
+dict per feature, the features of a dlayer are kept in contiguous arrays: one
+float array per coordinate attribute (gx/gy, rad, gx0/gy0/gx1/gy1), a flag
+byte per feature (visibility and selection bits), and for polygons, a single
+pair of x/y arrays with per-feature offsets. This is what is kept in the
+session (the arrays are pickled as raw bytes, and the ids are run-length
+encoded, see dracones.selection), and what the geometry builders
+(spatial index, compiled feature shapefile) read.
+
+FeatureColumns behaves like the former id -> {feature attributes..} dict: a
+feature dict is built on access, and assigning one stores its values in the
+columns (attributes that do not fit the columns are kept as is, aside).
+"""
+
+import json, hashlib
+from array import array
+from dracones.selection import encodeIDs, decodeIDs
+
+
+FEATURE_FIELDS = { 'point' : ('gx', 'gy'),
+                   'circle' : ('gx', 'gy', 'rad'),
+                   'line' : ('gx0', 'gy0', 'gx1', 'gy1'),
+                   'polygon' : () }
+"""Coordinate attributes of the features of each kind (polygons have their 'coords' list instead)."""
+
+HAS_VIS = 1
+IS_VIS = 2
+HAS_SEL = 4
+IS_SEL = 8
+RAW = 16 # the whole feature is kept in extras (its values do not fit the columns)
+
+FLAG_BITS = { 'is_vis' : (HAS_VIS, IS_VIS), 'is_sel' : (HAS_SEL, IS_SEL) }
+
+
+def toBytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def fromBytes(typecode, raw):
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(raw)
+    else:
+        a.fromstring(raw)
+    return a
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class FeatureColumns(object):
+    """
+    Features of a dlayer (id -> {feature attributes..}), stored by columns.
+    """
+
+    def __init__(self, kind, features = None):
+        """
+        FeatureColumns constructor.
+
+        @type kind: 'point' | 'circle' | 'line' | 'polygon'
+        @param kind: Feature kind (see FEATURE_FIELDS).
+        @type features: dict
+        @param features: Initial features (id -> {feature attributes..}).
+        """
+        self.kind = kind
+        self.fields = FEATURE_FIELDS[kind]
+        self.ids = [] # feature ids, by row
+        self.rows = {} # feature id -> row
+        self.columns = dict([(field, array('d')) for field in self.fields])
+        self.flags = array('B')
+        self.xs = array('d') # polygon coords: those of row i are at [offsets[i], offsets[i + 1])
+        self.ys = array('d')
+        self.offsets = array('i', [0])
+        self.extras = {} # feature id -> {other attributes..} (or the whole feature, for RAW rows)
+        self.visible_ids = None # sorted ids of the visible features (computed on demand)
+        if features:
+            for fid, feature in features.items():
+                self[fid] = feature
+
+    def __getstate__(self):
+        state = { 'kind' : self.kind, 'ids' : encodeIDs(self.ids), 'flags' : toBytes(self.flags), 'extras' : self.extras,
+                  'columns' : dict([(field, toBytes(column)) for field, column in self.columns.items()]) }
+        if self.kind == 'polygon':
+            state.update({ 'xs' : toBytes(self.xs), 'ys' : toBytes(self.ys), 'offsets' : toBytes(self.offsets) })
+        return state
+
+    def __setstate__(self, state):
+        self.kind = state['kind']
+        self.fields = FEATURE_FIELDS[self.kind]
+        self.ids = decodeIDs(state['ids'])
+        self.rows = dict(zip(self.ids, range(len(self.ids))))
+        self.columns = dict([(field, fromBytes('d', raw)) for field, raw in state['columns'].items()])
+        self.flags = fromBytes('B', state['flags'])
+        self.xs = fromBytes('d', state.get('xs', b''))
+        self.ys = fromBytes('d', state.get('ys', b''))
+        self.offsets = fromBytes('i', state['offsets']) if 'offsets' in state else array('i', [0] * (len(self.ids) + 1))
+        self.extras = state['extras']
+        self.visible_ids = None
+
+    def copy(self):
+        """
+        @return: A copy (arrays are copied, the attribute dicts of extras are shared, as they are never modified in place).
+        """
+        other = FeatureColumns.__new__(FeatureColumns)
+        other.kind = self.kind
+        other.fields = self.fields
+        other.ids = self.ids[:]
+        other.rows = self.rows.copy()
+        other.columns = dict([(field, column[:]) for field, column in self.columns.items()])
+        other.flags = self.flags[:]
+        other.xs = self.xs[:]
+        other.ys = self.ys[:]
+        other.offsets = self.offsets[:]
+        other.extras = self.extras.copy()
+        other.visible_ids = self.visible_ids
+        return other
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, fid):
+        return fid in self.rows
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        if not isinstance(other, FeatureColumns):
+            return False
+        return (self.kind == other.kind and self.ids == other.ids and self.flags == other.flags and
+                self.columns == other.columns and self.xs == other.xs and self.ys == other.ys and
+                self.offsets == other.offsets and self.extras == other.extras)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getitem__(self, fid):
+        row = self.rows[fid]
+        flags = self.flags[row]
+        if flags & RAW:
+            return dict(self.extras[fid])
+        feature = dict([(field, self.columns[field][row]) for field in self.fields])
+        if self.kind == 'polygon':
+            a, b = self.offsets[row], self.offsets[row + 1]
+            feature['coords'] = list(zip(self.xs[a:b], self.ys[a:b]))
+        for attr, (has_bit, is_bit) in FLAG_BITS.items():
+            if flags & has_bit:
+                feature[attr] = bool(flags & is_bit)
+        if fid in self.extras:
+            feature.update(self.extras[fid])
+        return feature
+
+    def get(self, fid, default = None):
+        if fid in self.rows:
+            return self[fid]
+        return default
+
+    def keys(self):
+        return list(self.ids)
+
+    def values(self):
+        return [self[fid] for fid in self.ids]
+
+    def items(self):
+        return [(fid, self[fid]) for fid in self.ids]
+
+    def __setitem__(self, fid, feature):
+        row = self.rows.get(fid)
+        if row is None:
+            row = len(self.ids)
+            self.ids.append(fid)
+            self.rows[fid] = row
+            for column in self.columns.values():
+                column.append(0.0)
+            self.flags.append(0)
+            self.offsets.append(self.offsets[-1])
+        self.visible_ids = None
+        self.extras.pop(fid, None)
+        coords = []
+        if self.kind == 'polygon':
+            coords = feature.get('coords')
+            if not isinstance(coords, (list, tuple)) or [xy for xy in coords if not isinstance(xy, (list, tuple)) or len(xy) != 2 or
+                                                         not isNumber(xy[0]) or not isNumber(xy[1])]:
+                coords = None
+        if coords is None or [field for field in self.fields if not isNumber(feature.get(field))]:
+            self.flags[row] = RAW
+            self.extras[fid] = dict(feature)
+            self.setCoords(row, [])
+            return
+        for field in self.fields:
+            self.columns[field][row] = feature[field]
+        self.setCoords(row, coords)
+        flags = 0
+        extras = {}
+        for attr, value in feature.items():
+            if attr in self.fields or (attr == 'coords' and self.kind == 'polygon'):
+                continue
+            if attr in FLAG_BITS and isinstance(value, bool):
+                flags |= FLAG_BITS[attr][0] | (FLAG_BITS[attr][1] if value else 0)
+            else:
+                extras[attr] = value
+        self.flags[row] = flags
+        if extras:
+            self.extras[fid] = extras
+
+    def setCoords(self, row, coords):
+        """
+        Replaces the polygon coords of a row (shifting the offsets of the following ones if needed).
+        """
+        if self.kind != 'polygon':
+            return
+        a, b = self.offsets[row], self.offsets[row + 1]
+        if b - a == len(coords):
+            for i, (x, y) in enumerate(coords):
+                self.xs[a + i] = x
+                self.ys[a + i] = y
+            return
+        self.xs[a:b] = array('d', [xy[0] for xy in coords])
+        self.ys[a:b] = array('d', [xy[1] for xy in coords])
+        delta = len(coords) - (b - a)
+        for i in range(row + 1, len(self.offsets)):
+            self.offsets[i] += delta
+
+    def __delitem__(self, fid):
+        features = self.copy()
+        del features.ids[features.rows[fid]]
+        self.__init__(self.kind)
+        for other_fid in features.ids:
+            self[other_fid] = features[other_fid]
+
+    def isVisible(self, fid):
+        """
+        @return: Whether a feature is visible: as for a feature dict, any false is_vis value hides it
+                 (a non bool value is kept in extras, see __setitem__).
+        """
+        flags = self.flags[self.rows[fid]]
+        if flags & RAW or (fid in self.extras and 'is_vis' in self.extras[fid]):
+            return bool(self.extras[fid].get('is_vis', True))
+        return not (flags & HAS_VIS) or bool(flags & IS_VIS)
+
+    def getVisibleIds(self):
+        """
+        @return: Sorted ids of the visible features (the order in which they are drawn).
+        """
+        if self.visible_ids is None:
+            self.visible_ids = sorted([fid for fid in self.ids if self.isVisible(fid)])
+        return self.visible_ids
+
+    def getGeometry(self, fid):
+        """
+        @return: The geometry tuple of a feature (see dracones.spatial), read from the columns,
+                 or None for a RAW feature.
+        """
+        row = self.rows[fid]
+        if self.flags[row] & RAW:
+            return None
+        c = self.columns
+        if self.kind == 'point':
+            return ('point', c['gx'][row], c['gy'][row])
+        elif self.kind == 'circle':
+            return ('circle', c['gx'][row], c['gy'][row], abs(c['rad'][row]))
+        elif self.kind == 'line':
+            return ('line', [(c['gx0'][row], c['gy0'][row]), (c['gx1'][row], c['gy1'][row])])
+        a, b = self.offsets[row], self.offsets[row + 1]
+        if a == b:
+            return None
+        return ('polygon', list(zip(self.xs[a:b], self.ys[a:b])))
+
+    def getDigest(self):
+        """
+        @return: Hex digest of the content of the features.
+        """
+        h = hashlib.sha1()
+        h.update(('%s|%s' % (self.kind, '\0'.join([str(fid) for fid in self.ids]))).encode('utf-8'))
+        for field in self.fields:
+            h.update(toBytes(self.columns[field]))
+        for a in (self.flags, self.xs, self.ys, self.offsets):
+            h.update(toBytes(a))
+        h.update(json.dumps(self.extras, sort_keys=True, default=str).encode('utf-8'))
+        return h.hexdigest()
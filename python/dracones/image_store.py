@@ -0,0 +1,124 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Storage of the rendered map images, from which they are fetched by the
+browser. The backend is selected with the "image_store" option of conf.json:
+
+  - "file" (default): the images are saved in ms_tmp_path, and served by the
+    web server under ms_tmp_url (the Apache /ms_tmp alias).
+  - "memory": the images are kept in a per-process LRU cache, bounded by
+    "image_store_max_bytes", with an optional "image_store_ttl" (in seconds),
+    and served by the /image route of the web interface, whose URL (as seen
+    by the browser) is "image_store_url". As the images live in the WSGI
+    process, this requires a single process deployment (e.g. a mod_wsgi daemon
+    process group with multiple threads, but only one process).
+"""
+
+import os, threading
+from dracones.cache import LRUCache
+from dracones.session_store import replaceFile
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+
+class ImageStore(object):
+    """
+    Base class of the image storage backends. A backend defines:
+
+      - put(key, img_bytes, mimetype): stores an image (replacing any previous image with the same
+        key, a file name), and returns the URL from which the browser can fetch it.
+      - get(key): returns the (img_bytes, mimetype) tuple of an image, or None if it is not (or no
+        longer) stored.
+    """
+
+
+class FileImageStore(ImageStore):
+    """
+    The images are files in a web server directory.
+    """
+
+    mimetypes = { 'png' : 'image/png', 'gif' : 'image/gif', 'jpg' : 'image/jpeg', 'jpeg' : 'image/jpeg' }
+
+    def __init__(self, path, url):
+        """
+        @type path: str
+        @param path: Directory in which the images are saved.
+        @type url: str
+        @param url: URL of that directory.
+        """
+        self.path = os.path.abspath(path)
+        self.url = url if url.endswith('/') else url + '/'
+
+    def put(self, key, img_bytes, mimetype):
+        filepath = os.path.join(self.path, key)
+        # write then rename, so that the web server never serves a partial image
+        tmp_filepath = '%s.%s.%s.tmp' % (filepath, os.getpid(), threading.current_thread().ident)
+        f = open(tmp_filepath, 'wb')
+        try:
+            f.write(img_bytes)
+        finally:
+            f.close()
+        replaceFile(tmp_filepath, filepath)
+        return self.url + key
+
+    def get(self, key):
+        try:
+            f = open(os.path.join(self.path, os.path.basename(key)), 'rb')
+        except IOError:
+            return None
+        try:
+            return (f.read(), self.mimetypes.get(key.rsplit('.', 1)[-1].lower(), 'application/octet-stream'))
+        finally:
+            f.close()
+
+
+class MemoryImageStore(ImageStore):
+    """
+    The images are kept in memory (LRU cache with TTL), and served by the /image route.
+    """
+
+    def __init__(self, url, max_bytes, ttl = 0):
+        """
+        @type url: str
+        @param url: URL of the /image route.
+        @type max_bytes: int
+        @param max_bytes: Size budget of the stored images.
+        @type ttl: float
+        @param ttl: Time-to-live of the images, in seconds (0 means no expiration).
+        """
+        self.url = url
+        self.images = LRUCache(max_bytes, ttl, sizeof=lambda img: len(img[0]))
+
+    def put(self, key, img_bytes, mimetype):
+        self.images.put(key, (img_bytes, mimetype))
+        return '%s?key=%s' % (self.url, quote(key))
+
+    def get(self, key):
+        return self.images.get(key)
+
+
+def createImageStore(dconf):
+    """
+    Instantiates the image store backend selected in the config.
+
+    @type dconf: dict
+    @param dconf: The Dracones config dict (see conf.py).
+    @return: An ImageStore instance.
+    """
+    store_type = dconf.get('image_store', 'file')
+    if store_type == 'file':
+        return FileImageStore(dconf['ms_tmp_path'], dconf['ms_tmp_url'])
+    elif store_type == 'memory':
+        return MemoryImageStore(dconf.get('image_store_url', '/dracones_core/dracones_do/image'),
+                                dconf.get('image_store_max_bytes', 64 * 1024 * 1024),
+                                dconf.get('image_store_ttl', 600))
+    else:
+        assert False, "Unknown image_store: '%s'" % store_type
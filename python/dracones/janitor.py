@@ -0,0 +1,247 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Cleanup of the Dracones temporary directories, which otherwise grow without
+bound: the rendered images and tiles of ms_tmp_path, the generated files of
+cache_path (subset shapefiles), and the sessions of session_path (Pesto
+session files, as well as the mid states of the "file" and "sqlite" session
+stores).
+
+Images are removed when they are older than "janitor_image_max_age" (seconds),
+and then, oldest first, until ms_tmp_path fits in "janitor_image_max_bytes"
+(the same rules apply to cache_path, whose files are touched while in use).
+Sessions are removed (Pesto file and mid states together) when their last
+activity is older than "janitor_session_max_age", and then, least recently
+active first, until they fit in "janitor_session_max_bytes". Mid states
+whose Pesto session file no longer exists are removed as well, and so are the
+lock files (see dracones.locks) unused for longer than janitor_session_max_age.
+A max_bytes of 0 means no size budget.
+
+The janitor can run in a background thread of the WSGI process, every
+"janitor_interval" seconds (0 to disable it), or from the command line:
+
+    python -m dracones.janitor
+"""
+
+import os, sys, time, threading, traceback
+from dracones.conf import dconf
+from dracones.session_store import createSessionStore
+from dracones.locks import fcntl, removeLockFile
+
+
+ORPHAN_GRACE_PERIOD = 600
+"""Mid states younger than this (in seconds) are never considered orphaned, as their Pesto session file may not be written yet."""
+
+
+class Janitor(object):
+    """
+    Removes the expired images and sessions.
+    """
+
+    def __init__(self, dconf):
+        """
+        Janitor constructor.
+
+        @type dconf: dict
+        @param dconf: The Dracones config dict (see conf.py).
+        """
+        self.ms_tmp_path = os.path.abspath(dconf['ms_tmp_path'])
+        self.cache_path = os.path.abspath(dconf.get('cache_path', dconf['ms_tmp_path']))
+        self.session_path = os.path.abspath(dconf['session_path'])
+        self.session_store = createSessionStore(dconf)
+        self.image_max_age = dconf.get('janitor_image_max_age', 3600)
+        self.image_max_bytes = dconf.get('janitor_image_max_bytes', 0)
+        self.session_max_age = dconf.get('janitor_session_max_age', 86400)
+        self.session_max_bytes = dconf.get('janitor_session_max_bytes', 0)
+        self.interval = dconf.get('janitor_interval', 0)
+
+    def run(self):
+        """
+        Performs a complete cleanup.
+
+        @return: {images: {files:.., bytes:..}, sessions: {files:.., bytes:..}}
+        """
+        now = time.time()
+        report = { 'images' : self.cleanImages(now), 'sessions' : self.cleanSessions(now) }
+        self.addToReport(report['sessions'], self.cleanLocks(now))
+        if self.cache_path != self.ms_tmp_path:
+            self.addToReport(report['images'], self.cleanFiles(self.cache_path, now))
+        return report
+
+    def cleanImages(self, now):
+        """
+        Removes the expired map images and tiles of ms_tmp_path (and the tile directories left empty).
+
+        @type now: float
+        @param now: Reference time.
+        @return: {files:.., bytes:..}
+        """
+        report = { 'files' : 0, 'bytes' : 0 }
+        self.addToReport(report, self.cleanFiles(self.ms_tmp_path, now))
+        # empty tile directories
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.ms_tmp_path, 'tiles'), topdown=False):
+            if dirpath != os.path.join(self.ms_tmp_path, 'tiles') and not os.listdir(dirpath):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+        return report
+
+    def cleanFiles(self, path, now):
+        """
+        Removes the expired files of a directory tree (with the image age and size budget).
+
+        @type path: str
+        @param path: Root directory.
+        @type now: float
+        @param now: Reference time.
+        @return: (nb of files, nb of bytes) reclaimed.
+        """
+        n_files, n_bytes = 0, 0
+        entries = [] # [(mtime, size, path)]
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fn in filenames:
+                filepath = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filepath))
+        entries.sort()
+        total_bytes = sum([e[1] for e in entries])
+        for mtime, size, filepath in entries:
+            if now - mtime <= self.image_max_age and (not self.image_max_bytes or total_bytes <= self.image_max_bytes):
+                break
+            if removeFile(filepath):
+                n_files += 1
+                n_bytes += size
+            total_bytes -= size
+        return (n_files, n_bytes)
+
+    def cleanSessions(self, now):
+        """
+        Removes the expired and orphaned sessions of session_path.
+
+        @type now: float
+        @param now: Reference time.
+        @return: {files:.., bytes:..}
+        """
+        report = { 'files' : 0, 'bytes' : 0 }
+        # session_id -> [last activity, size, [pesto session files]]
+        sessions = {}
+        for dirpath, dirnames, filenames in os.walk(self.session_path):
+            if dirpath == self.session_path and 'dracones_mids' in dirnames:
+                dirnames.remove('dracones_mids') # file session store
+            if dirpath == self.session_path and 'dracones_locks' in dirnames:
+                dirnames.remove('dracones_locks') # lock files (see dracones.locks)
+            for fn in filenames:
+                if fn.startswith('dracones_mids.sqlite'):
+                    continue # sqlite session store
+                filepath = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                session = sessions.setdefault(fn, [0, 0, []])
+                session[0] = max(session[0], st.st_mtime)
+                session[1] += st.st_size
+                session[2].append(filepath)
+        for session_id, (mtime, size) in self.session_store.listSessions().items():
+            if session_id not in sessions:
+                if now - mtime > ORPHAN_GRACE_PERIOD: # orphaned mid states
+                    self.addToReport(report, self.session_store.removeSession(session_id))
+                continue
+            sessions[session_id][0] = max(sessions[session_id][0], mtime)
+            sessions[session_id][1] += size
+        entries = sorted([(s[0], s[1], session_id, s[2]) for session_id, s in sessions.items()])
+        total_bytes = sum([e[1] for e in entries])
+        for mtime, size, session_id, filepaths in entries:
+            if now - mtime <= self.session_max_age and (not self.session_max_bytes or total_bytes <= self.session_max_bytes):
+                break
+            for filepath in filepaths:
+                try:
+                    file_size = os.stat(filepath).st_size
+                except OSError:
+                    continue
+                if removeFile(filepath):
+                    self.addToReport(report, (1, file_size))
+            self.addToReport(report, self.session_store.removeSession(session_id))
+            total_bytes -= size
+        return report
+
+    def cleanLocks(self, now):
+        """
+        Removes the lock files of <session_path>/dracones_locks that were not used for longer
+        than the session max age (and whose lock is not held, see dracones.locks.removeLockFile).
+
+        @type now: float
+        @param now: Reference time.
+        @return: (nb of files, nb of bytes) reclaimed.
+        """
+        lock_path = os.path.join(self.session_path, 'dracones_locks')
+        if fcntl is None or not os.path.isdir(lock_path):
+            return (0, 0)
+        n_files, n_bytes = 0, 0
+        for fn in os.listdir(lock_path):
+            filepath = os.path.join(lock_path, fn)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            if now - st.st_mtime > self.session_max_age and removeLockFile(filepath):
+                n_files += 1
+                n_bytes += st.st_size
+        return (n_files, n_bytes)
+
+    def addToReport(self, report, counts):
+        report['files'] += counts[0]
+        report['bytes'] += counts[1]
+
+    def start(self):
+        """
+        Starts the background cleanup thread (if janitor_interval is set).
+
+        @return: The thread, or None.
+        """
+        if not self.interval:
+            return None
+        thread = threading.Thread(target=self.loop, name='dracones-janitor')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run()
+            except Exception:
+                # the next run will try again, but the failure is reported on stderr (i.e. in the
+                # server error log), as it could otherwise keep the janitor from ever cleaning anything
+                sys.stderr.write('dracones janitor run failed:\n%s' % traceback.format_exc())
+
+
+def removeFile(filepath):
+    """
+    @return: True if the file was removed (False if it was already gone, or could not be removed).
+    """
+    try:
+        os.remove(filepath)
+        return True
+    except OSError:
+        return False
+
+
+def main():
+    report = Janitor(dconf).run()
+    for what in ('images', 'sessions'):
+        print('%s: %d files, %d bytes reclaimed' % (what, report[what]['files'], report[what]['bytes']))
+
+
+if __name__ == '__main__':
+    main()
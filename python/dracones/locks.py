@@ -0,0 +1,318 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Request locks. The session state of a map widget is read at the start of a
+request (beginDracones) and written back at its end (endDracones): two
+overlapping requests for the same state would lose one of the updates. A
+request thus holds a lock on its session state between these two steps, so
+that the requests of the same widget are serialized, while those of different
+widgets (or sessions) proceed in parallel, which makes a multithreaded WSGI
+deployment safe.
+
+With the "file" or "sqlite" session store (see dracones.session_store), the
+state of a widget is loaded once the lock is taken. With the "pesto" session
+store, the whole Pesto session is loaded and saved by its middleware, outside
+of the request: the lock is then taken by lock_middleware, which wraps the
+Pesto one, on the whole session (identified by its cookie), and held from
+before the session is loaded until after it is saved.
+
+The options of conf.json are:
+
+  - "lock_scope": "mid" (one lock per map widget, the default), "session" (one
+    lock per browser session) or "none" (no locking). With the "pesto" session
+    store, the lock is always per session.
+  - "session_cookie": name of the Pesto session cookie ("pesto_session" by
+    default), with the "pesto" session store.
+  - "lock_timeout": max number of seconds a request waits for a lock (30 by
+    default), after which it fails with a "session_locked" error.
+  - "lock_files": if true, the locks are also taken on files (in
+    <session_path>/dracones_locks/), so that they hold across the processes of
+    a multi-process deployment (this requires fcntl, i.e. a Unix system).
+"""
+
+import os, time, threading, hashlib, json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from Cookie import SimpleCookie
+except ImportError:
+    from http.cookies import SimpleCookie
+
+
+class LockHandle(object):
+    """
+    A lock held by a request (see LockManager.acquire).
+    """
+
+    def __init__(self, key, fd = None):
+        self.key = key
+        self.fd = fd # locked file descriptor (with lock_files)
+        self.released = False
+        self.held_until_response = False # taken by lock_middleware, which releases it (see releaseRequestLock)
+
+
+class LockManager(object):
+    """
+    Keyed locks, with a timeout and wait metrics.
+    """
+
+    def __init__(self, timeout = 30, lock_path = None):
+        """
+        LockManager constructor.
+
+        @type timeout: float
+        @param timeout: Max number of seconds to wait for a lock.
+        @type lock_path: str
+        @param lock_path: If set, the directory of the lock files (for locking across processes).
+        """
+        self.timeout = timeout
+        self.lock_path = lock_path
+        if lock_path:
+            assert fcntl is not None, 'lock_files requires fcntl'
+            if not os.path.exists(lock_path):
+                try:
+                    os.makedirs(lock_path)
+                except OSError:
+                    pass # created concurrently
+        self.cond = threading.Condition(threading.Lock())
+        self.held = set() # keys of the locks held in this process
+        self.stats = { 'acquired' : 0, 'contended' : 0, 'timeouts' : 0, 'total_wait' : 0.0, 'max_wait' : 0.0 }
+
+    def acquire(self, key):
+        """
+        Waits for the lock of a key (at most timeout seconds).
+
+        @type key: str
+        @param key: Lock key.
+        @return: LockHandle, to be passed to release.
+        @raise Exception: 'session_locked' if the lock could not be acquired in time.
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        with self.cond:
+            contended = key in self.held
+            while key in self.held:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.recordWait(start, contended, False)
+                    raise Exception('session_locked')
+                self.cond.wait(remaining)
+            self.held.add(key)
+        fd = None
+        if self.lock_path:
+            try:
+                fd, file_contended = self.acquireFile(key, deadline)
+                contended = contended or file_contended
+            except Exception:
+                with self.cond:
+                    self.held.discard(key)
+                    self.cond.notify_all()
+                    self.recordWait(start, True, False)
+                raise Exception('session_locked')
+        with self.cond:
+            self.recordWait(start, contended, True)
+        return LockHandle(key, fd)
+
+    def acquireFile(self, key, deadline):
+        """
+        Takes the (exclusive) lock of the file of a key, polling until the deadline. The janitor
+        removes the lock files unused for long (see removeLockFile): a lock taken on a file that
+        has been removed in the meantime is dropped, and taken again on the new file.
+
+        @return: (fd, contended) pair.
+        """
+        filepath = os.path.join(self.lock_path, '%s.lock' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+        fd = os.open(filepath, os.O_CREAT | os.O_RDWR)
+        contended = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                try:
+                    same_file = os.path.samestat(os.fstat(fd), os.stat(filepath))
+                except OSError:
+                    same_file = False
+                if same_file:
+                    os.utime(filepath, None) # last use (see removeLockFile)
+                    return fd, contended
+                os.close(fd) # removed by the janitor
+                fd = os.open(filepath, os.O_CREAT | os.O_RDWR)
+                continue
+            except (IOError, OSError):
+                contended = True
+                if time.time() >= deadline:
+                    os.close(fd)
+                    raise
+                time.sleep(0.01)
+
+    def release(self, handle):
+        """
+        Releases a lock (releasing it again has no effect).
+
+        @type handle: LockHandle
+        @param handle: The handle returned by acquire.
+        """
+        if handle.released:
+            return
+        handle.released = True
+        if handle.fd is not None:
+            fcntl.flock(handle.fd, fcntl.LOCK_UN)
+            os.close(handle.fd)
+        with self.cond:
+            self.held.discard(handle.key)
+            self.cond.notify_all()
+
+    def recordWait(self, start, contended, acquired):
+        """
+        Updates the wait metrics (called with the condition held).
+        """
+        wait = time.time() - start
+        if acquired:
+            self.stats['acquired'] += 1
+        else:
+            self.stats['timeouts'] += 1
+        if contended:
+            self.stats['contended'] += 1
+        self.stats['total_wait'] += wait
+        self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+
+    def getStats(self):
+        """
+        @return: Lock wait metrics of this process: {acquired, contended, timeouts, total_wait, max_wait, avg_wait} (times in seconds).
+        """
+        with self.cond:
+            stats = dict(self.stats)
+            stats['held'] = len(self.held)
+        n = stats['acquired'] + stats['timeouts']
+        stats['avg_wait'] = stats['total_wait'] / n if n else 0.0
+        return stats
+
+
+def lock_middleware(lock_manager, session_cookie = None):
+    """
+    WSGI middleware factory (used like the Pesto ones: lock_middleware(..)(app)). The
+    session lock taken by beginDracones is normally released by endDracones, but a
+    request can end without reaching it (error, extension route that only calls
+    beginDracones, etc.): the lock still held by a request (the "dracones.lock" item
+    of its environ) is released once its response is produced, whatever the way the
+    request ended.
+
+    With a session cookie name (see getSessionCookie), the middleware also takes the
+    lock of the session of the request itself, before calling the wrapped application
+    (which must be the Pesto session middleware), and holds it until the response is
+    produced: it is then held while the session is loaded and saved.
+
+    @type lock_manager: LockManager
+    @param lock_manager: The lock manager of the web interface.
+    @type session_cookie: str
+    @param session_cookie: If set, the name of the session cookie on which the lock is taken.
+    @return: A function wrapping a WSGI application.
+    """
+
+    def middleware(app):
+
+        def lock_app(environ, start_response):
+            if session_cookie:
+                cookie = SimpleCookie()
+                try:
+                    cookie.load(environ.get('HTTP_COOKIE', ''))
+                except Exception:
+                    pass # malformed: treated as a new session
+                if session_cookie in cookie and cookie[session_cookie].value:
+                    try:
+                        handle = lock_manager.acquire(cookie[session_cookie].value)
+                    except Exception:
+                        start_response('503 Service Unavailable', [('Content-Type', 'application/json'), ('Retry-After', '1')])
+                        return [json.dumps({'success': False, 'error': 'session_locked',
+                                            'error_msg': 'Session is busy with another request'}).encode('utf-8')]
+                    handle.held_until_response = True
+                    environ['dracones.lock'] = handle
+            try:
+                result = app(environ, start_response)
+                try:
+                    return list(result)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            finally:
+                handle = environ.get('dracones.lock')
+                if handle is not None:
+                    lock_manager.release(handle)
+
+        return lock_app
+
+    return middleware
+
+
+def removeLockFile(filepath):
+    """
+    Removes a lock file (used by the janitor), unless its lock is held. The file is removed while
+    its lock is taken, so that a request waiting for it takes it again on a new file (see
+    LockManager.acquireFile).
+
+    @type filepath: str
+    @param filepath: Path of the lock file.
+    @return: True if the file was removed.
+    """
+    try:
+        fd = os.open(filepath, os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False # in use
+        try:
+            os.remove(filepath)
+            return True
+        except OSError:
+            return False
+    finally:
+        os.close(fd)
+
+
+def getLockKey(dconf, session_id, mid):
+    """
+    @return: The lock key of a map widget state, according to lock_scope (None if there is no locking,
+             or if the lock is taken by lock_middleware, with the "pesto" session store).
+    """
+    if dconf.get('session_store', 'pesto') == 'pesto':
+        return None
+    scope = dconf.get('lock_scope', 'mid')
+    if scope == 'none':
+        return None
+    elif scope == 'session':
+        return str(session_id)
+    elif scope == 'mid':
+        return '%s/%s' % (session_id, mid)
+    else:
+        assert False, "Unknown lock_scope: '%s'" % scope
+
+
+def getSessionCookie(dconf):
+    """
+    @return: The name of the session cookie on which lock_middleware takes the lock (with the
+             "pesto" session store), or None.
+    """
+    if dconf.get('session_store', 'pesto') != 'pesto' or dconf.get('lock_scope', 'mid') == 'none':
+        return None
+    return dconf.get('session_cookie', 'pesto_session')
+
+
+def createLockManager(dconf):
+    """
+    Instantiates the lock manager configured in the config.
+
+    @type dconf: dict
+    @param dconf: The Dracones config dict (see conf.py).
+    @return: A LockManager instance.
+    """
+    lock_path = os.path.join(dconf['session_path'], 'dracones_locks') if dconf.get('lock_files', False) else None
+    return LockManager(dconf.get('lock_timeout', 30), lock_path)
@@ -0,0 +1,166 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Speculative background rendering. After a pan or a zoom, the next request of
+a map widget is quite predictable (another pan in the same direction, or the
+reverse zoom, back to the previous extent), so its image can be rendered in
+advance by a worker thread, and put in the render cache (or the tile cache, in
+tiled mode), where the follow-up request will find it instead of blocking on a
+draw.
+
+It is disabled unless "prefetch_workers" (size of the worker pool) is set in
+conf.json. The "prefetch_max_per_session" option (2 by default) limits the
+number of pending jobs of a session, and "prefetch_queue_size" (16 by default)
+the total number of pending jobs, so that prefetching never piles up in front
+of the interactive requests. Note that this requires a thread-safe build of
+MapServer/mapscript.
+"""
+
+import copy, sys, threading, traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from dracones.core import *
+
+
+class SessionSnapshot(dict):
+    """
+    Minimal stand-in for the session object, holding a frozen copy of a single
+    mid state, on which a DMap can be built outside of the request.
+    """
+
+    def __init__(self, session_id, mid, sess_mid):
+        dict.__init__(self)
+        self.session_id = session_id
+        self.is_new = False
+        self[mid] = sess_mid
+
+
+class Prefetcher(object):
+    """
+    Worker pool that renders the predicted next images of the map widgets.
+    """
+
+    def __init__(self, n_workers, max_per_session = 2, queue_size = 16):
+        """
+        Prefetcher constructor.
+
+        @type n_workers: int
+        @param n_workers: Number of worker threads (started on the first schedule call).
+        @type max_per_session: int
+        @param max_per_session: Max number of pending jobs per session.
+        @type queue_size: int
+        @param queue_size: Max number of pending jobs overall (jobs beyond that are dropped).
+        """
+        self.n_workers = n_workers
+        self.max_per_session = max_per_session
+        self.jobs = queue.Queue(queue_size)
+        self.pending = {} # session_id -> nb of pending jobs
+        self.generations = {} # (session_id, mid) -> generation of the latest scheduled state
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def start(self):
+        """
+        Starts the worker threads (as daemons, so that they never block the process exit).
+        """
+        self.lock.acquire()
+        try:
+            while len(self.workers) < self.n_workers:
+                worker = threading.Thread(target=self.work, name='dracones-prefetch-%d' % len(self.workers))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            self.lock.release()
+
+    def schedule(self, dmap, moves):
+        """
+        Schedules the rendering of the images that would result from applying some moves
+        to the current (just saved) state of a dmap. Any job still pending for a previous
+        state of the same mid becomes obsolete, and is skipped.
+
+        @type dmap: DMap
+        @param dmap: The dmap of the request, after its state has been saved.
+        @type moves: list
+        @param moves: List of (method name, args..) tuples, applied to a new DMap (e.g. ('pan', 'right'), or
+                      ('setExtentFromDict', extent)).
+        """
+        if not self.n_workers or not moves:
+            return
+        if not dmap.isTiled() and not render_cache.max_bytes:
+            return # the rendered image would have nowhere to go
+        if not self.workers:
+            self.start()
+        session_id = dmap.sess.session_id
+        key = (session_id, dmap.mid)
+        sess_mid = dict(dmap.sess_mid)
+        # only the current history cell is needed to rebuild the map
+        sess_mid['history'] = [copy.deepcopy(dmap.getHistoryCell())]
+        sess_mid['history_size'] = 1
+        sess_mid['history_head'] = 0
+        sess_mid['history_idx'] = 0
+        self.lock.acquire()
+        try:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+            for move in moves:
+                if self.pending.get(session_id, 0) >= self.max_per_session:
+                    break
+                try:
+                    self.jobs.put_nowait((key, generation, sess_mid, move))
+                except queue.Full:
+                    break
+                self.pending[session_id] = self.pending.get(session_id, 0) + 1
+        finally:
+            self.lock.release()
+
+    def work(self):
+        """
+        Worker thread loop.
+        """
+        while True:
+            key, generation, sess_mid, move = self.jobs.get()
+            try:
+                if self.generations.get(key) == generation:
+                    self.render(key[0], key[1], sess_mid, move)
+            except Exception:
+                # a failed prediction only means that the next request will render itself, but it is
+                # reported on stderr (i.e. in the server error log), as the request is not there to get it
+                sys.stderr.write('dracones prefetch %s %s failed:\n%s' % (key[1], move, traceback.format_exc()))
+            finally:
+                self.lock.acquire()
+                try:
+                    self.pending[key[0]] -= 1
+                    if not self.pending[key[0]]:
+                        # nothing left for this session: forget its generations
+                        del self.pending[key[0]]
+                        for k in [k for k in self.generations if k[0] == key[0]]:
+                            del self.generations[k]
+                finally:
+                    self.lock.release()
+
+    def render(self, session_id, mid, sess_mid, move):
+        """
+        Rebuilds the map the same way beginDracones does, applies the move, and renders it
+        into the render cache (or the tile cache).
+        """
+        dmap = DMap(SessionSnapshot(session_id, mid, sess_mid), mid)
+        dmap.restoreStateFromSession()
+        dmap.addDLayerFeatures()
+        getattr(dmap, move[0])(*move[1:])
+        if dmap.isTiled():
+            dmap.getTiles()
+        elif render_cache.max_bytes and dmap.getStateHash() not in render_cache:
+            dmap.renderImage()
+
+
+prefetcher = Prefetcher(dconf.get('prefetch_workers', 0), dconf.get('prefetch_max_per_session', 2),
+                        dconf.get('prefetch_queue_size', 16))
+"""Per-process prefetcher (inactive if prefetch_workers is 0)."""
@@ -0,0 +1,135 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Storage of the selected and filtered item IDs of the dlayers: an ordered set,
+for the selections (constant time membership tests and toggles), and a compact
+run-length encoding of the ID lists, for their session (history) persistence.
+
+Item IDs are very often shape indices or numeric keys, selected by ranges (a box
+select returns its results in shape order): such a list of numeric strings is
+stored as runs of consecutive values (start, length), which preserves its order,
+instead of one string per item. Lists that do not compress (non numeric IDs, or
+fewer than "selection_rle_min_size" items) are stored as is.
+"""
+
+import re
+from collections import OrderedDict
+
+
+class OrderedSet(object):
+    """
+    Set of item IDs that remembers their insertion order (in which they are drawn,
+    and returned to the client).
+    """
+
+    def __init__(self, elements = ()):
+        """
+        @type elements: iterable
+        @param elements: Initial elements (duplicates are ignored).
+        """
+        self.elements = OrderedDict()
+        for element in elements:
+            self.elements[element] = None
+
+    def __contains__(self, element):
+        return element in self.elements
+
+    def __iter__(self):
+        return iter(self.elements)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __getitem__(self, i):
+        return list(self.elements)[i]
+
+    def __eq__(self, other):
+        if isinstance(other, OrderedSet):
+            other = other.elements
+        return list(self.elements) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'OrderedSet(%r)' % list(self.elements)
+
+    def add(self, element):
+        self.elements[element] = None
+
+    def extend(self, elements):
+        for element in elements:
+            self.elements[element] = None
+
+    def discard(self, element):
+        self.elements.pop(element, None)
+
+    def remove(self, element):
+        del self.elements[element]
+
+    def toggle(self, element):
+        """
+        Adds the element if it is not in the set, removes it otherwise.
+        """
+        if element in self.elements:
+            del self.elements[element]
+        else:
+            self.elements[element] = None
+
+    def clear(self):
+        self.elements.clear()
+
+
+_canonical_int_re = re.compile(r'^(0|-?[1-9][0-9]*)\Z') # \Z: '$' would also match before a trailing newline
+
+
+def encodeIDs(elements, min_size = 64):
+    """
+    Encodes a list of item IDs for the session: when all of them are canonical integer
+    strings, and there are at least min_size of them forming long enough runs of
+    consecutive values, as {'rle': [start, length, start, length, ..]}, and otherwise
+    as a plain list.
+
+    @type elements: iterable
+    @param elements: Item IDs.
+    @type min_size: int
+    @param min_size: Minimum number of IDs for the encoding to be tried.
+    @return: The encoded IDs (see decodeIDs).
+    """
+    elements = list(elements)
+    if len(elements) < min_size:
+        return elements
+    runs = []
+    prev = None
+    for element in elements:
+        if not isinstance(element, str) or not _canonical_int_re.match(element):
+            return elements
+        value = int(element)
+        if prev is not None and value == prev + 1:
+            runs[-1] += 1
+        else:
+            runs.extend([value, 1])
+        prev = value
+    if len(runs) > len(elements): # mostly isolated values: no gain
+        return elements
+    return { 'rle' : runs }
+
+
+def decodeIDs(encoded):
+    """
+    @type encoded: list or dict
+    @param encoded: Item IDs, as returned by encodeIDs.
+    @return: A new list of the item IDs.
+    """
+    if isinstance(encoded, dict):
+        runs = encoded['rle']
+        elements = []
+        for i in range(0, len(runs), 2):
+            elements.extend([str(value) for value in range(runs[i], runs[i] + runs[i + 1])])
+        return elements
+    return list(encoded)
@@ -0,0 +1,323 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Dracones session storage. The Pesto session is still used to identify the
+browser session (cookie), but the state of every map widget (mid) can be
+stored separately, so that a request only reads and writes the state of its
+own widget, instead of the whole session pickle. The backend is selected with
+the "session_store" option of conf.json:
+
+  - "pesto" (default): everything is kept in the Pesto session, as before.
+  - "file": one pickle file per mid, in <session_path>/dracones_mids/<session_id>/.
+  - "sqlite": one row per mid, in the <session_path>/dracones_mids.sqlite database (WAL mode).
+"""
+
+import os, re, time, threading, sqlite3
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class DraconesSession(object):
+    """
+    Session object used by the Dracones components (DMap, web interface), in place of
+    the Pesto session. It behaves like a dict of mid -> state, whose items are loaded
+    from the store on first access, and written back (only those) by save.
+    """
+
+    def __init__(self, pesto_session, store):
+        """
+        DraconesSession constructor.
+
+        @param pesto_session: Pesto session object (identifies the browser session).
+        @type store: SessionStore
+        @param store: The backend in which the mid states are kept.
+        """
+        self.pesto_session = pesto_session
+        self.store = store
+        self.session_id = pesto_session.session_id
+        self.is_new = pesto_session.is_new
+        self.states = {} #: mid -> state, for the mids loaded or set in this request.
+
+    def __getitem__(self, mid):
+        if mid not in self.states:
+            state = self.store.load(self.pesto_session, mid)
+            if state is None:
+                raise KeyError(mid)
+            self.states[mid] = state
+        return self.states[mid]
+
+    def __setitem__(self, mid, state):
+        self.states[mid] = state
+
+    def __contains__(self, mid):
+        try:
+            self[mid]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, mid, default = None):
+        try:
+            return self[mid]
+        except KeyError:
+            return default
+
+    def save(self):
+        """
+        Writes back the states of the mids that were accessed in this request.
+        """
+        for mid, state in self.states.items():
+            self.store.save(self.pesto_session, mid, state)
+        self.store.commit(self.pesto_session)
+
+
+class SessionStore(object):
+    """
+    Base class of the mid state storage backends. A backend defines:
+
+      - load(pesto_session, mid): returns the stored state (dict) of the mid, or None if there is none.
+      - save(pesto_session, mid, state): stores the state of the mid.
+
+    The other methods (listSessions, removeSession, commit) have defaults, overridden as needed.
+    """
+
+    def listSessions(self):
+        """
+        Used by the janitor (see dracones.janitor).
+
+        @return: dict: session_id -> (last modification time, size in bytes) of the mid states stored
+                 outside the Pesto session (empty for the Pesto backend).
+        """
+        return {}
+
+    def removeSession(self, session_id):
+        """
+        Removes all the mid states of a session (used by the janitor).
+
+        @type session_id: str
+        @param session_id: Session ID.
+        @return: (nb of files, nb of bytes) reclaimed.
+        """
+        return (0, 0)
+
+    def commit(self, pesto_session):
+        """
+        Called once all the states of a request have been saved. The granular backends
+        store a marker in the (otherwise empty) Pesto session, so that it gets persisted,
+        and is not considered new (i.e. expired) by the following requests.
+
+        @param pesto_session: Pesto session object.
+        """
+        if pesto_session.is_new or 'dracones' not in pesto_session:
+            pesto_session['dracones'] = True
+            pesto_session.save()
+
+
+class PestoSessionStore(SessionStore):
+    """
+    The mid states are kept in the Pesto session itself (the whole session is
+    pickled in a single file, rewritten on every save).
+    """
+
+    def load(self, pesto_session, mid):
+        return pesto_session.get(mid, None)
+
+    def save(self, pesto_session, mid, state):
+        pesto_session[mid] = state
+
+    def commit(self, pesto_session):
+        pesto_session.save()
+
+
+class FileSessionStore(SessionStore):
+    """
+    One pickle file per mid, in a directory per session: <path>/<session_id>/<mid>.pickle
+    """
+
+    def __init__(self, path):
+        """
+        @type path: str
+        @param path: Root directory of the session directories.
+        """
+        self.path = os.path.abspath(path)
+
+    def getFilepath(self, session_id, mid):
+        """
+        @return: The pickle file path of a given session/mid.
+        """
+        return os.path.join(self.path, safeFilename(session_id), '%s.pickle' % safeFilename(mid))
+
+    def load(self, pesto_session, mid):
+        filepath = self.getFilepath(pesto_session.session_id, mid)
+        try:
+            f = open(filepath, 'rb')
+        except IOError:
+            return None
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+    def save(self, pesto_session, mid, state):
+        filepath = self.getFilepath(pesto_session.session_id, mid)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            try:
+                os.makedirs(os.path.dirname(filepath))
+            except OSError:
+                pass # created concurrently
+        # write then rename, so that a concurrent load never sees a partial file
+        tmp_filepath = '%s.%s.%s.tmp' % (filepath, os.getpid(), threading.current_thread().ident)
+        f = open(tmp_filepath, 'wb')
+        try:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        replaceFile(tmp_filepath, filepath)
+
+    def listSessions(self):
+        sessions = {}
+        if not os.path.isdir(self.path):
+            return sessions
+        for session_dir in os.listdir(self.path):
+            mtime, n_bytes = 0, 0
+            dirpath = os.path.join(self.path, session_dir)
+            try:
+                for fn in os.listdir(dirpath):
+                    st = os.stat(os.path.join(dirpath, fn))
+                    mtime = max(mtime, st.st_mtime)
+                    n_bytes += st.st_size
+                mtime = max(mtime, os.stat(dirpath).st_mtime)
+            except OSError:
+                continue # removed concurrently
+            sessions[session_dir] = (mtime, n_bytes)
+        return sessions
+
+    def removeSession(self, session_id):
+        n_files, n_bytes = 0, 0
+        dirpath = os.path.join(self.path, safeFilename(session_id))
+        try:
+            filenames = os.listdir(dirpath)
+        except OSError:
+            return (0, 0)
+        for fn in filenames:
+            filepath = os.path.join(dirpath, fn)
+            try:
+                size = os.stat(filepath).st_size
+                os.remove(filepath)
+            except OSError:
+                continue
+            n_files += 1
+            n_bytes += size
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass # not empty: a state was saved concurrently
+        return (n_files, n_bytes)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    One row per mid, in a SQLite database in WAL mode (readers are not blocked by
+    writers, and a save only rewrites the pages of its own row).
+    """
+
+    def __init__(self, filename, timeout = 30):
+        """
+        @type filename: str
+        @param filename: Path of the SQLite database file (created if needed).
+        @type timeout: float
+        @param timeout: How long to wait for a concurrent write lock, in seconds.
+        """
+        self.filename = os.path.abspath(filename)
+        self.timeout = timeout
+        self.local = threading.local() # SQLite connections cannot be shared by threads
+
+    def getConnection(self):
+        """
+        @return: The SQLite connection of the current thread (opened if needed).
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS mid_state (session_id TEXT NOT NULL, mid TEXT NOT NULL, '
+                         'mtime REAL NOT NULL, state BLOB NOT NULL, PRIMARY KEY (session_id, mid))')
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def load(self, pesto_session, mid):
+        row = self.getConnection().execute('SELECT state FROM mid_state WHERE session_id = ? AND mid = ?',
+                                           (pesto_session.session_id, mid)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def save(self, pesto_session, mid, state):
+        conn = self.getConnection()
+        conn.execute('INSERT OR REPLACE INTO mid_state (session_id, mid, mtime, state) VALUES (?, ?, ?, ?)',
+                     (pesto_session.session_id, mid, time.time(),
+                      sqlite3.Binary(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))))
+        conn.commit()
+
+    def listSessions(self):
+        rows = self.getConnection().execute('SELECT session_id, MAX(mtime), SUM(LENGTH(state)) FROM mid_state '
+                                            'GROUP BY session_id').fetchall()
+        return dict([(row[0], (row[1], row[2])) for row in rows])
+
+    def removeSession(self, session_id):
+        conn = self.getConnection()
+        row = conn.execute('SELECT COUNT(*), SUM(LENGTH(state)) FROM mid_state WHERE session_id = ?',
+                           (session_id,)).fetchone()
+        conn.execute('DELETE FROM mid_state WHERE session_id = ?', (session_id,))
+        conn.commit()
+        return (row[0], row[1] or 0)
+
+
+def safeFilename(s):
+    """
+    @return: The string, with every character that is not allowed in a file name replaced by '_'.
+    """
+    return re.sub(r'[^\w\-.]', '_', str(s)).lstrip('.')
+
+
+def replaceFile(src, dst):
+    """
+    Atomic rename of src to dst, replacing dst if it exists (also on Windows).
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # Windows/Python 2: rename does not overwrite
+            os.remove(dst)
+            os.rename(src, dst)
+
+
+def createSessionStore(dconf):
+    """
+    Instantiates the session store backend selected in the config.
+
+    @type dconf: dict
+    @param dconf: The Dracones config dict (see conf.py).
+    @return: A SessionStore instance.
+    """
+    store_type = dconf.get('session_store', 'pesto')
+    if store_type == 'pesto':
+        return PestoSessionStore()
+    elif store_type == 'file':
+        return FileSessionStore(os.path.join(dconf['session_path'], 'dracones_mids'))
+    elif store_type == 'sqlite':
+        return SQLiteSessionStore(os.path.join(dconf['session_path'], 'dracones_mids.sqlite'))
+    else:
+        assert False, "Unknown session_store: '%s'" % store_type
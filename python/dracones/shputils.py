@@ -0,0 +1,443 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+Direct access to the shapefile data of the MS layers, to avoid the full scans
+that MapServer performs on attribute queries and expression evaluation: a pure
+Python DBF reader, a per-attribute index (value -> shape indices), built once
+per DBF file and rebuilt whenever its modification time changes, and subset
+shapefiles (copies of a set of shapes), that MS layers can read instead of the
+whole file. Shapefiles can also be written from the geometries of the user
+features (see dracones.spatial), so that the inline feature layers are read
+from a compiled file, instead of being rebuilt shape by shape.
+"""
+
+import os, re, struct, threading, hashlib, time
+from dracones.session_store import replaceFile
+
+
+SHPT_NULL = 0
+SHPT_POINT = 1
+SHPT_ARC = 3
+SHPT_POLYGON = 5
+
+
+def decodeValue(raw):
+    """
+    @return: A DBF value as a (native) string.
+    """
+    if bytes is str: # Python 2
+        return raw
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+
+def getShapefileBasePath(map_obj, ms_layer):
+    """
+    Resolves the shapefile of a MS layer the way MapServer does (DATA relative to
+    SHAPEPATH, itself relative to the mapfile directory).
+
+    @type map_obj: mapscript.mapObj
+    @param map_obj: The map containing the layer.
+    @type ms_layer: mapscript.layerObj
+    @param ms_layer: A shapefile layer.
+    @return: Absolute shapefile path, without extension, or None if the layer uses a tile index.
+    """
+    if ms_layer.tileindex or not ms_layer.data:
+        return None
+    path = ms_layer.data
+    if not os.path.isabs(path):
+        shapepath = map_obj.shapepath or ''
+        if not os.path.isabs(shapepath):
+            shapepath = os.path.join(map_obj.mappath or '', shapepath)
+        path = os.path.join(shapepath, path)
+    return re.sub(r'\.shp$', '', os.path.abspath(path), flags=re.IGNORECASE)
+
+
+class DBFReader(object):
+    """
+    Minimal dBase III reader (the attribute part of a shapefile). Values are returned
+    as strings, trimmed the same way MapServer does.
+    """
+
+    def __init__(self, filename):
+        """
+        @type filename: str
+        @param filename: Path of the .dbf file.
+        """
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            header = f.read(32)
+            self.n_records, self.header_length, self.record_length = struct.unpack('<IHH', header[4:12])
+            self.fields = [] # [(name, type, offset, length)]
+            offset = 1 # deletion flag
+            while True:
+                descriptor = f.read(32)
+                if len(descriptor) < 32 or descriptor[0:1] == b'\r':
+                    break
+                name = decodeValue(descriptor[:11].split(b'\0')[0])
+                field_type = decodeValue(descriptor[11:12])
+                length = struct.unpack('<B', descriptor[16:17])[0]
+                self.fields.append((name, field_type, offset, length))
+                offset += length
+        finally:
+            f.close()
+
+    def getFieldNames(self):
+        """
+        @return: The list of field names (in DBF order).
+        """
+        return [field[0] for field in self.fields]
+
+    def getFieldIndex(self, name):
+        """
+        @return: The index of a field (case insensitive), or None if the field does not exist.
+        """
+        for i, field in enumerate(self.fields):
+            if field[0].lower() == name.lower():
+                return i
+        return None
+
+    def parseValue(self, record, field):
+        value = decodeValue(record[field[2]:field[2] + field[3]])
+        if field[1] in ('N', 'F'):
+            return value.strip()
+        return value.rstrip()
+
+    def iterFieldValues(self, field_index):
+        """
+        Sequential scan of a single field.
+
+        @return: Iterator over the values of the field, in record (i.e. shape) order.
+        """
+        field = self.fields[field_index]
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(self.header_length)
+            for i in range(self.n_records):
+                record = f.read(self.record_length)
+                if len(record) < self.record_length:
+                    break
+                yield self.parseValue(record, field)
+        finally:
+            f.close()
+
+    def getRecords(self, indices):
+        """
+        Random access to a set of records.
+
+        @type indices: list
+        @param indices: Record (i.e. shape) indices.
+        @return: List of value lists (in DBF field order), one per index.
+        """
+        records = []
+        f = open(self.filename, 'rb')
+        try:
+            for i in indices:
+                f.seek(self.header_length + i * self.record_length)
+                record = f.read(self.record_length)
+                records.append([self.parseValue(record, field) for field in self.fields])
+        finally:
+            f.close()
+        return records
+
+
+class AttributeIndex(object):
+    """
+    Maps the values of a DBF field to the indices of the shapes having them.
+    """
+
+    def __init__(self, dbf, field_index):
+        """
+        @type dbf: DBFReader
+        @param dbf: The DBF of the shapefile.
+        @type field_index: int
+        @param field_index: The indexed field.
+        """
+        self.dbf = dbf
+        self.values = {} # value -> [shape indices]
+        for i, value in enumerate(dbf.iterFieldValues(field_index)):
+            self.values.setdefault(value, []).append(i)
+
+    def lookup(self, values):
+        """
+        @type values: list
+        @param values: Attribute values.
+        @return: Sorted list of the indices of the shapes having one of the values.
+        """
+        indices = set()
+        for value in values:
+            indices.update(self.values.get(value, []))
+        return sorted(indices)
+
+
+_attribute_indices = {} # (dbf path, field name) -> (mtime, AttributeIndex)
+_attribute_indices_lock = threading.Lock()
+
+
+def getAttributeIndex(shapefile, attr):
+    """
+    Returns the (cached) index of a shapefile attribute.
+
+    @type shapefile: str
+    @param shapefile: Shapefile path, without extension.
+    @type attr: str
+    @param attr: Name of the indexed attribute (case insensitive).
+    @return: An AttributeIndex, or None if the DBF or the attribute does not exist.
+    """
+    dbf_filename = shapefile + '.dbf'
+    try:
+        mtime = os.path.getmtime(dbf_filename)
+    except OSError:
+        return None
+    key = (dbf_filename, attr.lower())
+    _attribute_indices_lock.acquire()
+    try:
+        entry = _attribute_indices.get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+    finally:
+        _attribute_indices_lock.release()
+    # built outside of the lock: concurrent builds of the same index are harmless
+    dbf = DBFReader(dbf_filename)
+    field_index = dbf.getFieldIndex(attr)
+    if field_index is None:
+        return None
+    index = AttributeIndex(dbf, field_index)
+    _attribute_indices_lock.acquire()
+    try:
+        _attribute_indices[key] = (mtime, index)
+    finally:
+        _attribute_indices_lock.release()
+    return index
+
+
+def writeSubset(shapefile, indices, out_shapefile):
+    """
+    Writes a shapefile made of a subset of the shapes of another one (and of their DBF
+    records), by copying the raw records: shape i of the subset is shape indices[i]
+    of the source.
+
+    @type shapefile: str
+    @param shapefile: Source shapefile path, without extension.
+    @type indices: list
+    @param indices: Indices of the copied shapes.
+    @type out_shapefile: str
+    @param out_shapefile: Path of the written shapefile, without extension.
+    """
+    # .shx: 100 bytes header, followed by (offset, length) pairs, in 16-bit words (big endian)
+    f = open(shapefile + '.shx', 'rb')
+    try:
+        shx_header = f.read(100)
+        offsets = []
+        for i in indices:
+            f.seek(100 + i * 8)
+            offsets.append(struct.unpack('>ii', f.read(8)))
+    finally:
+        f.close()
+    shp_out = open(out_shapefile + '.shp', 'wb')
+    shx_out = open(out_shapefile + '.shx', 'wb')
+    f = open(shapefile + '.shp', 'rb')
+    try:
+        shp_out.write(shx_header) # same header, except for the file length (patched below)
+        shx_out.write(shx_header[:24] + struct.pack('>i', 50 + 4 * len(indices)) + shx_header[28:])
+        offset = 50
+        for n, (src_offset, length) in enumerate(offsets):
+            f.seek(src_offset * 2 + 8)
+            shp_out.write(struct.pack('>ii', n + 1, length) + f.read(length * 2))
+            shx_out.write(struct.pack('>ii', offset, length))
+            offset += 4 + length
+        shp_out.seek(24)
+        shp_out.write(struct.pack('>i', offset))
+    finally:
+        f.close()
+        shp_out.close()
+        shx_out.close()
+    dbf = DBFReader(shapefile + '.dbf')
+    dbf_out = open(out_shapefile + '.dbf', 'wb')
+    f = open(shapefile + '.dbf', 'rb')
+    try:
+        header = f.read(dbf.header_length)
+        dbf_out.write(header[:4] + struct.pack('<I', len(indices)) + header[8:])
+        for i in indices:
+            f.seek(dbf.header_length + i * dbf.record_length)
+            dbf_out.write(f.read(dbf.record_length))
+        dbf_out.write(b'\x1a')
+    finally:
+        f.close()
+        dbf_out.close()
+
+
+def getSubsetShapefile(shapefile, indices, cache_path):
+    """
+    Returns a (cached) subset shapefile (see writeSubset). Subsets are identified by
+    their source (and its modification time) and shape indices, and are written once
+    in cache_path.
+
+    @type shapefile: str
+    @param shapefile: Source shapefile path, without extension.
+    @type indices: list
+    @param indices: Indices of the shapes (sorted).
+    @type cache_path: str
+    @param cache_path: Directory of the subset shapefiles.
+    @return: Path of the subset shapefile, without extension.
+    """
+    key = '%s|%s|%s' % (shapefile, os.path.getmtime(shapefile + '.shp'), ','.join([str(i) for i in indices]))
+    out_shapefile = os.path.join(os.path.abspath(cache_path), hashlib.sha1(key.encode('utf-8')).hexdigest())
+    if os.path.exists(out_shapefile + '.shp'):
+        try:
+            for ext in ('.dbf', '.shx', '.shp'):
+                os.utime(out_shapefile + ext, None) # keeps it from being cleaned up while in use (see dracones.janitor)
+            return out_shapefile
+        except OSError:
+            pass # partially cleaned up: written again below
+    if not os.path.isdir(os.path.abspath(cache_path)):
+        try:
+            os.makedirs(os.path.abspath(cache_path))
+        except OSError:
+            pass # created concurrently
+    # written under a temporary name, the .shp being renamed last, so that its
+    # existence means that the subset is complete
+    tmp_shapefile = '%s_%s_%s' % (out_shapefile, os.getpid(), threading.current_thread().ident)
+    writeSubset(shapefile, indices, tmp_shapefile)
+    for ext in ('.dbf', '.shx', '.shp'):
+        replaceFile(tmp_shapefile + ext, out_shapefile + ext)
+    return out_shapefile
+
+
+def geometryParts(geom):
+    """
+    @type geom: tuple
+    @param geom: Geometry tuple (see dracones.spatial), or None.
+    @return: List of parts (lists of (x, y) points) of the shape of a geometry: a circle is
+             described by the corners of its bounding box (as MapServer does), and polygon
+             rings are closed.
+    """
+    if geom is None:
+        return []
+    elif geom[0] == 'point':
+        return [[(geom[1], geom[2])]]
+    elif geom[0] == 'circle':
+        return [[(geom[1] - geom[3], geom[2] + geom[3]), (geom[1] + geom[3], geom[2] - geom[3])]]
+    elif geom[0] == 'polygon':
+        coords = list(geom[1])
+        if coords and coords[0] != coords[-1]:
+            coords.append(coords[0])
+        return [coords]
+    return [list(geom[1])]
+
+
+def writeShapefile(out_shapefile, shape_type, geometries, ids):
+    """
+    Writes a shapefile from geometry tuples (see dracones.spatial), with a single
+    DRC_ID attribute. Missing (None) or empty geometries are written as null shapes,
+    so that shape i is always geometries[i].
+
+    @type out_shapefile: str
+    @param out_shapefile: Path of the written shapefile, without extension.
+    @type shape_type: int
+    @param shape_type: SHPT_POINT, SHPT_ARC or SHPT_POLYGON.
+    @type geometries: list
+    @param geometries: Geometry tuples.
+    @type ids: list
+    @param ids: DRC_ID values (strings), one per geometry.
+    """
+    records = []
+    bounds = None
+    for geom in geometries:
+        parts = [part for part in geometryParts(geom) if part]
+        if not parts:
+            records.append(struct.pack('<i', SHPT_NULL))
+            continue
+        xs = [x for part in parts for x, y in part]
+        ys = [y for part in parts for x, y in part]
+        box = (min(xs), min(ys), max(xs), max(ys))
+        if bounds is None:
+            bounds = box
+        else:
+            bounds = (min(bounds[0], box[0]), min(bounds[1], box[1]), max(bounds[2], box[2]), max(bounds[3], box[3]))
+        if shape_type == SHPT_POINT:
+            records.append(struct.pack('<idd', SHPT_POINT, parts[0][0][0], parts[0][0][1]))
+            continue
+        starts = []
+        n_points = 0
+        for part in parts:
+            starts.append(n_points)
+            n_points += len(part)
+        points = [c for part in parts for xy in part for c in xy]
+        records.append(struct.pack('<i4d2i', shape_type, box[0], box[1], box[2], box[3], len(parts), n_points) +
+                       struct.pack('<%di' % len(parts), *starts) + struct.pack('<%dd' % len(points), *points))
+    bounds = bounds or (0.0, 0.0, 0.0, 0.0)
+    def header(file_length):
+        return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, file_length) + struct.pack('<2i', 1000, shape_type) +
+                struct.pack('<8d', bounds[0], bounds[1], bounds[2], bounds[3], 0, 0, 0, 0))
+    shp_out = open(out_shapefile + '.shp', 'wb')
+    shx_out = open(out_shapefile + '.shx', 'wb')
+    try:
+        shp_out.write(header(50 + sum([4 + len(r) // 2 for r in records])))
+        shx_out.write(header(50 + 4 * len(records)))
+        offset = 50
+        for n, record in enumerate(records):
+            shp_out.write(struct.pack('>ii', n + 1, len(record) // 2) + record)
+            shx_out.write(struct.pack('>ii', offset, len(record) // 2))
+            offset += 4 + len(record) // 2
+    finally:
+        shp_out.close()
+        shx_out.close()
+    ids = [str(i).encode('utf-8') for i in ids]
+    length = min(max([len(i) for i in ids] + [1]), 254)
+    today = time.localtime()
+    dbf_out = open(out_shapefile + '.dbf', 'wb')
+    try:
+        dbf_out.write(struct.pack('<4BIHH20x', 3, today.tm_year - 1900, today.tm_mon, today.tm_mday,
+                                  len(ids), 32 + 32 + 1, 1 + length))
+        dbf_out.write(struct.pack('<11sc4xBB14x', b'DRC_ID', b'C', length, 0) + b'\r')
+        for i in ids:
+            dbf_out.write(b' ' + i[:length].ljust(length))
+        dbf_out.write(b'\x1a')
+    finally:
+        dbf_out.close()
+
+
+def getFeatureShapefile(key, shape_type, getGeometries, cache_path):
+    """
+    Returns a (cached) shapefile of user features (see writeShapefile). As the features
+    of a given key never change, the shapefile is written once in cache_path.
+
+    @type key: str
+    @param key: Unique identifier of the features (e.g. a dlayer features revision).
+    @type shape_type: int
+    @param shape_type: SHPT_POINT, SHPT_ARC or SHPT_POLYGON.
+    @type getGeometries: function
+    @param getGeometries: Returns the (geometries, ids) pair of lists to write (only called
+                          if the shapefile does not exist yet).
+    @type cache_path: str
+    @param cache_path: Directory of the feature shapefiles.
+    @return: Path of the shapefile, without extension.
+    """
+    out_shapefile = os.path.join(os.path.abspath(cache_path), 'features_' + hashlib.sha1(key.encode('utf-8')).hexdigest())
+    if os.path.exists(out_shapefile + '.shp'):
+        try:
+            for ext in ('.dbf', '.shx', '.shp'):
+                os.utime(out_shapefile + ext, None) # see getSubsetShapefile
+            return out_shapefile
+        except OSError:
+            pass
+    if not os.path.isdir(os.path.abspath(cache_path)):
+        try:
+            os.makedirs(os.path.abspath(cache_path))
+        except OSError:
+            pass # created concurrently
+    geometries, ids = getGeometries()
+    tmp_shapefile = '%s_%s_%s' % (out_shapefile, os.getpid(), threading.current_thread().ident)
+    writeShapefile(tmp_shapefile, shape_type, geometries, ids)
+    for ext in ('.dbf', '.shx', '.shp'):
+        replaceFile(tmp_shapefile + ext, out_shapefile + ext)
+    return out_shapefile
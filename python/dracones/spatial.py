@@ -0,0 +1,219 @@
+#  Draoones Web-Mapping Framework
+#  ==============================
+#
+#  http://surveillance.mcgill.ca/dracones
+#  Copyright (c) 2009, Christian Jauvin
+#  All rights reserved. See LICENSE.txt for BSD license notice
+
+"""
+In-memory spatial index of the user-defined features (shapes) of the dlayers,
+answering the point and box selections in Python, instead of querying the
+inline features of the MS layer (which requires them to be all added first,
+and scans them all).
+
+The features are described by simple geometry tuples:
+
+  - ('point', x, y)
+  - ('circle', x, y, radius)
+  - ('line', [(x, y), ..])
+  - ('polygon', [(x, y), ..])
+
+and indexed by a uniform grid of their bounding boxes.
+"""
+
+import math
+
+
+MAX_CELLS_PER_ENTRY = 64
+"""Entries whose bounding box covers more grid cells are not put in the grid, but tested by every query."""
+
+
+def geometryBounds(geom):
+    """
+    @return: Bounding box of a geometry, as a (minx, miny, maxx, maxy) tuple.
+    """
+    if geom[0] == 'point':
+        return (geom[1], geom[2], geom[1], geom[2])
+    elif geom[0] == 'circle':
+        return (geom[1] - geom[3], geom[2] - geom[3], geom[1] + geom[3], geom[2] + geom[3])
+    xs = [xy[0] for xy in geom[1]]
+    ys = [xy[1] for xy in geom[1]]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def segmentDistance(x, y, x0, y0, x1, y1):
+    """
+    @return: Distance between point (x, y) and segment (x0, y0)-(x1, y1).
+    """
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    if length2:
+        t = max(0.0, min(1.0, ((x - x0) * dx + (y - y0) * dy) / length2))
+        x0, y0 = x0 + t * dx, y0 + t * dy
+    return math.hypot(x - x0, y - y0)
+
+
+def pointInRing(x, y, coords):
+    """
+    @return: Whether point (x, y) is inside a ring (even-odd rule).
+    """
+    inside = False
+    x0, y0 = coords[-1]
+    for x1, y1 in coords:
+        if (y1 > y) != (y0 > y) and x < (x0 - x1) * (y - y1) / (y0 - y1) + x1:
+            inside = not inside
+        x0, y0 = x1, y1
+    return inside
+
+
+def segmentsIntersect(a0, a1, b0, b1):
+    """
+    @return: Whether segments a0-a1 and b0-b1 intersect.
+    """
+    def orientation(p, q, r):
+        v = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (v > 0) - (v < 0)
+    def onSegment(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+    o1, o2 = orientation(a0, a1, b0), orientation(a0, a1, b1)
+    o3, o4 = orientation(b0, b1, a0), orientation(b0, b1, a1)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and onSegment(a0, a1, b0)) or (o2 == 0 and onSegment(a0, a1, b1)) or
+            (o3 == 0 and onSegment(b0, b1, a0)) or (o4 == 0 and onSegment(b0, b1, a1)))
+
+
+def geometryDistance(geom, x, y):
+    """
+    @return: Distance between a geometry and point (x, y) (0 inside a polygon or circle).
+    """
+    if geom[0] == 'point':
+        return math.hypot(x - geom[1], y - geom[2])
+    elif geom[0] == 'circle':
+        return max(0.0, math.hypot(x - geom[1], y - geom[2]) - geom[3])
+    coords = geom[1]
+    if geom[0] == 'polygon' and len(coords) >= 3 and pointInRing(x, y, coords):
+        return 0.0
+    if len(coords) == 1:
+        return math.hypot(x - coords[0][0], y - coords[0][1])
+    segments = list(zip(coords[:-1], coords[1:]))
+    if geom[0] == 'polygon':
+        segments.append((coords[-1], coords[0]))
+    return min([segmentDistance(x, y, p0[0], p0[1], p1[0], p1[1]) for p0, p1 in segments])
+
+
+def geometryIntersectsRect(geom, minx, miny, maxx, maxy):
+    """
+    @return: Whether a geometry intersects a rectangle.
+    """
+    if geom[0] == 'point':
+        return minx <= geom[1] <= maxx and miny <= geom[2] <= maxy
+    elif geom[0] == 'circle':
+        dx = geom[1] - max(minx, min(geom[1], maxx))
+        dy = geom[2] - max(miny, min(geom[2], maxy))
+        return dx * dx + dy * dy <= geom[3] * geom[3]
+    coords = geom[1]
+    for x, y in coords:
+        if minx <= x <= maxx and miny <= y <= maxy:
+            return True
+    corners = [(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)]
+    if geom[0] == 'polygon' and len(coords) >= 3 and pointInRing(minx, miny, coords):
+        return True # rectangle inside the polygon
+    segments = list(zip(coords[:-1], coords[1:]))
+    if geom[0] == 'polygon':
+        segments.append((coords[-1], coords[0]))
+    for p0, p1 in segments:
+        for i in range(4):
+            if segmentsIntersect(p0, p1, corners[i], corners[(i + 1) % 4]):
+                return True
+    return False
+
+
+class GridIndex(object):
+    """
+    Uniform grid over the bounding boxes of a set of geometries.
+    """
+
+    def __init__(self, entries):
+        """
+        GridIndex constructor.
+
+        @type entries: list
+        @param entries: List of (key, geometry) pairs (in drawing order).
+        """
+        self.entries = [(key, geom, geometryBounds(geom)) for key, geom in entries]
+        self.cells = {} # (i, j) -> [entry positions]
+        self.large = [] # positions of the entries covering too many cells
+        if not self.entries:
+            return
+        self.minx = min([e[2][0] for e in self.entries])
+        self.miny = min([e[2][1] for e in self.entries])
+        width = max([e[2][2] for e in self.entries]) - self.minx
+        height = max([e[2][3] for e in self.entries]) - self.miny
+        # about one entry per cell
+        self.cell_size = (max(width, height) / math.ceil(math.sqrt(len(self.entries)))) or 1.0
+        for n, (key, geom, bounds) in enumerate(self.entries):
+            i0, j0, i1, j1 = self.getCellRange(*bounds)
+            if (i1 - i0 + 1) * (j1 - j0 + 1) > MAX_CELLS_PER_ENTRY:
+                self.large.append(n)
+                continue
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    self.cells.setdefault((i, j), []).append(n)
+
+    def getCellRange(self, minx, miny, maxx, maxy):
+        """
+        @return: (i0, j0, i1, j1) range of the cells covered by a rectangle.
+        """
+        return (int(math.floor((minx - self.minx) / self.cell_size)), int(math.floor((miny - self.miny) / self.cell_size)),
+                int(math.floor((maxx - self.minx) / self.cell_size)), int(math.floor((maxy - self.miny) / self.cell_size)))
+
+    def getCandidates(self, minx, miny, maxx, maxy):
+        """
+        @return: Sorted positions of the entries whose cells intersect a rectangle.
+        """
+        if not self.entries:
+            return []
+        i0, j0, i1, j1 = self.getCellRange(minx, miny, maxx, maxy)
+        candidates = set(self.large)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            for (i, j), positions in self.cells.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    candidates.update(positions)
+        else:
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    candidates.update(self.cells.get((i, j), []))
+        return sorted(candidates)
+
+    def queryPoint(self, x, y, tolerance = 0):
+        """
+        @type x, y: float
+        @param x, y: Query point.
+        @type tolerance: float
+        @param tolerance: Max distance between the point and a matching geometry.
+        @return: Keys of the matching entries, nearest first (in drawing order, for equal distances).
+        """
+        hits = []
+        for n in self.getCandidates(x - tolerance, y - tolerance, x + tolerance, y + tolerance):
+            key, geom, bounds = self.entries[n]
+            if bounds[0] - tolerance <= x <= bounds[2] + tolerance and bounds[1] - tolerance <= y <= bounds[3] + tolerance:
+                d = geometryDistance(geom, x, y)
+                if d <= tolerance:
+                    hits.append((d, n, key))
+        hits.sort()
+        return [key for d, n, key in hits]
+
+    def queryRect(self, minx, miny, maxx, maxy):
+        """
+        @type minx, miny, maxx, maxy: float
+        @param minx, miny, maxx, maxy: Query rectangle.
+        @return: Keys of the entries intersecting the rectangle (in drawing order).
+        """
+        keys = []
+        for n in self.getCandidates(minx, miny, maxx, maxy):
+            key, geom, bounds = self.entries[n]
+            if bounds[0] <= maxx and bounds[2] >= minx and bounds[1] <= maxy and bounds[3] >= miny:
+                if geometryIntersectsRect(geom, minx, miny, maxx, maxy):
+                    keys.append(key)
+        return keys
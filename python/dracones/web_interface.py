@@ -29,13 +29,36 @@ def foo(req):
 
 import copy, time, traceback, uuid
 from dracones.core import *
+from dracones.session_store import DraconesSession, createSessionStore
+from dracones.prefetch import prefetcher
+from dracones.coalesce import continuesBurst, isSuperseded
+from dracones.locks import createLockManager, getLockKey, getSessionCookie, lock_middleware
+from dracones.janitor import Janitor
+from dracones.compression import gzip_middleware
 from pesto import *
 from pesto.session.filesessionmanager import *
 from pesto.wsgiutils import *
 
 
 dispatcher = dispatcher_app()
+lock_manager = createLockManager(dconf)
 application = session_middleware(FileSessionManager(dconf['session_path']), cookie_path='/')(dispatcher)
+application = lock_middleware(lock_manager, getSessionCookie(dconf))(application) # (pesto store) locks the sessions, releases the locks left by the requests
+if dconf.get('gzip_responses', True):
+    application = gzip_middleware(dconf.get('gzip_min_size', 1024), dconf.get('gzip_level', 6))(application)
+session_store = createSessionStore(dconf)
+Janitor(dconf).start() # only if janitor_interval is set
+
+
+def getSession(req):
+    """
+    Wraps the Pesto session of a request, so that the map widget states are read from
+    and written to the configured session store (see dracones.session_store).
+
+    @param req: Pesto request object.
+    @return: DraconesSession object.
+    """
+    return DraconesSession(req.session, session_store)
                                  
 
 def catchDraconesErrors(f):
@@ -60,6 +83,14 @@ def catchDraconesErrors(f):
                 return Response(content=[json.dumps({'success': False, 'error': 'missing_mid',
                                                      'error_msg': "Missing 'mid' param"})],
                                 content_type='application/json')
+            elif exc.args and exc.args[0] == 'session_locked':
+                return Response(content=[json.dumps({'success': False, 'error': 'session_locked',
+                                                     'error_msg': 'Session is busy with another request'})],
+                                content_type='application/json')
+            elif exc.args and exc.args[0] == 'unknown_batch_op':
+                return Response(content=[json.dumps({'success': False, 'error': 'unknown_batch_op',
+                                                     'error_msg': "Unknown batch operation: %s" % exc.args[1]})],
+                                content_type='application/json')
             tb = traceback.format_exc()
             tb = tb.replace('\n', '<br>')
             return Response(content=[json.dumps({'success':False, 'traceback': tb})],
@@ -67,6 +98,42 @@ def catchDraconesErrors(f):
     return new_f
 
 
+def catchImageErrors(f):
+    """
+    Counterpart of catchDraconesErrors for the routes returning an image (requested
+    by an <img> element, not by an ajax call): the errors are routed to the client
+    as HTTP error statuses, with a plain text body.
+
+    @type f: function
+    @param f: the function that will be exception wrapped.
+    @return: the wrapped function.
+    """
+
+    def new_f(*args):
+        try:
+            return f(*args)
+        except Exception as exc:
+            if exc.args and exc.args[0] in ['session_expired', 'missing_mid']:
+                return Response(status=404, content=['Session has expired'], content_type='text/plain')
+            elif exc.args and exc.args[0] == 'session_locked':
+                return Response(status=503, content=['Session is busy with another request'],
+                                content_type='text/plain').add_headers(retry_after='1')
+            return Response(status=500, content=[traceback.format_exc()], content_type='text/plain')
+    return new_f
+
+
+def releaseRequestLock(req):
+    """
+    Releases the session lock taken by beginDracones for a request, if it still holds it (a
+    lock taken by lock_middleware is held until the Pesto session is saved, after the request).
+
+    @param req: Pesto request object.
+    """
+    handle = req.environ.get('dracones.lock')
+    if handle is not None and not handle.held_until_response:
+        lock_manager.release(handle)
+
+
 def beginDracones(req, **kw):
     """
     B{First step of any Dracones complete interaction}: session
@@ -91,7 +158,7 @@ def beginDracones(req, **kw):
     history_dir = kw.get('history_dir', None)
 
     params = req.form
-    sess = req.session
+    sess = getSession(req)
 
     if sess.is_new:
         raise Exception('session_expired')
@@ -99,6 +166,12 @@ def beginDracones(req, **kw):
         raise Exception('missing_mid')
 
     mid = params['mid']
+    # the state of the widget is loaded (and saved by endDracones) under its lock (see dracones.locks)
+    lock_key = getLockKey(dconf, sess.session_id, mid)
+    if lock_key is not None and req.environ.get('dracones.lock') is None:
+        req.environ['dracones.lock'] = lock_manager.acquire(lock_key)
+    if mid not in sess:
+        raise Exception('session_expired')
 
     if history_dir == 'undo':
         assert sess[mid]['history_idx'] > 0
@@ -108,6 +181,8 @@ def beginDracones(req, **kw):
         sess[mid]['history_idx'] += 1
 
     dmap = DMap(sess, mid, use_viewport_geom)
+    dmap.request_lock = req.environ.get('dracones.lock')
+    dmap.client_rev = params.get('rev', None)
     dmap.restoreStateFromSession(restore_extent)
     if add_features:
         dmap.addDLayerFeatures()
@@ -127,23 +202,46 @@ def endDracones(dmap, **kw):
     @param shift_history_window: If an operation is not to be recorded in the session, the history window must not be shifted.
     @type update_session: keyword arg - bool
     @param update_session: Whether to update the session or not (for instance, when going back/forward in the history, this is needed).
+    @type superseded: keyword arg - bool
+    @param superseded: If True, the map image is not rendered, as a newer request will replace it (the next navigation
+                       request then continues the same history step, see dracones.coalesce).
     @return: json_out JSON dict, containing all the variables required by the client, and that can be modified
              between the return of this call and the final call to exitDracones.
     """
     shift_history_window = kw.get('shift_history_window', True)
     update_session = kw.get('update_session', True)
+    superseded = kw.get('superseded', False)
 
     json_out = {'success': True}
     json_out['extent'] = dmap.getExtent()
-    json_out['hover'] = dmap.getHoverItems()
-    json_out['selection'] = dmap.getSelection()
-    json_out['map_img_url'] = dmap.getImageURL() 
+    if dmap.sess_mid.get('hover_encoding', 'list') == 'compact':
+        json_out['hover'] = dmap.getCompactHoverItems()
+    else:
+        json_out['hover'] = dmap.getHoverItems()
+    if superseded:
+        json_out['superseded'] = True
+    elif dmap.isTiled():
+        json_out['tiles'] = dmap.getTiles()
+    elif dmap.sess_mid.get('img_delivery', 'url') == 'inline':
+        json_out['map_img_url'] = dmap.getImageDataURI()
+    elif dmap.sess_mid.get('img_delivery', 'url') == 'lazy':
+        json_out['map_img_url'] = dmap.getLazyImageURL()
+    else:
+        json_out['map_img_url'] = dmap.getImageURL() 
     if update_session:
         dmap.saveStateInSession(shift_history_window)
+    if dmap.sess_mid.get('nav_burst', False) != superseded:
+        dmap.sess_mid['nav_burst'] = superseded # see continuesBurst
+    if dmap.sess_mid.get('delta_responses', False):
+        json_out.update(dmap.getSelectionDelta(dmap.client_rev, update_session))
+    else:
+        json_out['selection'] = dmap.getSelection()
     dmap.sess.save()
+    if dmap.request_lock is not None and not dmap.request_lock.held_until_response:
+        lock_manager.release(dmap.request_lock)
 
-    json_out['can_undo'] = dmap.sess_mid['history_idx'] > 0 and ('init' not in dmap.sess_mid['history'][dmap.sess_mid['history_idx']-1])
-    json_out['can_redo'] = dmap.sess_mid['history_idx'] < (dmap.sess_mid['history_size'] - 1)
+    json_out['can_undo'] = dmap.canUndo()
+    json_out['can_redo'] = dmap.canRedo()
     json_out['history_idx'] = dmap.sess_mid['history_idx']
     json_out['shift_history_window'] = shift_history_window if update_session else False
     return json_out
@@ -162,6 +260,42 @@ def exitDracones(json_out):
     return Response(content=[json.dumps(json_out)], content_type='application/json')
 
 
+batch_ops = {}
+"""Operations that can be applied by the /batch route: op name -> (function(dmap, params), defers_features)."""
+
+def batchOp(name, defers_features = False):
+    """
+    Decorator registering a function as a batch operation (see batch). The function is
+    passed the dmap and the params of the operation (a dict-like object, as req.form),
+    and must not call beginDracones or endDracones. Extension modules can register
+    their own operations the same way.
+
+    @type name: str
+    @param name: Name of the operation, in the batch requests.
+    @type defers_features: bool
+    @param defers_features: Whether the operation modifies the features of the dlayers (or their selection), in which
+                            case the features already added to the map by a previous operation are removed before it
+                            is applied, to be added again afterwards (see DMap.removeDLayerFeatures).
+    @return: The decorator.
+    """
+    def register(f):
+        batch_ops[name] = (f, defers_features)
+        return f
+    return register
+
+
+def splitParam(value):
+    """
+    @param value: A list param: a list, or its items joined by commas.
+    @return: The list of items.
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+    return value.split(',')
+
+
 @dispatcher.match('/init', 'GET')
 @catchDraconesErrors
 def init(req):
@@ -181,9 +315,21 @@ def init(req):
     @param msvp: HTTP GET param - map size relative to the viewport (the viewport dims will be multiplied by this value).
     @type history_size: int
     @param history_size: HTTP GET param - number of history cells kept (nb. of times undo will be allowed, in other words).
+    @type tiled: B{str} ('true' | 'false')
+    @param tiled: HTTP GET param - if 'true', the map is returned as a list of cached tiles instead of a single image (see DMap.getTiles).
+    @type img_delivery: 'url' | 'inline' | 'lazy'
+    @param img_delivery: HTTP GET param - whether the map image is saved in ms_tmp_path and returned as a URL (default), embedded
+                         in the response as a data URI (see DMap.getImageDataURI), or only drawn when the client fetches it
+                         (see DMap.getLazyImageURL).
+    @type hover_encoding: 'list' | 'compact'
+    @param hover_encoding: HTTP GET param - whether the hover items are returned as lists of (gx, gy, html) triplets (default), or
+                           in columnar form (see DMap.getCompactHoverItems).
+    @type delta_responses: B{str} ('true' | 'false')
+    @param delta_responses: HTTP GET param - if 'true', the responses only contain the selection of the dlayers that changed
+                            since the last response processed by the client, identified by the rev it sends back (see DMap.getSelectionDelta).
     """
     params = req.form
-    sess = req.session
+    sess = getSession(req)
     json_out = { 'success' : True }
 
     # init params
@@ -193,13 +339,17 @@ def init(req):
     mvph = int(params.get('mvph', 0)) # map viewport height
     msvp = int(params.get('msvp', 0)) # map size relative to viewport
     history_size = int(params.get('history_size', 1))
+    tiled = params.get('tiled', 'false').lower() == 'true'
+    img_delivery = params.get('img_delivery', 'url')
+    hover_encoding = params.get('hover_encoding', 'list')
+    delta_responses = params.get('delta_responses', 'false').lower() == 'true'
 
     if not app or not map_name or not mvpw or not mvph or not msvp:
          return Response(content_type='application/json',
                          content=[json.dumps({'success' : False, 'error' : 'missing init variables (app, map, mvpw, mvph, msvp)'})])
 
     mid = str(uuid.uuid4())
-    sess[mid] = {'app': app, 'map' : map_name, 'mvpw' : mvpw, 'mvph' : mvph, 'msvp': msvp, 'history_size' : history_size, 'history' : [], 'history_idx' : (history_size - 1) }
+    sess[mid] = {'app': app, 'map' : map_name, 'mvpw' : mvpw, 'mvph' : mvph, 'msvp': msvp, 'history_size' : history_size, 'history' : [], 'history_head' : 0, 'history_idx' : (history_size - 1), 'tiled' : tiled, 'img_delivery' : img_delivery, 'hover_encoding' : hover_encoding, 'delta_responses' : delta_responses }
 
     for i in range(history_size):
         hist_cell = newHistoryCell()
@@ -224,6 +374,14 @@ def fullExtent(req):
     return exitDracones(endDracones(dmap))
 
 
+@batchOp('fullExtent')
+def fullExtentOp(dmap, params):
+    """
+    Resets the map initial extent (see fullExtent).
+    """
+    dmap.setExtentFromDict(dmap.default_extent)
+
+
 @dispatcher.match('/pan', 'GET')
 @catchDraconesErrors
 def pan(req):
@@ -233,16 +391,30 @@ def pan(req):
     @param req: Pesto request object.
     @type pan_dir: 'right' | 'left' | 'up' | 'down'
     @param pan_dir: HTTP GET param - the direction in which to pan the map.
+    @type nav_pending: B{str} ('true' | 'false')
+    @param nav_pending: HTTP GET param - whether the client has other navigation requests queued (see dracones.coalesce).
     """
     dmap = beginDracones(req)            
     params = req.form
     pan_dir = params['dir']
     dmap.pan(pan_dir)
-    json_out = endDracones(dmap, shift_history_window=True) # Not sure if pan steps should be recorded as history items..
+    superseded = isSuperseded(params)
+    # Not sure if pan steps should be recorded as history items.. (a burst of them is recorded as a single one)
+    json_out = endDracones(dmap, shift_history_window=not continuesBurst(dmap), superseded=superseded)
     json_out['pan_dir'] = pan_dir
+    if not superseded:
+        prefetcher.schedule(dmap, [('pan', pan_dir)]) # the next pan is likely in the same direction
     return exitDracones(json_out)
 
 
+@batchOp('pan')
+def panOp(dmap, params):
+    """
+    Pans the map (see pan).
+    """
+    dmap.pan(params['dir'])
+
+
 @dispatcher.match('/zoom', 'GET')
 @catchDraconesErrors
 def zoom(req):
@@ -262,6 +434,8 @@ def zoom(req):
     @param mode: HTTP GET param - zoom mode, "in" or "out".
     @type zsize: int
     @param zsize: HTTP GET param - zoom size.
+    @type nav_pending: B{str} ('true' | 'false')
+    @param nav_pending: HTTP GET param - whether the client has other navigation requests queued (see dracones.coalesce).
     """
     dmap = beginDracones(req)
 
@@ -274,9 +448,26 @@ def zoom(req):
     mode = params.get('mode', None)
     zsize = int(params.get('zsize', 2))
 
+    prev_extent = dmap.getExtent()
     dmap.zoom(x, y, w, h, mode, zsize)
 
-    return exitDracones(endDracones(dmap))
+    superseded = isSuperseded(params)
+    json_out = endDracones(dmap, shift_history_window=not continuesBurst(dmap), superseded=superseded)
+    if superseded:
+        return exitDracones(json_out)
+    # the next zoom is likely the reverse one, back to the previous extent (x/y are
+    # pixel coords of the previous extent, they can't be reused on the new one)
+    prefetcher.schedule(dmap, [('setExtentFromDict', prev_extent)])
+    return exitDracones(json_out)
+
+
+@batchOp('zoom')
+def zoomOp(dmap, params):
+    """
+    Point/box zoom (see zoom).
+    """
+    dmap.zoom(int(params.get('x')), int(params.get('y')), int(params.get('w', 0)), int(params.get('h', 0)),
+              params.get('mode', None), int(params.get('zsize', 2)))
 
 # CTRL + left mouse button: box/point action: select or draw)
 
@@ -311,33 +502,41 @@ def action(req):
     @param dlayers: HTTP GET param - list of dlayers on which to perform the action.
     """
     dmap = beginDracones(req, add_features=False) # dont add features, because we may need to clear the
+    actionOp(dmap, req.form)
+    return exitDracones(endDracones(dmap))
 
-    json_out = {'success': True}                                
 
-    # input params
-    params = req.form
+@batchOp('action')
+def actionOp(dmap, params):
+    """
+    Select or draw action (see action).
+    """
     x = int(params.get('x', 0))
     y = int(params.get('y', 0))
     w = int(params.get('w', 0))
     h = int(params.get('h', 0))
     action = params.get('action', None)
     select_mode = params.get('select_mode', 'reset')
-    dlayers = params.get('dlayers', None)
+    dlayers = splitParam(params.get('dlayers', None))
 
     if action == 'select':
 
         # only significant for custom feature layers
         if select_mode == 'reset':
-            for dlayer_name in dlayers.split(',') if dlayers else []:
+            if dmap.features_added: # (in a batch) the selected features would keep their class
+                dmap.removeDLayerFeatures()
+            for dlayer_name in dlayers:
                 dmap.clearDLayer(dlayer_name, 'selected')
 
-        dmap.addDLayerFeatures()
-        dmap.select(dlayers.split(',') if dlayers else [], x, y, w, h, select_mode)
+        if not dmap.features_added:
+            dmap.addDLayerFeatures()
+        dmap.select(dlayers, x, y, w, h, select_mode)
 
     elif action == 'draw':
 
-        dmap.addDLayerFeatures()
-        for dlayer_name in dlayers.split(',') if dlayers else []:            
+        if not dmap.features_added:
+            dmap.addDLayerFeatures()
+        for dlayer_name in dlayers:
             if dmap.hasDLayer(dlayer_name):
                 dmap.dlayers[dlayer_name].drawFeature(x, y)
 
@@ -345,8 +544,6 @@ def action(req):
 
         assert False, 'action is not defined'
 
-    return exitDracones(endDracones(dmap))
-
 
 @dispatcher.match('/setDLayersStatus', 'GET')
 @catchDraconesErrors
@@ -361,21 +558,23 @@ def setDLayersStatus(req):
     @param dlayers_off: HTTP GET param - list of dlayers to desactivate.
     """
     dmap = beginDracones(req)
+    setDLayersStatusOp(dmap, req.form)
+    return exitDracones(endDracones(dmap))
 
-    params = req.form
-    dlayers_on = params.get('dlayers_on', None)
-    dlayers_off = params.get('dlayers_off', None)
 
+@batchOp('setDLayersStatus')
+def setDLayersStatusOp(dmap, params):
+    """
+    Sets dlayers status on/off (see setDLayersStatus).
+    """
     # dlayers to turn on
-    for dlayer_name in list(set(dlayers_on.split(',') if dlayers_on else [])):
+    for dlayer_name in list(set(splitParam(params.get('dlayers_on', None)))):
         dmap.dlayers[dlayer_name].setStatus(MS_ON)
 
     # dlayers to turn off
-    for dlayer_name in list(set(dlayers_off.split(',') if dlayers_off else [])):
+    for dlayer_name in list(set(splitParam(params.get('dlayers_off', None)))):
         dmap.dlayers[dlayer_name].setStatus(MS_OFF)
 
-    return exitDracones(endDracones(dmap))
-
 
 @dispatcher.match('/clearDLayers', 'GET')
 @catchDraconesErrors
@@ -391,18 +590,22 @@ def clearDLayers(req):
     @param dlayers: HTTP GET param - list of dlayers on which to apply the clear.
     """
     dmap = beginDracones(req, add_features=False) # dont add features yet
-
-    params = req.form
-    what = params.get('what')
-    dlayers_to_clear = params.get('dlayers', None)
-
-    for dlayer_name in list(set(dlayers_to_clear.split(","))) if dlayers_to_clear else []:
-        dmap.clearDLayer(dlayer_name, what) # need to remove ref to sess/mid here
+    clearDLayersOp(dmap, req.form)
     dmap.addDLayerFeatures()
 
     return exitDracones(endDracones(dmap))
 
 
+@batchOp('clearDLayers', defers_features=True)
+def clearDLayersOp(dmap, params):
+    """
+    Clears dlayers (see clearDLayers).
+    """
+    what = params.get('what')
+    for dlayer_name in list(set(splitParam(params.get('dlayers', None)))):
+        dmap.clearDLayer(dlayer_name, what) # need to remove ref to sess/mid here
+
+
 @dispatcher.match('/toggleDLayers', 'GET')
 @catchDraconesErrors
 def toggleDLayers(req):
@@ -413,10 +616,16 @@ def toggleDLayers(req):
     @param dlayers: HTTP GET param - list of dlayers to toggle.
     """
     dmap = beginDracones(req)
+    toggleDLayersOp(dmap, req.form)
+    return exitDracones(endDracones(dmap))
 
-    params = req.form
-    if params.get('dlayers', None): dlayers_to_toggle = list(set(params.get('dlayers').split(",")))
-    else: dlayers_to_toggle = []
+
+@batchOp('toggleDLayers')
+def toggleDLayersOp(dmap, params):
+    """
+    Toggles dlayers on/off (see toggleDLayers).
+    """
+    dlayers_to_toggle = list(set(splitParam(params.get('dlayers', None))))
 
     # warning: toggled dlayer must have been created by a previous call
     for dlayer_name in dlayers_to_toggle:
@@ -425,8 +634,6 @@ def toggleDLayers(req):
         else:
             dmap.dlayers[dlayer_name].setStatus(MS_ON)
 
-    return exitDracones(endDracones(dmap))
-
 
 @dispatcher.match('/export', 'GET')
 @catchDraconesErrors
@@ -447,8 +654,7 @@ def export(req):
     vptx = int(params.get('vptx', 0))
     vpty = int(params.get('vpty', 0))
 
-    hist_idx = dmap.sess_mid['history_idx']
-    xt = dmap.sess_mid['history'][hist_idx]['extent'].copy()
+    xt = dmap.getHistoryCell()['extent'].copy()
 
     # First adjust temp extent to match vp size map
     xvp = (xt['maxx'] - xt['minx']) / dmap.sess_mid['msvp']
@@ -470,16 +676,52 @@ def export(req):
     xt['maxy'] += yd
     dmap.setExtentFromDict(xt)
 
-    img = dmap.draw()
-    img.imagepath = os.path.abspath(dconf['ms_tmp_path'])
-    # image filename structure: <mapname>_<mid>_<session_id>_EXPORT.<img_type>
-    fn = "%s_%s_%s_%s.%s" % (dmap.sess_mid['map'], dmap.app, dmap.sess.session_id, "EXPORT", dmap.imagetype)
-    img.save("%s/%s" % (os.path.abspath(dconf['ms_tmp_path']), fn))
-
-    return serve_static_file(req, '%s/%s' % (os.path.abspath(dconf['ms_tmp_path']), fn)).add_headers(
+    # the exported image is sent directly, it doesn't need to be stored
+    return Response(content=[dmap.renderImage()], content_type=dmap.outputformat.mimetype).add_headers(
         content_disposition='attachment; filename=%s_%s.%s' % (dmap.app, time.strftime('%Y-%m-%d_%Hh%Mm%Ss'), dmap.imagetype))
 
 
+@dispatcher.match('/image', 'GET')
+def image(req):
+    """
+    Serves a map image from the image store (only used with the "memory" image_store, see dracones.image_store).
+
+    @param req: Pesto request object.
+    @type key: str
+    @param key: HTTP GET param - the image key.
+    """
+    img = image_store.get(req.form.get('key', ''))
+    if img is None:
+        return Response(status=404, content=['Image not found'], content_type='text/plain')
+    return Response(content=[img[0]], content_type=img[1]).add_headers(cache_control='no-cache')
+
+
+@dispatcher.match('/render', 'GET')
+@catchImageErrors
+def render(req):
+    """
+    Draws the map image of a lazily rendered state (see DMap.getLazyImageURL), unless a newer
+    state has replaced it in the meantime.
+
+    @param req: Pesto request object.
+    @type mid: str
+    @param mid: HTTP GET param - the map widget ID.
+    @type rev: str
+    @param rev: HTTP GET param - the render rev of the state.
+    """
+    sess = getSession(req)
+    mid = req.form.get('mid', '')
+    if sess.is_new or mid not in sess:
+        return Response(status=404, content=['Session has expired'], content_type='text/plain')
+    if sess[mid].get('render_rev') != req.form.get('rev', None):
+        return Response(status=410, content=['Superseded'], content_type='text/plain')
+    try:
+        dmap = beginDracones(req)
+    finally:
+        releaseRequestLock(req) # the state is only read
+    return Response(content=[dmap.renderImage()], content_type=dmap.outputformat.mimetype).add_headers(cache_control='no-cache')
+
+
 @dispatcher.match('/setFeatureVisibility', 'GET')
 @catchDraconesErrors
 def setFeatureVisibility(req):
@@ -497,24 +739,26 @@ def setFeatureVisibility(req):
     @param is_visible: HTTP GET param - feature visibility status.
     """
     dmap = beginDracones(req, add_features=False) 
+    setFeatureVisibilityOp(dmap, req.form)
+    dmap.addDLayerFeatures()
 
-    # input params
-    params = req.form
+    return exitDracones(endDracones(dmap))
+
+
+@batchOp('setFeatureVisibility', defers_features=True)
+def setFeatureVisibilityOp(dmap, params):
+    """
+    Sets the visibility of features (see setFeatureVisibility).
+    """
     dlayer_name = params.get('dlayer')
-    if params.get('features', None): features = list(set(params.get('features', None).split(",")))
-    else: features = []
-    if params.get('visibles', None): visibles = list(set(params.get('visibles', None).split(",")))
-    else: visibles = []
+    features = list(set(splitParam(params.get('features', None))))
+    visibles = list(set(splitParam(params.get('visibles', None))))
 
     assert len(features) == len(visibles)
 
     for i, feature_id in enumerate(features):
         dmap.dlayers[dlayer_name].setFeatureVisibility(feature_id, visibles[i].lower()=='true')
 
-    dmap.addDLayerFeatures()
-
-    return exitDracones(endDracones(dmap))
-
 
 @dispatcher.match('/selectFeatures', 'GET')
 @catchDraconesErrors
@@ -532,20 +776,23 @@ def selectFeatures(req):
                                          "toggle" will toggle the selected state of the target items, and "add" will not unselect nor toggle anything before selecting new features.
     """
     dmap = beginDracones(req, add_features=False) 
+    selectFeaturesOp(dmap, req.form)
+    dmap.addDLayerFeatures()
 
-    # input params
-    params = req.form
+    return exitDracones(endDracones(dmap))
+
+
+@batchOp('selectFeatures', defers_features=True)
+def selectFeaturesOp(dmap, params):
+    """
+    Selects features (see selectFeatures).
+    """
     dlayer_name = params.get('dlayer')
-    if params.get('features', None): features = list(set(params.get('features', None).split(",")))
-    else: features = []
+    features = list(set(splitParam(params.get('features', None))))
     select_mode = params.get('select_mode', 'reset')
 
     dmap.selectFeatures(dlayer_name, features, select_mode)
 
-    dmap.addDLayerFeatures()
-
-    return exitDracones(endDracones(dmap))
-
 
 @dispatcher.match('/history', 'GET')
 @catchDraconesErrors
@@ -562,3 +809,45 @@ def history(req):
     dmap = beginDracones(req, history_dir=direction)     
     return exitDracones(endDracones(dmap, update_session=False))
 
+
+@dispatcher.match('/batch', 'GET')
+@catchDraconesErrors
+def batch(req):
+    """
+    Applies a list of operations to the map, in order, as a single interaction: the map is
+    restored, rendered and saved in the session once, and the whole batch is recorded as a
+    single history step. The operations (see batchOp) are the ones of the routes of the same
+    name (action, clearDLayers, fullExtent, pan, selectFeatures, setDLayersStatus,
+    setFeatureVisibility, toggleDLayers, zoom), with the same params (list params can also
+    be given as JSON arrays). The operations can come in any order: the features are added to
+    the map by the actions that need them, and added again when a later operation modifies them.
+
+    @param req: Pesto request object.
+    @type ops: str (JSON list)
+    @param ops: HTTP GET param - list of operations, as {op: name, ..params} objects.
+    """
+    ops = json.loads(req.form.get('ops', '[]'))
+    for op in ops:
+        if op.get('op') not in batch_ops:
+            raise Exception('unknown_batch_op', op.get('op'))
+
+    dmap = beginDracones(req, add_features=False)
+    for op in ops:
+        f, defers_features = batch_ops[op['op']]
+        if defers_features and dmap.features_added:
+            dmap.removeDLayerFeatures() # added again by the next action, or below
+        f(dmap, op)
+    if not dmap.features_added:
+        dmap.addDLayerFeatures()
+
+    return exitDracones(endDracones(dmap))
+
+
+@dispatcher.match('/lockStats', 'GET')
+def lockStats(req):
+    """
+    Session lock wait metrics of this process (see LockManager.getStats).
+
+    @param req: Pesto request object.
+    """
+    return Response(content=[json.dumps(lock_manager.getStats())], content_type='application/json')